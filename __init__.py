@@ -36,31 +36,9 @@
 from vcycle.shared   import *
 from vcycle.vacutils import *
 
-import os
-
-# We import all modules of the form xxxx_api.py in the package directory
-# and in first level folders
-#
-# The API object in the module is created by shared.py at runtime using
-# the BaseSpace.__subclasses__() method.
-
-vcycledir = os.path.dirname(__file__)
-
-for dirname, dirnames, files in os.walk(vcycledir):
-  # ignore .git folder and build folder
-  if '.git' in dirnames:
-    dirnames.remove('.git')
-  if 'RPMTMP' in dirnames:
-    dirnames.remove('RPMTMP')
-  # look for api files and import them
-  for apifile in files:
-    if apifile.endswith('_api.py'):
-      reldir = os.path.relpath(dirname, vcycledir)
-      if reldir == '.':
-        __import__('vcycle.' + apifile[:-3])
-      else:
-        __import__('vcycle.' + reldir + '.' + apifile[:-3])
-
-del apifile, dirname, dirnames, files
+# Space plugins in modules of the form xxxx_api.py are no longer all
+# imported here. shared.loadSpacePlugin() imports each one only when
+# readConf() finds a space which uses it, and the API object in the
+# module is then created using the BaseSpace.__subclasses__() method.
 
 __all__ = [ 'shared', 'vacutils' ]
@@ -0,0 +1,327 @@
+#!/usr/bin/python
+#
+#  cycle_benchmark.py - Time the steps of a cycle for large spaces
+#
+#  Generates /var/lib/vcycle/shared/spaces/SPACE/current for N machines in
+#  mixed states on a tmpfs, and runs Machine construction, scanMachines(),
+#  commitMachineEffects(), deleteMachines(), createHeartbeatMachines() and
+#  makeMachines() of a real OpenStack space against fake_openstack.py on
+#  127.0.0.1. For each step it reports the wall and CPU time, the read and
+#  write system calls counted in /proc/self/io (but not open, stat, rename
+#  and other system calls), the Vcycle file operations, the HTTP calls and
+#  the growth in resident memory.
+#
+#  This must be run as root, since it reexecutes itself with unshare(1) in a
+#  private mount namespace and mounts a tmpfs over /var/lib/vcycle there, and
+#  hides /etc/vcycle.conf and /etc/vcycle.d. The real files are not touched.
+#
+#  Usage: python benchmarks/cycle_benchmark.py [--json FILE]
+#                 [--baseline FILE [--tolerance FRACTION]] [N ...]
+#
+#  The default sizes are 1000 10000 50000. --json saves the results, and
+#  --baseline compares them with results saved before, exiting with status
+#  1 if any step takes more time, read/write calls, file operations or HTTP
+#  calls than the baseline by more than the tolerance (default 0.25)
+#
+
+import os
+import gc
+import sys
+import imp
+import json
+import time
+import base64
+import getopt
+import shutil
+import signal
+import calendar
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# The root of the repository is the vcycle package, so load it from this
+# checkout rather than using any installed copy of Vcycle
+imp.load_package('vcycle', os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vcycle.shared
+import vcycle.metrics
+import vcycle.vacutils
+
+import fake_openstack
+
+spaceName     = 'bench.example'
+heartbeatFile = 'vm-heartbeat'
+timeNow       = 1600000000 + 86400 * ((int(time.time()) - 1600000000) / 86400)
+
+confTemplate = """[space %(spaceName)s]
+api             = openstack
+url             = http://127.0.0.1:%(port)d/v3
+api_version     = 3
+glance_api      = 2
+project_name    = benchmark
+username        = benchmark
+password_base64 = %(password)s
+https_host      = vcycle.example
+"""
+
+machinetypeTemplate = """
+[machinetype %(spaceName)s %(machinetypeName)s]
+root_image            = image:%(imageName)s
+flavor_names          = m1.large
+min_processors        = 8
+backoff_seconds       = 600
+fizzle_seconds        = 600
+max_wallclock_seconds = 172800
+heartbeat_file        = %(heartbeatFile)s
+heartbeat_seconds     = 600
+target_share          = 1
+user_data             = user_data
+"""
+
+states = { 'ACTIVE'  : vcycle.shared.MachineState.running,
+           'BUILD'   : vcycle.shared.MachineState.starting,
+           'SHUTOFF' : vcycle.shared.MachineState.shutdown,
+           'ERROR'   : vcycle.shared.MachineState.failed }
+
+def rssBytes():
+  return int(open('/proc/self/statm').read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def enterNamespace():
+  # Rerun this script in a private mount namespace with a tmpfs on
+  # /var/lib/vcycle, and without the real configuration files
+
+  if os.environ.get('VCYCLE_BENCHMARK_NAMESPACE') != '1':
+    if os.geteuid() != 0:
+      sys.exit('cycle_benchmark.py must be run as root, to mount a private tmpfs on /var/lib/vcycle')
+
+    os.environ['VCYCLE_BENCHMARK_NAMESPACE'] = '1'
+    os.execvp('unshare', [ 'unshare', '--mount', '--propagation', 'private', sys.executable ] + sys.argv)
+
+  if not os.path.isdir('/var/lib/vcycle'):
+    os.makedirs('/var/lib/vcycle')
+
+  subprocess.check_call([ 'mount', '-t', 'tmpfs', 'tmpfs', '/var/lib/vcycle' ])
+
+  if os.path.isdir('/etc/vcycle.d'):
+    subprocess.check_call([ 'mount', '-t', 'tmpfs', 'tmpfs', '/etc/vcycle.d' ])
+
+  if os.path.exists('/etc/vcycle.conf'):
+    subprocess.check_call([ 'mount', '--bind', '/dev/null', '/etc/vcycle.conf' ])
+
+def writeTree(cloud, port):
+  """ Write the configuration and the machine directories that the cloud's
+      servers would have after some cycles. Running machines mostly have
+      recent heartbeats, and half of the stopped ones shutdown messages """
+
+  for name in os.listdir('/var/lib/vcycle'):
+    if os.path.isdir('/var/lib/vcycle/' + name):
+      shutil.rmtree('/var/lib/vcycle/' + name)
+    else:
+      os.remove('/var/lib/vcycle/' + name)
+
+  for path in [ '/var/lib/vcycle/tmp', '/var/lib/vcycle/shared/tmp', '/var/lib/vcycle/shared/vcycle.d',
+                '/var/lib/vcycle/spaces/' + spaceName ]:
+    os.makedirs(path)
+
+  conf = confTemplate % { 'spaceName' : spaceName, 'port' : port, 'password' : base64.b64encode('benchmark') }
+
+  for machinetypeName in fake_openstack.machinetypeNames:
+    conf += machinetypeTemplate % { 'spaceName' : spaceName, 'machinetypeName' : machinetypeName,
+                                    'imageName' : fake_openstack.imageName, 'heartbeatFile' : heartbeatFile }
+
+    os.makedirs('/var/lib/vcycle/spaces/%s/machinetypes/%s/files' % (spaceName, machinetypeName))
+    open('/var/lib/vcycle/spaces/%s/machinetypes/%s/files/user_data' % (spaceName, machinetypeName), 'w').write(
+         '#!/bin/sh\necho ##user_data_space## ##user_data_machinetype##\n')
+
+  open('/var/lib/vcycle/shared/vcycle.d/benchmark.conf', 'w').write(conf)
+
+  hostName = os.uname()[1]
+
+  for (i, server) in enumerate(sorted(cloud.servers.values(), key = lambda server: server['name'])):
+    machineDir  = '/var/lib/vcycle/shared/spaces/%s/current/%s' % (spaceName, server['name'])
+    createdTime = calendar.timegm(time.strptime(server['created'], '%Y-%m-%dT%H:%M:%SZ'))
+
+    for subDir in [ 'machinefeatures', 'jobfeatures', 'joboutputs' ]:
+      os.makedirs(machineDir + '/' + subDir)
+
+    files = { 'created'                  : str(createdTime),
+              'updated'                  : str(createdTime),
+              'machinetype_name'         : server['metadata']['machinetype'],
+              'space_name'               : spaceName,
+              'manager'                  : hostName,
+              'manager_heartbeat'        : str(timeNow),
+              'user_data'                : '#!/bin/sh\n',
+              'jobfeatures/allocated_cpu': '8' }
+
+    if server['status'] != 'BUILD':
+      files['started'] = str(createdTime + 60)
+
+    if server['status'] == 'ACTIVE' and i % 7:
+      files['joboutputs/' + heartbeatFile] = str(timeNow)
+
+    if server['status'] in ('SHUTOFF', 'ERROR'):
+      files['stopped'] = str(createdTime + 3600)
+
+      if i % 2:
+        files['joboutputs/shutdown_message'] = '300 No more work'
+
+    for (fileName, contents) in files.iteritems():
+      open(machineDir + '/' + fileName, 'w').write(contents)
+
+class Counters:
+  # Counts at the start of a step
+
+  def __init__(self):
+    io    = dict([ line.split(':') for line in open('/proc/self/io') ])
+    times = os.times()
+
+    self.time      = time.time()
+    self.cpu       = times[0] + times[1]
+    # Only read and write calls are counted there, not open, stat, rename etc
+    self.rwSyscalls = int(io['syscr']) + int(io['syscw'])
+    self.fileOps   = sum(vcycle.vacutils.fileOpCounts.values())
+    self.httpCalls = sum([ endpoint['calls'] for endpoint in vcycle.metrics.cycleRecord['http'].values() ])
+    self.rss       = rssBytes()
+
+  def since(self, start):
+    return { 'seconds'     : self.time - start.time,
+             'cpu_seconds' : self.cpu - start.cpu,
+             'rw_syscalls' : self.rwSyscalls - start.rwSyscalls,
+             'file_ops'    : self.fileOps - start.fileOps,
+             'http_calls'  : self.httpCalls - start.httpCalls,
+             'rss_bytes'   : self.rss - start.rss }
+
+def constructMachines(space, cloud):
+  # Make the Machine objects for the servers, as scanMachines() does but
+  # without the HTTP call and JSON decoding
+
+  machines = {}
+
+  for server in cloud.servers.values():
+    machines[server['name']] = vcycle.shared.Machine(name            = server['name'],
+                                                     spaceName       = spaceName,
+                                                     state           = states[server['status']],
+                                                     ip              = server['addresses']['private'][0]['addr'],
+                                                     createdTime     = calendar.timegm(time.strptime(server['created'], '%Y-%m-%dT%H:%M:%SZ')),
+                                                     startedTime     = None,
+                                                     updatedTime     = None,
+                                                     uuidStr         = server['id'],
+                                                     machinetypeName = server['metadata']['machinetype'],
+                                                     zone            = 'nova',
+                                                     processors      = 8)
+  return machines
+
+def commitMachineEffects(space):
+  space.updateAccounting()
+  space.commitMachineEffects()
+
+def runSize(numberMachines):
+  cloud  = fake_openstack.FakeCloud(numberMachines, timeNow = timeNow)
+  server = fake_openstack.FakeOpenstackServer(0, cloud)
+  port   = server.server_address[1]
+
+  writeTree(cloud, port)
+
+  serverPid = os.fork()
+
+  if serverPid == 0:
+    try:
+      server.serve_forever()
+    finally:
+      os._exit(0)
+
+  server.server_close()
+
+  try:
+    vcycle.shared.readConf(updatePipes = False)
+    space = vcycle.shared.spaces[spaceName]
+
+    vcycle.metrics.startCycle()
+    space.connect()
+
+    steps = [ ('Machine()',               lambda: constructMachines(space, cloud)),
+              ('scanMachines',            space.scanMachines),
+              ('commitMachineEffects',    lambda: commitMachineEffects(space)),
+              ('deleteMachines',          space.deleteMachines),
+              ('createHeartbeatMachines', space.createHeartbeatMachines),
+              ('makeMachines',            space.makeMachines) ]
+
+    results = []
+    gc.collect()
+
+    for (stepName, function) in steps:
+      start = Counters()
+      kept  = function()
+      result = Counters().since(start)
+
+      result['machines'] = numberMachines
+      result['step']     = stepName
+      results.append(result)
+
+      del kept
+
+  finally:
+    os.kill(serverPid, signal.SIGTERM)
+    os.waitpid(serverPid, 0)
+    vcycle.shared.spaces = {}
+
+  return results
+
+def compareBaseline(results, baseline, tolerance):
+  # Return descriptions of the steps which are worse than the baseline
+
+  regressions = []
+  old         = dict([ ((result['machines'], result['step']), result) for result in baseline ])
+
+  for result in results:
+    if (result['machines'], result['step']) not in old:
+      continue
+
+    oldResult = old[(result['machines'], result['step'])]
+
+    # Small absolute changes in time and in read and write calls, which
+    # include logging and the HTTP connections, are just noise
+    for (field, slack) in [ ('seconds', 0.05), ('rw_syscalls', 100), ('file_ops', 0), ('http_calls', 0) ]:
+      if field in oldResult and result[field] > oldResult[field] * (1.0 + tolerance) + slack:
+        regressions.append('%d machines %s: %s %s > %s' % (result['machines'], result['step'], field,
+                                                            str(result[field]), str(oldResult[field])))
+  return regressions
+
+def main(argv):
+  (opts, args) = getopt.getopt(argv, '', [ 'json=', 'baseline=', 'tolerance=' ])
+  opts         = dict(opts)
+  sizes        = [ int(arg) for arg in args ] or [ 1000, 10000, 50000 ]
+
+  enterNamespace()
+
+  # Per-machine log lines are not what we are measuring
+  vcycle.vacutils.logStream = open(os.devnull, 'w')
+
+  results = []
+
+  print '%10s %-24s %9s %9s %19s %10s %6s %9s' % ('machines', 'step', 'seconds', 'cpu s', 'read/write syscalls', 'file ops', 'http', 'RSS MiB')
+
+  for numberMachines in sizes:
+    for result in runSize(numberMachines):
+      print '%10d %-24s %9.3f %9.3f %19d %10d %6d %9.1f' % (result['machines'], result['step'], result['seconds'], result['cpu_seconds'],
+                                                             result['rw_syscalls'], result['file_ops'], result['http_calls'],
+                                                             result['rss_bytes'] / 1048576.0)
+      results.append(result)
+
+  print 'Peak RSS %.1f MiB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+
+  if '--json' in opts:
+    json.dump(results, open(opts['--json'], 'w'), indent = 1)
+
+  if '--baseline' in opts:
+    regressions = compareBaseline(results, json.load(open(opts['--baseline'])), float(opts.get('--tolerance', 0.25)))
+
+    for regression in regressions:
+      print 'Worse than baseline: ' + regression
+
+    if regressions:
+      sys.exit(1)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,582 @@
+#!/usr/bin/python
+#
+#  fake_openstack.py - Local stand-in for the OpenStack APIs used by Vcycle
+#
+#  Serves the Keystone v2 and v3 token, Nova servers, flavors, limits and
+#  keypairs, Glance v1 and v2 images, and Cinder volumes calls made by
+#  vcycle.openstack.openstack_api and image_api from an in-memory project,
+#  so the benchmarks and end-to-end tests can run Vcycle's own code against
+#  a cloud of any size without a network.
+#
+#  Servers move from BUILD to ACTIVE, and optionally to SHUTOFF, as time
+#  passes, and deletions can take time. Latency, 5xx responses, quota errors
+#  and pagination of server and image lists can be injected.
+#
+#  Usage: python benchmarks/fake_openstack.py [options] PORT [NUMBER_SERVERS]
+#
+#   --host HOST            Address to listen on (default 127.0.0.1)
+#   --seed N               Seed for the servers made at startup and faults
+#   --build-seconds S      BUILD servers become ACTIVE after S seconds
+#   --run-seconds S        ACTIVE servers become SHUTOFF after S seconds
+#   --delete-seconds S     Deleted servers stay in task_state deleting for S
+#   --volume-seconds S     New volumes are creating for S seconds
+#   --cores-limit N        Quota of cores, creations beyond it get HTTP 403
+#   --latency S            Seconds to wait before each response
+#   --jitter S             Up to S more seconds to wait, at random
+#   --error-rate F         Fraction of requests that get HTTP 500, 502 or 503
+#   --page-size N          Most servers or images returned per page
+#
+#  It prints a [space ...] section for vcycle.conf with url pointing at it.
+#
+
+import re
+import sys
+import json
+import time
+import heapq
+import getopt
+import random
+import urllib
+import hashlib
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+flavors = [ { 'id' : '1', 'name' : 'm1.small', 'vcpus' : 1, 'ram' : 2048  },
+            { 'id' : '2', 'name' : 'm1.large', 'vcpus' : 8, 'ram' : 16384 } ]
+
+imageName        = 'benchmark'
+machinetypeNames = [ 'alpha', 'beta', 'gamma' ]
+
+# Out of every 10 servers, how many are in each (status, power_state)
+serverMix = [ ('ACTIVE', 1) ] * 7 + [ ('BUILD', 0), ('SHUTOFF', 4), ('ERROR', 0) ]
+
+def isoTime(t):
+  return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))
+
+class FakeCloud:
+  """ The servers, images, keypairs and volumes of one project. With the
+      same numberServers, seed and timeNow the same servers are made, in
+      the same order. Timed state changes are kept in a heap of events,
+      which are applied when the next request arrives """
+
+  def __init__(self, numberServers, seed = 1, timeNow = None, headroomServers = 64,
+               buildSeconds = None, runSeconds = None, deleteSeconds = 0, volumeSeconds = 0,
+               coresLimit = None, latency = 0.0, jitter = 0.0, errorRate = 0.0, pageSize = None):
+    self.lock          = threading.Lock()
+    self.random        = random.Random(seed)
+    self.faultRandom   = random.Random(seed)
+    self.timeNow       = int(timeNow or time.time())
+    self.token         = 'fake-token-%d' % seed
+    self.servers       = {}
+    self.images        = {}
+    self.keypairs      = {}
+    self.volumes       = {}
+    self.events        = []
+    self.nextIndex     = 0
+    self.usedCores     = 0
+
+    self.buildSeconds  = buildSeconds
+    self.runSeconds    = runSeconds
+    self.deleteSeconds = deleteSeconds
+    self.volumeSeconds = volumeSeconds
+    self.latency       = latency
+    self.jitter        = jitter
+    self.errorRate     = errorRate
+    self.pageSize      = pageSize
+
+    for i in xrange(numberServers):
+      (status, powerState) = serverMix[i % len(serverMix)]
+      self.addServer(machinetypeNames[i % len(machinetypeNames)], status, powerState,
+                     self.timeNow - self.random.randint(3600, 86400))
+
+    # Enough cores for makeMachines() to create headroomServers more
+    if coresLimit is None:
+      self.coresLimit = (numberServers + headroomServers) * flavors[1]['vcpus']
+    else:
+      self.coresLimit = coresLimit
+
+    self.addImage(imageName, [], '00000000-0000-4000-8000-000000000001')
+
+  def addEvent(self, delaySeconds, action, itemID):
+    heapq.heappush(self.events, (time.time() + delaySeconds, self.nextIndex, action, itemID))
+    self.nextIndex += 1
+
+  def applyEvents(self):
+    # Make the state changes which are now due
+
+    timeNow = time.time()
+
+    while self.events and self.events[0][0] <= timeNow:
+      (dueTime, index, action, itemID) = heapq.heappop(self.events)
+      server = self.servers.get(itemID)
+
+      if action == 'active' and server and server['status'] == 'BUILD':
+        server.update({ 'status'                 : 'ACTIVE',
+                        'OS-EXT-STS:power_state' : 1,
+                        'OS-SRV-USG:launched_at' : isoTime(dueTime).rstrip('Z') + '.000000',
+                        'updated'                : isoTime(dueTime) })
+
+        if self.runSeconds is not None:
+          self.addEvent(self.runSeconds, 'shutoff', itemID)
+
+      elif action == 'shutoff' and server and server['status'] == 'ACTIVE':
+        server.update({ 'status' : 'SHUTOFF', 'OS-EXT-STS:power_state' : 4, 'updated' : isoTime(dueTime) })
+
+      elif action == 'deleted' and server:
+        self.removeServer(itemID)
+
+      elif action == 'available' and itemID in self.volumes:
+        self.volumes[itemID]['status'] = 'available'
+
+  def addServer(self, machinetypeName, status, powerState, createdTime, machineName = None, flavor = flavors[1]):
+    i       = self.nextIndex
+    uuidStr = '%08x-0000-4000-8000-%012x' % (i, self.random.getrandbits(48))
+    self.nextIndex += 1
+
+    if not machineName:
+      machineName = 'vcycle-%s-%010d' % (machinetypeName, i)
+
+    server = { 'id'                     : uuidStr,
+               'name'                   : machineName,
+               'status'                 : status,
+               'OS-EXT-STS:power_state' : powerState,
+               'OS-EXT-STS:task_state'  : None,
+               'OS-EXT-AZ:availability_zone' : 'nova',
+               'created'                : isoTime(createdTime),
+               'updated'                : isoTime(createdTime + 60),
+               'flavor'                 : { 'id' : flavor['id'] },
+               'addresses'              : { 'private' : [ { 'addr' : '10.%d.%d.%d' % ((i >> 16) & 255, (i >> 8) & 255, i & 255) } ] },
+               'metadata'               : { 'name' : machineName, 'machinetype' : machinetypeName } }
+
+    if status != 'BUILD':
+      server['OS-SRV-USG:launched_at'] = isoTime(createdTime + 60).rstrip('Z') + '.000000'
+
+    self.servers[uuidStr] = server
+    self.usedCores       += flavor['vcpus']
+
+    if status == 'BUILD' and self.buildSeconds is not None:
+      self.addEvent(self.buildSeconds, 'active', uuidStr)
+    elif status == 'ACTIVE' and self.runSeconds is not None:
+      # Spread out the ends of the servers which are already running
+      self.addEvent(self.random.uniform(0, self.runSeconds), 'shutoff', uuidStr)
+
+    return server
+
+  def removeServer(self, uuidStr):
+    server = self.servers.pop(uuidStr)
+
+    for flavor in flavors:
+      if flavor['id'] == server['flavor']['id']:
+        self.usedCores -= flavor['vcpus']
+
+  def addImage(self, name, tags, imageID = None):
+    imageID = imageID or '%08x-0000-4000-9000-%012x' % (self.nextIndex, self.random.getrandbits(48))
+    self.nextIndex += 1
+
+    self.images[imageID] = { 'id' : imageID, 'name' : name, 'status' : 'active', 'tags' : tags,
+                             'disk_format' : 'raw', 'container_format' : 'bare', 'visibility' : 'private' }
+    return self.images[imageID]
+
+class FakeOpenstackHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  # httpRequest() only recognises HTTP/1.1 status lines. Each header line
+  # is a separate write, which would wait for delayed ACKs with Nagle
+  protocol_version        = 'HTTP/1.1'
+  disable_nagle_algorithm = True
+
+  # (method, path, handler, whether X-Auth-Token is needed)
+  routes = [ ('POST',   '/v2.0/tokens$',                    'authTokensV2',  False),
+             ('POST',   '/v3/auth/tokens$',                 'authTokensV3',  False),
+             ('GET',    '/compute/v2.1/flavors(/detail)?$', 'flavorsDetail', True),
+             ('GET',    '/compute/v2.1/limits$',            'limits',        True),
+             ('GET',    '/compute/v2.1/servers(/detail)?$', 'serversDetail', True),
+             ('GET',    '/compute/v2.1/servers/([^/]+)$',   'showServer',    True),
+             ('POST',   '/compute/v2.1/servers$',           'createServer',  True),
+             ('DELETE', '/compute/v2.1/servers/([^/]+)$',   'deleteServer',  True),
+             ('GET',    '/compute/v2.1/os-keypairs$',       'listKeypairs',  True),
+             ('POST',   '/compute/v2.1/os-keypairs$',       'createKeypair', True),
+             ('GET',    '/image/v1/images(/detail)?$',      'imagesV1',      True),
+             ('POST',   '/image/v1/images$',                'uploadImageV1', True),
+             ('GET',    '/image/v2/images$',                'imagesV2',      True),
+             ('POST',   '/image/v2/images$',                'createImageV2', True),
+             ('PUT',    '/image/v2/images/([^/]+)/file$',   'uploadImageV2', True),
+             ('GET',    '/volume/v3/volumes(/detail)?$',    'listVolumes',   True),
+             ('POST',   '/volume/v3/volumes$',              'createVolume',  True),
+             ('GET',    '/volume/v3/volumes/([^/]+)$',      'showVolume',    True),
+             ('DELETE', '/volume/v3/volumes/([^/]+)$',      'deleteVolume',  True) ]
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    self.dispatch('GET')
+
+  def do_POST(self):
+    self.dispatch('POST')
+
+  def do_PUT(self):
+    self.dispatch('PUT')
+
+  def do_DELETE(self):
+    self.dispatch('DELETE')
+
+  def readBody(self):
+    # Glance uploads from pycurl are chunked and may expect 100 Continue
+
+    if self.headers.get('Expect', '').lower() == '100-continue':
+      self.wfile.write('HTTP/1.1 100 Continue\r\n\r\n')
+
+    if self.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+      return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    chunks = []
+
+    while True:
+      chunkSize = int(self.rfile.readline().split(';')[0], 16)
+
+      if chunkSize == 0:
+        while self.rfile.readline().strip():
+          pass
+        return ''.join(chunks)
+
+      chunks.append(self.rfile.read(chunkSize))
+      self.rfile.readline()
+
+  def dispatch(self, method):
+    self.cloud = self.server.cloud
+    self.body  = self.readBody()
+
+    # Glance image creation sends JSON without a JSON Content-Type
+    try:
+      self.jsonRequest = json.loads(self.body) if self.body else None
+    except ValueError:
+      self.jsonRequest = None
+
+    (path, query) = (self.path.split('?', 1) + [ '' ])[:2]
+    self.query    = dict([ (name, values[0]) for (name, values) in urlparse.parse_qs(query).items() ])
+
+    if self.cloud.latency or self.cloud.jitter:
+      time.sleep(self.cloud.latency + self.cloud.faultRandom.uniform(0, self.cloud.jitter))
+
+    with self.cloud.lock:
+      if self.cloud.errorRate and self.cloud.faultRandom.random() < self.cloud.errorRate:
+        status = self.cloud.faultRandom.choice([ 500, 502, 503 ])
+        self.sendJSON(status, { 'computeFault' : { 'code' : status, 'message' : 'Injected fault' } })
+        return
+
+      for (routeMethod, pattern, handlerName, needsToken) in self.routes:
+        match = re.match(pattern, path)
+
+        if match and routeMethod == method:
+          if needsToken and self.headers.get('X-Auth-Token') != self.cloud.token:
+            self.sendJSON(401, { 'error' : { 'code' : 401, 'message' : 'The request you have made requires authentication.' } })
+            return
+
+          self.cloud.applyEvents()
+
+          # Optional groups such as (/detail)? are not arguments
+          getattr(self, handlerName)(*[ group for group in match.groups() if group and not group.startswith('/') ])
+          return
+
+    self.sendJSON(404, { 'itemNotFound' : { 'code' : 404, 'message' : method + ' ' + path + ' not found' } })
+
+  def sendJSON(self, status, response, headers = None):
+    body = json.dumps(response) if response is not None else ''
+
+    self.send_response(status)
+
+    if response is not None:
+      self.send_header('Content-Type', 'application/json')
+
+    for (name, value) in (headers or []):
+      self.send_header(name, value)
+
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def sendNotFound(self, what):
+    self.sendJSON(404, { 'itemNotFound' : { 'code' : 404, 'message' : what + ' could not be found.' } })
+
+  def sendBadRequest(self, message):
+    self.sendJSON(400, { 'badRequest' : { 'code' : 400, 'message' : message } })
+
+  def baseURL(self):
+    # Use the host name the client used, so the catalog works from elsewhere
+    return 'http://%s:%d' % (self.headers.get('Host', self.server.server_address[0]).split(':')[0],
+                             self.server.server_address[1])
+
+  def page(self, items):
+    """ Return one page of items, sorted by ID, after the marker given in
+        the query, and the query for the next page if there are more """
+
+    items  = sorted(items, key = lambda item: item['id'])
+    limits = [ int(limit) for limit in [ self.query.get('limit'), self.cloud.pageSize ] if limit ]
+
+    if 'marker' in self.query:
+      items = [ item for item in items if item['id'] > self.query['marker'] ]
+
+    if not limits or len(items) <= min(limits):
+      return (items, None)
+
+    items = items[:min(limits)]
+
+    # Like the real services, the link keeps the filters of this request
+    nextQuery = dict(self.query)
+    nextQuery.update({ 'limit' : str(min(limits)), 'marker' : items[-1]['id'] })
+
+    return (items, '?' + urllib.urlencode(sorted(nextQuery.items())))
+
+  def catalog(self):
+    return [ ('compute',  self.baseURL() + '/compute/v2.1'),
+             ('image',    self.baseURL() + '/image'),
+             ('volumev3', self.baseURL() + '/volume/v3') ]
+
+  def authTokensV2(self):
+    try:
+      self.jsonRequest['auth']['passwordCredentials']['username']
+    except (TypeError, KeyError):
+      self.sendBadRequest('Expecting auth.passwordCredentials')
+      return
+
+    self.sendJSON(200, { 'access' : { 'token'          : { 'id' : self.cloud.token },
+                                      'serviceCatalog' : [ { 'type'      : serviceType,
+                                                             'endpoints' : [ { 'region' : 'RegionOne', 'publicURL' : url } ] }
+                                                           for (serviceType, url) in self.catalog() ] } })
+
+  def authTokensV3(self):
+    try:
+      self.jsonRequest['auth']['identity']['methods']
+    except (TypeError, KeyError):
+      self.sendBadRequest('Expecting auth.identity.methods')
+      return
+
+    self.sendJSON(201, { 'token' : { 'catalog' : [ { 'type'      : serviceType,
+                                                     'endpoints' : [ { 'interface' : 'public', 'region' : 'RegionOne', 'url' : url } ] }
+                                                   for (serviceType, url) in self.catalog() ] } },
+                  [ ('X-Subject-Token', self.cloud.token) ])
+
+  def flavorsDetail(self):
+    self.sendJSON(200, { 'flavors' : flavors })
+
+  def limits(self):
+    self.sendJSON(200, { 'limits' : { 'absolute' : { 'maxTotalCores'      : self.cloud.coresLimit,
+                                                     'totalCoresUsed'     : self.cloud.usedCores,
+                                                     'totalInstancesUsed' : len(self.cloud.servers) } } })
+
+  def serversDetail(self):
+    servers = self.cloud.servers.values()
+
+    # Like Nova, name is a regular expression matched anywhere in the name
+    if 'name' in self.query:
+      servers = [ server for server in servers if re.search(self.query['name'], server['name']) ]
+
+    (servers, nextQuery) = self.page(servers)
+    response             = { 'servers' : servers }
+
+    if nextQuery:
+      response['servers_links'] = [ { 'rel' : 'next', 'href' : self.baseURL() + self.path.split('?')[0] + nextQuery } ]
+
+    self.sendJSON(200, response)
+
+  def showServer(self, uuidStr):
+    if uuidStr in self.cloud.servers:
+      self.sendJSON(200, { 'server' : self.cloud.servers[uuidStr] })
+    else:
+      self.sendNotFound('Instance ' + uuidStr)
+
+  def createServer(self):
+    try:
+      request         = self.jsonRequest['server']
+      machinetypeName = request['metadata']['machinetype']
+      flavor          = [ flavor for flavor in flavors if flavor['id'] == request['flavorRef'] ][0]
+    except (TypeError, KeyError, IndexError):
+      self.sendBadRequest('Invalid server request')
+      return
+
+    if request.get('imageRef') not in self.cloud.images and 'block_device_mapping_v2' not in request:
+      self.sendBadRequest('Image ' + str(request.get('imageRef')) + ' could not be found.')
+      return
+
+    if self.cloud.usedCores + flavor['vcpus'] > self.cloud.coresLimit:
+      self.sendJSON(403, { 'forbidden' : { 'code' : 403, 'message' : 'Quota exceeded for cores: Requested %d, but already used %d of %d cores'
+                                                                      % (flavor['vcpus'], self.cloud.usedCores, self.cloud.coresLimit) } })
+      return
+
+    server = self.cloud.addServer(machinetypeName, 'BUILD', 0, int(time.time()), request.get('name'), flavor)
+    self.sendJSON(202, { 'server' : { 'id' : server['id'] } })
+
+  def deleteServer(self, uuidStr):
+    if uuidStr not in self.cloud.servers:
+      self.sendNotFound('Instance ' + uuidStr)
+      return
+
+    if self.cloud.deleteSeconds:
+      if self.cloud.servers[uuidStr]['OS-EXT-STS:task_state'] != 'deleting':
+        self.cloud.servers[uuidStr]['OS-EXT-STS:task_state'] = 'deleting'
+        self.cloud.addEvent(self.cloud.deleteSeconds, 'deleted', uuidStr)
+    else:
+      self.cloud.removeServer(uuidStr)
+
+    self.sendJSON(204, None)
+
+  def listKeypairs(self):
+    self.sendJSON(200, { 'keypairs' : [ { 'keypair' : keypair } for keypair in self.cloud.keypairs.values() ] })
+
+  def createKeypair(self):
+    try:
+      name      = self.jsonRequest['keypair']['name']
+      publicKey = self.jsonRequest['keypair']['public_key']
+    except (TypeError, KeyError):
+      self.sendBadRequest('Invalid keypair request')
+      return
+
+    if name in self.cloud.keypairs:
+      self.sendJSON(409, { 'conflictingRequest' : { 'code' : 409, 'message' : 'Key pair ' + name + ' already exists.' } })
+      return
+
+    self.cloud.keypairs[name] = { 'name' : name, 'public_key' : publicKey, 'fingerprint' : hashlib.md5(publicKey).hexdigest() }
+    self.sendJSON(200, { 'keypair' : self.cloud.keypairs[name] })
+
+  def imagesV1(self):
+    # In the form GlanceV1.getImageDetails() reads. uploadImageV1() keeps
+    # the last_modified property as a tag, as Glance v2 clients do
+    images = []
+
+    for image in self.cloud.images.values():
+      lastModified = [ tag.split(': ', 1)[1] for tag in image['tags'] if tag.startswith('last_modified: ') ]
+      images.append({ 'id'       : image['id'],
+                      'name'     : image['name'],
+                      'status'   : image['status'].upper(),
+                      'metadata' : { 'last_modified' : lastModified[0] } if lastModified else {} })
+
+    self.sendJSON(200, { 'images' : images })
+
+  def uploadImageV1(self):
+    image = self.cloud.addImage(self.headers.get('x-image-meta-name', ''),
+                                [ 'last_modified: ' + self.headers.get('x-image-meta-property-last-modified', '') ])
+    image['size'] = len(self.body)
+
+    self.sendJSON(201, { 'image' : { 'id' : image['id'], 'name' : image['name'], 'status' : 'active' } })
+
+  def imagesV2(self):
+    (images, nextQuery) = self.page(self.cloud.images.values())
+    response            = { 'images' : images }
+
+    if nextQuery:
+      response['next'] = '/v2/images' + nextQuery
+
+    self.sendJSON(200, response)
+
+  def createImageV2(self):
+    try:
+      name = self.jsonRequest['name']
+    except (TypeError, KeyError):
+      self.sendBadRequest('Invalid image request')
+      return
+
+    image = self.cloud.addImage(name, self.jsonRequest.get('tags', []))
+    image['status'] = 'queued'
+
+    self.sendJSON(201, image)
+
+  def uploadImageV2(self, imageID):
+    if imageID not in self.cloud.images:
+      self.sendNotFound('Image ' + imageID)
+      return
+
+    self.cloud.images[imageID]['status'] = 'active'
+    self.cloud.images[imageID]['size']   = len(self.body)
+    self.sendJSON(204, None)
+
+  def listVolumes(self):
+    self.sendJSON(200, { 'volumes' : self.cloud.volumes.values() })
+
+  def createVolume(self):
+    try:
+      request = self.jsonRequest['volume']
+      size    = int(request['size'])
+    except (TypeError, KeyError, ValueError):
+      self.sendBadRequest('Invalid volume request')
+      return
+
+    uuidStr = '%08x-0000-4000-a000-%012x' % (self.cloud.nextIndex, self.cloud.random.getrandbits(48))
+    self.cloud.nextIndex += 1
+
+    self.cloud.volumes[uuidStr] = { 'id'                : uuidStr,
+                                    'name'              : request.get('name'),
+                                    'size'              : size,
+                                    'status'            : 'creating' if self.cloud.volumeSeconds else 'available',
+                                    'availability_zone' : request.get('availability_zone', 'nova') }
+
+    if self.cloud.volumeSeconds:
+      self.cloud.addEvent(self.cloud.volumeSeconds, 'available', uuidStr)
+
+    self.sendJSON(202, { 'volume' : self.cloud.volumes[uuidStr] })
+
+  def showVolume(self, uuidStr):
+    if uuidStr in self.cloud.volumes:
+      self.sendJSON(200, { 'volume' : self.cloud.volumes[uuidStr] })
+    else:
+      self.sendNotFound('Volume ' + uuidStr)
+
+  def deleteVolume(self, uuidStr):
+    if self.cloud.volumes.pop(uuidStr, None) is None:
+      self.sendNotFound('Volume ' + uuidStr)
+    else:
+      self.sendJSON(202, None)
+
+class FakeOpenstackServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  # Vcycle keeps one connection open for Nova and another for Glance
+  daemon_threads      = True
+  allow_reuse_address = True
+
+  def __init__(self, port, cloud, host = '127.0.0.1'):
+    BaseHTTPServer.HTTPServer.__init__(self, (host, port), FakeOpenstackHandler)
+    self.cloud = cloud
+
+def serve(port, cloud, host = '127.0.0.1'):
+  FakeOpenstackServer(port, cloud, host).serve_forever()
+
+def main(argv):
+  (opts, args) = getopt.getopt(argv, '', [ 'host=', 'seed=', 'build-seconds=', 'run-seconds=', 'delete-seconds=',
+                                           'volume-seconds=', 'cores-limit=', 'latency=', 'jitter=', 'error-rate=',
+                                           'page-size=' ])
+  opts = dict(opts)
+
+  if len(args) not in (1, 2):
+    sys.exit('Usage: fake_openstack.py [options] PORT [NUMBER_SERVERS]')
+
+  def option(name, convert, default = None):
+    return convert(opts[name]) if name in opts else default
+
+  cloud = FakeCloud(int(args[1]) if len(args) > 1 else 0,
+                    seed          = option('--seed',           int,   1),
+                    buildSeconds  = option('--build-seconds',  float),
+                    runSeconds    = option('--run-seconds',    float),
+                    deleteSeconds = option('--delete-seconds', float, 0),
+                    volumeSeconds = option('--volume-seconds', float, 0),
+                    coresLimit    = option('--cores-limit',    int),
+                    latency       = option('--latency',        float, 0.0),
+                    jitter        = option('--jitter',         float, 0.0),
+                    errorRate     = option('--error-rate',     float, 0.0),
+                    pageSize      = option('--page-size',      int))
+
+  host = opts.get('--host', '127.0.0.1')
+
+  print '[space fake.example]'
+  print 'api             = openstack'
+  print 'url             = http://%s:%d/v3' % (host, int(args[0]))
+  print 'api_version     = 3'
+  print 'glance_api      = 2'
+  print 'project_name    = fake'
+  print 'username        = fake'
+  print 'password_base64 = ZmFrZQ=='
+  sys.stdout.flush()
+
+  serve(int(args[0]), cloud, host)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
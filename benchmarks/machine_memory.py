@@ -0,0 +1,116 @@
+#!/usr/bin/python
+#
+#  machine_memory.py - Memory used by Machine objects for large fleets
+#
+#  Builds N vcycle.shared.Machine objects for a synthetic space without
+#  touching the disk or the network, as scanMachines() does each cycle,
+#  and reports the resident memory and garbage collection time they add,
+#  and the time accountMachines() takes to add them up.
+#
+#  Usage: python benchmarks/machine_memory.py [N ...]   (default 10000 50000)
+#
+
+import os
+import gc
+import sys
+import imp
+import time
+import ConfigParser
+
+# The root of the repository is the vcycle package, so load it from this
+# checkout rather than using any installed copy of Vcycle
+imp.load_package('vcycle', os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vcycle.shared
+import vcycle.vacutils
+
+spaceName = 'bench.example'
+
+def rssBytes():
+  return int(open('/proc/self/statm').read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+class BenchmarkSpace(vcycle.shared.BaseSpace):
+  # Machine files all appear missing, as for newly seen machines
+
+  def getFileContents(self, machineName, fileName):
+    return None
+
+  def setFileContents(self, machineName, fileName, contents, mode = None):
+    pass
+
+def makeSpace():
+  parser = ConfigParser.RawConfigParser()
+
+  parser.add_section('space ' + spaceName)
+
+  for machinetypeName in ('alpha', 'beta', 'gamma'):
+    sectionName = 'machinetype ' + spaceName + ' ' + machinetypeName
+    parser.add_section(sectionName)
+    parser.set(sectionName, 'root_image', 'image:benchmark')
+    parser.set(sectionName, 'flavor_names', 'm1.large')
+    parser.set(sectionName, 'backoff_seconds', '600')
+    parser.set(sectionName, 'fizzle_seconds', '600')
+    parser.set(sectionName, 'max_wallclock_seconds', '172800')
+    parser.set(sectionName, 'target_share', '1')
+    parser.set(sectionName, 'user_data', 'user_data')
+
+  vcycle.shared.spaces = { spaceName : BenchmarkSpace('benchmark', None, spaceName, parser, 'space ' + spaceName, False) }
+  return vcycle.shared.spaces[spaceName]
+
+def makeMachines(space, numberMachines):
+  machines     = {}
+  timeNow      = int(time.time())
+  states       = [ vcycle.shared.MachineState.running ] * 8 + [ vcycle.shared.MachineState.starting,
+                                                                vcycle.shared.MachineState.shutdown ]
+  machinetypes = sorted(space.machinetypes)
+
+  for i in xrange(numberMachines):
+    machineName = 'vcycle-%s-%010d' % (machinetypes[i % 3], i)
+
+    # As the API plugins make them, from strings in each server's JSON
+    machines[machineName] = vcycle.shared.Machine(name            = machineName,
+                                                  spaceName       = ''.join(spaceName),
+                                                  state           = ''.join(states[i % 10]),
+                                                  ip              = '10.%d.%d.%d' % (i >> 16, (i >> 8) & 255, i & 255),
+                                                  createdTime     = timeNow - 7200,
+                                                  startedTime     = timeNow - 3600,
+                                                  updatedTime     = timeNow - 3600,
+                                                  uuidStr         = '%08x-0000-4000-8000-%012x' % (i, i),
+                                                  machinetypeName = ''.join(machinetypes[i % 3]),
+                                                  zone            = 'nova',
+                                                  processors      = 8)
+  return machines
+
+def main(sizes):
+  # Per-machine log lines are not what we are measuring
+  vcycle.vacutils.logStream = open(os.devnull, 'w')
+
+  space = makeSpace()
+
+  print '%10s %12s %14s %12s %10s %12s' % ('machines', 'build s', 'bytes/machine', 'RSS MiB', 'gc ms', 'account ms')
+
+  for numberMachines in sizes:
+    gc.collect()
+    startRSS  = rssBytes()
+    startTime = time.time()
+
+    space.machines = makeMachines(space, numberMachines)
+
+    buildSeconds = time.time() - startTime
+    usedBytes    = rssBytes() - startRSS
+
+    startTime = time.time()
+    gc.collect()
+    gcSeconds = time.time() - startTime
+
+    startTime = time.time()
+    vcycle.shared.accountMachines(space.machines, space.machinetypes)
+    accountSeconds = time.time() - startTime
+
+    print '%10d %12.2f %14d %12.1f %10.1f %12.1f' % (numberMachines, buildSeconds, usedBytes / numberMachines,
+                                                      usedBytes / 1048576.0, gcSeconds * 1000.0, accountSeconds * 1000.0)
+
+    space.machines = {}
+
+if __name__ == '__main__':
+  main([ int(arg) for arg in sys.argv[1:] ] or [ 10000, 50000 ])
@@ -57,6 +57,7 @@ import M2Crypto
 import hashlib
 
 import vcycle.vacutils
+import vcycle.imagecache
 
 def _emptyCallback1(p1, p2):
   return
@@ -305,12 +306,10 @@ class GoogleSpace(vcycle.BaseSpace):
        self.machinetypes[machinetypeName].root_image.startswith('https://'):
 
       try:
-          imageFile = vcycle.vacutils.getRemoteRootImage(self.machinetypes[machinetypeName].root_image,
-                                         '/var/lib/vcycle/imagecache',
-                                         '/var/lib/vcycle/tmp',
-                                         'Vcycle ' + vcycle.shared.vcycleVersion)
-
-          imageLastModified = int(os.stat(imageFile).st_mtime)
+          (imageFile, imageLastModified) = vcycle.imagecache.getImage(self.machinetypes[machinetypeName].root_image,
+                                         'Vcycle ' + vcycle.shared.vcycleVersion,
+                                         vcycle.shared.imageCacheBytes,
+                                         vcycle.shared.prefetchStaleSeconds if self.prefetch_images else 0)
           imageURL = self.machinetypes[machinetypeName].root_image
 
       except Exception as e:
@@ -342,14 +341,14 @@ class GoogleSpace(vcycle.BaseSpace):
     imageFamily = base64.b32encode(hashlib.sha256(imageURL).digest()).lower().replace('=','0')
 
     if self.machinetypes[machinetypeName].cernvm_signing_dn:
-      cernvmDict = vac.vacutils.getCernvmImageData(imageFile)
+      cernvmDict = vcycle.vacutils.getCernvmImageData(imageFile, '/var/lib/vcycle/imagecache/cernvm')
 
       if cernvmDict['verified'] == False:
         raise GoogleError('Failed to verify signature/cert for ' + self.machinetypes[machinetypeName].root_image)
       elif re.search(self.machinetypes[machinetypeName].cernvm_signing_dn,  cernvmDict['dn']) is None:
         raise GoogleError('Signing DN ' + cernvmDict['dn'] + ' does not match cernvm_signing_dn = ' + self.machinetypes[machinetypeName].cernvm_signing_dn)
       else:
-        vac.vacutils.logLine('Verified image signed by ' + cernvmDict['dn'])
+        vcycle.vacutils.logLine('Verified image signed by ' + cernvmDict['dn'])
 
     # Try to upload the image
     try:
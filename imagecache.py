@@ -0,0 +1,666 @@
+#!/usr/bin/python
+#
+#  imagecache.py - content-addressed cache of remote root_image files
+#
+#  Andrew McNab, University of Manchester.
+#  Copyright (c) 2013-9. All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or
+#  without modification, are permitted provided that the following
+#  conditions are met:
+#
+#    o Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#    o Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+#  CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+#  MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+#  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#  EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+#  TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+#  DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+#  ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+#  OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+#  POSSIBILITY OF SUCH DAMAGE.
+#
+#  Contacts: Andrew.McNab@cern.ch  http://www.gridpp.ac.uk/vcycle/
+#
+
+import os
+import json
+import stat
+import time
+import fcntl
+import base64
+import shutil
+import urllib
+import hashlib
+import tempfile
+
+import pycurl
+
+import vcycle.vacutils
+
+# Images are stored once in sha256/HASH, whatever URLs they came from, and
+# aliases/URLENCODED.json records which image each URL currently points to.
+# Downloads in progress are kept in partial/URLENCODED so they can be resumed.
+cacheDir   = '/var/lib/vcycle/imagecache'
+objectsDir = cacheDir + '/sha256'
+aliasesDir = cacheDir + '/aliases'
+partialDir = cacheDir + '/partial'
+
+rangeSegments    = 4			# Maximum parallel Range requests per download
+minSegmentBytes  = 64 * 1024 * 1024	# Files must be twice this size to be split
+connectSeconds   = 30
+lowSpeedBytes    = 1024			# Downloads only fail if slower than this
+lowSpeedSeconds  = 120			# for this many seconds
+recentlyUsedSeconds = 3600		# Images used this recently are not evicted
+readChunkBytes   = 1024 * 1024
+
+class ImageCacheError(Exception):
+  pass
+
+def aliasPath(url, pending = False):
+  # A pending alias is a prefetched version which is not in use yet
+  return aliasesDir + '/' + urllib.quote(url, '') + ('.pending.json' if pending else '.json')
+
+def objectPath(sha256):
+  return objectsDir + '/' + sha256
+
+def loadAlias(url, pending = False):
+  """ Return the alias dictionary for url if it points to an image of the
+      right size in the cache, or None """
+
+  try:
+    aliasDict = json.load(open(aliasPath(url, pending), 'r'))
+    if os.stat(objectPath(aliasDict['sha256'])).st_size != aliasDict['size']:
+      return None
+  except:
+    return None
+
+  return aliasDict
+
+def saveAlias(url, aliasDict, pending = False):
+  # The mtime of the alias file records when the image was last used
+
+  try:
+    fd, tempName = tempfile.mkstemp(prefix = '.alias-', dir = aliasesDir)
+    os.write(fd, json.dumps(aliasDict))
+    os.close(fd)
+    os.chmod(tempName, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+    os.rename(tempName, aliasPath(url, pending))
+  except Exception as e:
+    raise ImageCacheError('Failed to save alias for ' + url + ' (' + str(e) + ')')
+
+def isCurrent(aliasDict, remoteDict):
+  """ True if aliasDict is for the version of the image described by remoteDict """
+
+  return aliasDict is not None and \
+         aliasDict['last_modified'] == remoteDict['last_modified'] and \
+         (remoteDict['size'] is None or aliasDict['size'] == remoteDict['size']) and \
+         (not remoteDict['etag'] or not aliasDict['etag'] or aliasDict['etag'] == remoteDict['etag'])
+
+def newCurl(url, versionString):
+
+  c = pycurl.Curl()
+  c.setopt(c.USERAGENT, versionString)
+  c.setopt(c.URL, url)
+
+  # Large images over slow links may take a long time, so rather than an
+  # overall timeout we only give up on transfers that have stalled
+  c.setopt(c.CONNECTTIMEOUT,  connectSeconds)
+  c.setopt(c.LOW_SPEED_LIMIT, lowSpeedBytes)
+  c.setopt(c.LOW_SPEED_TIME,  lowSpeedSeconds)
+
+  c.setopt(c.FOLLOWLOCATION, 1)
+  c.setopt(c.OPT_FILETIME,   1)
+  c.setopt(c.SSL_VERIFYPEER, 1)
+  c.setopt(c.SSL_VERIFYHOST, 2)
+
+  if os.path.isdir('/etc/grid-security/certificates'):
+    c.setopt(c.CAPATH, '/etc/grid-security/certificates')
+
+  return c
+
+def digestSha256(digestHeader):
+  """ Return the hex SHA-256 given in an RFC 3230 Digest: header, or None """
+
+  if not digestHeader:
+    return None
+
+  for digest in digestHeader.split(','):
+    try:
+      (algorithm, value) = digest.strip().split('=', 1)
+      if algorithm.lower() == 'sha-256':
+        return base64.b64decode(value).encode('hex')
+    except:
+      pass
+
+  return None
+
+def checkRemoteImage(url, versionString):
+  """ Use a HEAD request to get the size, validators, and Range support of url """
+
+  headers = {}
+
+  def headerLine(line):
+    line = line.strip()
+    if line.startswith('HTTP/'):
+      # A new response after following a redirect
+      headers.clear()
+    elif ':' in line:
+      (name, value) = line.split(':', 1)
+      headers[name.strip().lower()] = value.strip()
+
+  c = newCurl(url, versionString)
+  c.setopt(c.NOBODY, 1)
+  c.setopt(c.HEADERFUNCTION, headerLine)
+
+  try:
+    c.perform()
+    responseCode = c.getinfo(c.RESPONSE_CODE)
+    lastModified = c.getinfo(c.INFO_FILETIME)
+    contentLength = c.getinfo(c.CONTENT_LENGTH_DOWNLOAD)
+  except Exception as e:
+    raise ImageCacheError('Failed to check ' + url + ' (' + str(e) + ')')
+  finally:
+    c.close()
+
+  if responseCode != 200:
+    raise ImageCacheError('Checking ' + url + ' returns HTTP code ' + str(responseCode))
+
+  if lastModified < 0:
+    # We fail rather than use a server that doesn't give Last-Modified:
+    raise ImageCacheError('Failed to get last modified time for ' + url)
+
+  remoteDict = { 'size'          : None,
+                 'last_modified' : int(lastModified),
+                 'etag'          : headers.get('etag'),
+                 'if_range'      : None,
+                 'ranges'        : False,
+                 'sha256'        : digestSha256(headers.get('digest')) }
+
+  if contentLength >= 0:
+    remoteDict['size'] = int(contentLength)
+
+    if 'bytes' in headers.get('accept-ranges', '').lower():
+      # If-Range: makes the server send the whole file rather than a range
+      # of a newer version, which we then detect and start again
+      if remoteDict['etag'] and not remoteDict['etag'].startswith('W/'):
+        remoteDict['if_range'] = remoteDict['etag']
+      else:
+        remoteDict['if_range'] = headers.get('last-modified')
+
+      remoteDict['ranges'] = remoteDict['if_range'] is not None
+
+  return remoteDict
+
+def downloadImage(url, remoteDict, versionString):
+  """ Download url into the cache using parallel Range requests where possible,
+      resuming any partial download of the same version, and return the
+      SHA-256 hash and size of the verified image """
+
+  partDir  = partialDir + '/' + urllib.quote(url, '')
+  infoDict = { 'size'          : remoteDict['size'],
+               'last_modified' : remoteDict['last_modified'],
+               'etag'          : remoteDict['etag'] }
+
+  try:
+    resumable = remoteDict['ranges'] and json.load(open(partDir + '/info.json', 'r')) == infoDict
+  except:
+    resumable = False
+
+  if resumable:
+    vcycle.vacutils.logLine('Resuming partial download of ' + url)
+  else:
+    shutil.rmtree(partDir, True)
+
+    try:
+      os.makedirs(partDir)
+      with open(partDir + '/info.json', 'w') as f:
+        json.dump(infoDict, f)
+    except Exception as e:
+      raise ImageCacheError('Failed to create ' + partDir + ' (' + str(e) + ')')
+
+  size = remoteDict['size']
+
+  if remoteDict['ranges'] and size >= 2 * minSegmentBytes:
+    numSegments = min(rangeSegments, size / minSegmentBytes)
+  else:
+    numSegments = 1
+
+  multi   = pycurl.CurlMulti()
+  handles = []
+
+  for i in range(numSegments):
+    partPath = partDir + '/' + str(i)
+
+    if size is None:
+      start  = 0
+      length = None
+    else:
+      start  = size * i / numSegments
+      length = size * (i + 1) / numSegments - start
+
+    try:
+      alreadyBytes = os.stat(partPath).st_size
+    except:
+      alreadyBytes = 0
+
+    if length is not None and alreadyBytes == length:
+      continue
+
+    if length is None or alreadyBytes > length or not remoteDict['ranges']:
+      alreadyBytes = 0
+
+    ranged = remoteDict['ranges'] and (numSegments > 1 or alreadyBytes > 0)
+
+    f = open(partPath, 'ab' if alreadyBytes else 'wb')
+    c = newCurl(url, versionString)
+    c.setopt(c.WRITEDATA, f)
+
+    if ranged:
+      c.setopt(c.RANGE, '%d-%d' % (start + alreadyBytes, start + length - 1))
+      c.setopt(c.HTTPHEADER, ['If-Range: ' + remoteDict['if_range']])
+
+    multi.add_handle(c)
+    handles.append({ 'curl' : c, 'file' : f, 'path' : partPath,
+                     'already' : alreadyBytes, 'ranged' : ranged })
+
+  vcycle.vacutils.logLine('Fetching ' + url + ' with ' + str(len(handles)) + ' connection(s)')
+
+  numActive = len(handles)
+  while numActive:
+    while True:
+      (ret, numActive) = multi.perform()
+      if ret != pycurl.E_CALL_MULTI_PERFORM:
+        break
+
+    if numActive:
+      multi.select(1.0)
+
+  curlErrors = {}
+  while True:
+    (numQueued, okList, errList) = multi.info_read()
+
+    for (c, errNum, errMessage) in errList:
+      curlErrors[c] = errMessage
+
+    if numQueued == 0:
+      break
+
+  errors  = []
+  restart = False
+
+  for h in handles:
+    responseCode = h['curl'].getinfo(pycurl.RESPONSE_CODE)
+    multi.remove_handle(h['curl'])
+    h['curl'].close()
+    h['file'].close()
+
+    if h['curl'] in curlErrors:
+      # Keep what we received so the next attempt can resume from there
+      errors.append(curlErrors[h['curl']])
+    elif responseCode == 200 and h['ranged']:
+      # The whole file rather than a range means the image has changed
+      restart = True
+    elif responseCode != (206 if h['ranged'] else 200):
+      errors.append('HTTP code ' + str(responseCode))
+
+      # Remove any error page appended to the partial file
+      with open(h['path'], 'r+b') as f:
+        f.truncate(h['already'])
+
+  if restart:
+    shutil.rmtree(partDir, True)
+    raise ImageCacheError(url + ' changed during download')
+
+  if errors:
+    raise ImageCacheError('Failed to fetch ' + url + ' (' + ', '.join(errors) + ')')
+
+  # Join the segments into the first one, hashing them in order as we go
+  imagePath = partDir + '/0'
+  sha256    = hashlib.sha256()
+
+  try:
+    with open(imagePath, 'r+b') as imageFile:
+      for i in range(numSegments):
+        with open(partDir + '/' + str(i), 'rb') as partFile:
+          while True:
+            data = partFile.read(readChunkBytes)
+            if not data:
+              break
+
+            sha256.update(data)
+            if i > 0:
+              imageFile.seek(0, os.SEEK_END)
+              imageFile.write(data)
+
+        if i > 0:
+          os.remove(partDir + '/' + str(i))
+
+      imageFile.seek(0, os.SEEK_END)
+      imageSize = imageFile.tell()
+
+  except Exception as e:
+    shutil.rmtree(partDir, True)
+    raise ImageCacheError('Failed to join segments of ' + url + ' (' + str(e) + ')')
+
+  if size is not None and imageSize != size:
+    shutil.rmtree(partDir, True)
+    raise ImageCacheError('Size of ' + url + ' is ' + str(imageSize) + ' rather than ' + str(size))
+
+  imageHash = sha256.hexdigest()
+
+  if remoteDict['sha256'] and imageHash != remoteDict['sha256'].lower():
+    shutil.rmtree(partDir, True)
+    raise ImageCacheError('SHA-256 of ' + url + ' does not match server Digest')
+
+  try:
+    if os.path.exists(objectPath(imageHash)):
+      # The same image is already cached from another URL or version
+      os.remove(imagePath)
+    else:
+      os.chmod(imagePath, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+      os.rename(imagePath, objectPath(imageHash))
+  except Exception as e:
+    raise ImageCacheError('Failed to store ' + url + ' as ' + objectPath(imageHash) + ' (' + str(e) + ')')
+
+  shutil.rmtree(partDir, True)
+
+  return (imageHash, imageSize)
+
+def migrateLegacyImages():
+  """ Move images left in cacheDir under their quoted URLs by versions before
+      the content-addressed cache into it, so they count against the budget
+      and are evicted like any other. Their mtime is the Last-Modified: time
+      they were fetched with, so they are not fetched again if unchanged """
+
+  for fileName in os.listdir(cacheDir):
+    if not fileName.startswith('http%3A%2F%2F') and not fileName.startswith('https%3A%2F%2F'):
+      continue
+
+    legacyPath = cacheDir + '/' + fileName
+    url        = urllib.unquote(fileName)
+
+    if not os.path.isfile(legacyPath):
+      continue
+
+    # Left for the next time if a cycle or the prefetcher is using this URL
+    lockFile = lockURL(url, blocking = False)
+
+    if lockFile is None:
+      continue
+
+    try:
+      if loadAlias(url):
+        # Already fetched again into the cache
+        os.remove(legacyPath)
+        vcycle.vacutils.logLine('Removed old copy of ' + url + ' from image cache')
+        continue
+
+      legacyStat = os.stat(legacyPath)
+      sha256     = hashlib.sha256()
+
+      with open(legacyPath, 'rb') as legacyFile:
+        while True:
+          data = legacyFile.read(readChunkBytes)
+          if not data:
+            break
+
+          sha256.update(data)
+
+      imageHash = sha256.hexdigest()
+
+      if os.path.exists(objectPath(imageHash)):
+        os.remove(legacyPath)
+      else:
+        os.chmod(legacyPath, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.rename(legacyPath, objectPath(imageHash))
+
+      saveAlias(url, { 'url'           : url,
+                       'sha256'        : imageHash,
+                       'size'          : legacyStat.st_size,
+                       'last_modified' : int(legacyStat.st_mtime),
+                       'etag'          : None,
+                       'checked'       : 0 })
+
+      vcycle.vacutils.logLine('Moved old copy of ' + url + ' to ' + objectPath(imageHash))
+
+    except Exception as e:
+      vcycle.vacutils.logLine('Failed to move old copy of ' + url + ' into image cache (' + str(e) + ')')
+
+    finally:
+      lockFile.close()
+
+def evictImages(budgetBytes, keepHashes = []):
+  """ Remove least recently used images until the cache fits in budgetBytes """
+
+  usedTimes = {}
+  aliasesOf = {}
+
+  for fileName in os.listdir(aliasesDir):
+    if fileName.startswith('.') or not fileName.endswith('.json'):
+      continue
+
+    try:
+      aliasDict = json.load(open(aliasesDir + '/' + fileName, 'r'))
+      usedTime  = os.stat(aliasesDir + '/' + fileName).st_mtime
+    except:
+      continue
+
+    usedTimes[aliasDict['sha256']] = max(usedTimes.get(aliasDict['sha256'], 0), usedTime)
+    aliasesOf.setdefault(aliasDict['sha256'], []).append(aliasesDir + '/' + fileName)
+
+  candidates = []
+  totalBytes = 0
+
+  for fileName in os.listdir(objectsDir):
+    try:
+      objectStat = os.stat(objectsDir + '/' + fileName)
+    except:
+      continue
+
+    totalBytes += objectStat.st_size
+    candidates.append((usedTimes.get(fileName, objectStat.st_mtime), fileName, objectStat.st_size))
+
+  if totalBytes <= budgetBytes:
+    return
+
+  for (usedTime, fileName, fileSize) in sorted(candidates):
+
+    if totalBytes <= budgetBytes:
+      return
+
+    if fileName in keepHashes or usedTime > time.time() - recentlyUsedSeconds:
+      continue
+
+    for aliasFile in aliasesOf.get(fileName, []):
+      try:
+        os.remove(aliasFile)
+      except:
+        pass
+
+    try:
+      os.remove(objectsDir + '/' + fileName)
+    except Exception as e:
+      vcycle.vacutils.logLine('Failed to evict ' + fileName + ' from image cache (' + str(e) + ')')
+    else:
+      vcycle.vacutils.logLine('Evicted ' + fileName + ' (' + str(fileSize) + ' bytes) from image cache')
+      totalBytes -= fileSize
+
+  if totalBytes > budgetBytes:
+    vcycle.vacutils.logLine('Image cache is ' + str(totalBytes) + ' bytes, over budget of ' + str(budgetBytes) +
+                            ' bytes, but remaining images are in use')
+
+def makeCacheDirs():
+
+  for d in [objectsDir, aliasesDir, partialDir]:
+    if not os.path.isdir(d):
+      try:
+        os.makedirs(d)
+      except Exception as e:
+        raise ImageCacheError('Failed to create ' + d + ' (' + str(e) + ')')
+
+def lockURL(url, blocking = True):
+  """ Return an open lock file if we get the lock for url, otherwise None """
+
+  lockFile = open(aliasesDir + '/' + urllib.quote(url, '') + '.lock', 'a')
+
+  try:
+    fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+  except IOError:
+    lockFile.close()
+    return None
+
+  return lockFile
+
+def fetchImage(url, remoteDict, versionString, budgetBytes, keepHashes):
+  """ Return the alias dictionary for the version of url in remoteDict,
+      using a pending prefetched copy if there is one """
+
+  pendingDict = loadAlias(url, pending = True)
+
+  if isCurrent(pendingDict, remoteDict):
+    return pendingDict
+
+  (imageHash, imageSize) = downloadImage(url, remoteDict, versionString)
+  vcycle.vacutils.logLine('New ' + url + ' put in ' + objectPath(imageHash))
+
+  if budgetBytes:
+    try:
+      evictImages(budgetBytes, keepHashes + [imageHash])
+    except Exception as e:
+      vcycle.vacutils.logLine('Image cache eviction fails (' + str(e) + ')')
+
+  return { 'url'           : url,
+           'sha256'        : imageHash,
+           'size'          : imageSize,
+           'last_modified' : remoteDict['last_modified'],
+           'etag'          : remoteDict['etag'],
+           'checked'       : int(time.time()) }
+
+def getImage(url, versionString, budgetBytes = None, maxAgeSeconds = 0):
+  """ Return (imageFile, lastModified) for a verified copy of the image at url
+      in the cache, fetching it first if it is new or has changed. If the
+      cached copy was checked less than maxAgeSeconds ago (by the prefetcher)
+      or another process is fetching the image, the cached copy is used """
+
+  makeCacheDirs()
+
+  # Only does anything the first time after upgrading
+  migrateLegacyImages()
+
+  aliasDict = loadAlias(url)
+
+  if aliasDict and aliasDict.get('checked', 0) > time.time() - maxAgeSeconds:
+    try:
+      os.utime(aliasPath(url), None)
+    except:
+      pass
+
+    vcycle.vacutils.logLine('Using ' + url + ' checked ' + str(int(time.time()) - aliasDict['checked']) + ' seconds ago')
+    return (objectPath(aliasDict['sha256']), aliasDict['last_modified'])
+
+  # Only one process at a time checks or fetches each URL
+  lockFile = lockURL(url, blocking = aliasDict is None)
+
+  if lockFile is None:
+    vcycle.vacutils.logLine(url + ' is being checked by another process - using cached copy')
+    return (objectPath(aliasDict['sha256']), aliasDict['last_modified'])
+
+  try:
+    # Reload in case it was changed while we waited for the lock
+    aliasDict = loadAlias(url)
+
+    vcycle.vacutils.logLine('Checking if an updated ' + url + ' needs to be fetched')
+
+    try:
+      remoteDict = checkRemoteImage(url, versionString)
+    except Exception as e:
+      if aliasDict is None:
+        raise
+
+      vcycle.vacutils.logLine(str(e) + ' - using cached copy')
+      remoteDict = None
+
+    if remoteDict and not isCurrent(aliasDict, remoteDict):
+      aliasDict = fetchImage(url, remoteDict, versionString, budgetBytes, [])
+
+      try:
+        os.remove(aliasPath(url, pending = True))
+      except:
+        pass
+
+    elif remoteDict:
+      vcycle.vacutils.logLine('No new version of ' + url + ' found and existing copy not replaced')
+      aliasDict['checked'] = int(time.time())
+
+    saveAlias(url, aliasDict)
+
+  finally:
+    lockFile.close()
+
+  return (objectPath(aliasDict['sha256']), aliasDict['last_modified'])
+
+def prefetchImage(url, versionString, budgetBytes = None):
+  """ Check url and fetch any new version into the cache without switching
+      to it, returning the pending alias dictionary of the new version or
+      None if the image in use is current. switchImage() then switches to it """
+
+  makeCacheDirs()
+
+  # Only does anything the first time after upgrading
+  migrateLegacyImages()
+
+  lockFile = lockURL(url)
+
+  try:
+    aliasDict  = loadAlias(url)
+    remoteDict = checkRemoteImage(url, versionString)
+
+    if isCurrent(aliasDict, remoteDict):
+      aliasDict['checked'] = int(time.time())
+      saveAlias(url, aliasDict)
+      return None
+
+    if aliasDict:
+      # Cycles keep using the current version until the new one is ready
+      aliasDict['checked'] = int(time.time())
+      saveAlias(url, aliasDict)
+
+    pendingDict = fetchImage(url, remoteDict, versionString, budgetBytes,
+                             [aliasDict['sha256']] if aliasDict else [])
+    saveAlias(url, pendingDict, pending = True)
+
+  finally:
+    lockFile.close()
+
+  return pendingDict
+
+def switchImage(url, pendingDict):
+  """ Atomically make the pending version of url the one used by cycles """
+
+  lockFile = lockURL(url)
+
+  try:
+    pendingDict['checked'] = int(time.time())
+    saveAlias(url, pendingDict)
+
+    try:
+      os.remove(aliasPath(url, pending = True))
+    except:
+      pass
+
+  finally:
+    lockFile.close()
+
+  vcycle.vacutils.logLine('Switched ' + url + ' to ' + objectPath(pendingDict['sha256']))
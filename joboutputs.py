@@ -0,0 +1,458 @@
+#!/usr/bin/python
+#
+#  joboutputs.py - inotify and notification tracking of joboutputs files
+#
+#  Andrew McNab, University of Manchester.
+#  Copyright (c) 2013-9. All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or
+#  without modification, are permitted provided that the following
+#  conditions are met:
+#
+#    o Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#    o Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+#  CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+#  MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+#  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#  EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+#  TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+#  DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+#  ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+#  OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+#  POSSIBILITY OF SUCH DAMAGE.
+#
+#  Contacts: Andrew.McNab@cern.ch  http://www.gridpp.ac.uk/vcycle/
+#
+
+import os
+import stat
+import json
+import time
+import errno
+import ctypes
+import select
+import struct
+
+import vcycle.vacutils
+
+# From /usr/include/sys/inotify.h
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_NONBLOCK    = 0x00000800
+IN_CLOEXEC     = 0x00080000
+
+flushSeconds = 5	# How often the watcher writes out the times file if changed
+staleSeconds = 120	# Times files older than this are ignored, as the watcher has died
+
+class JoboutputsError(Exception):
+  pass
+
+def timesPath(spaceName):
+  # The times file is on local disk, like inotify itself
+  return '/var/lib/vcycle/spaces/' + spaceName + '/joboutputs_times'
+
+def loadJoboutputsTimes(spaceName):
+  """ Return a dictionary of machineName -> { fileName : ctime } for the joboutputs
+      files of the machines in this space, or None if there is no running watcher """
+
+  try:
+    timesDict = json.load(open(timesPath(spaceName), 'r'))
+  except:
+    return None
+
+  try:
+    if timesDict['updated'] < time.time() - staleSeconds:
+      vcycle.vacutils.logLine('Ignoring stale ' + timesPath(spaceName))
+      return None
+
+    return timesDict['machines']
+  except:
+    return None
+
+def notificationsDir(spaceName):
+  # vcycle-wsgi only writes notifications if this directory exists
+  return '/var/lib/vcycle/shared/spaces/' + spaceName + '/notifications'
+
+def createNotificationsDir(spaceName):
+  # Writable by the Apache user, with the sticky bit set like /tmp
+
+  try:
+    os.makedirs(notificationsDir(spaceName))
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+
+  os.chmod(notificationsDir(spaceName), stat.S_ISVTX | stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO)
+
+def readNotifications(spaceName, fileName = None):
+  """ Return a list of (notificationPath, machineName, fileName, time) tuples for the
+      notifications written by vcycle-wsgi for this space. If fileName is given then
+      only notifications about that joboutputs file are returned """
+
+  notifications = []
+
+  try:
+    notificationNames = sorted(os.listdir(notificationsDir(spaceName)))
+  except OSError:
+    return notifications
+
+  for notificationName in notificationNames:
+    if notificationName.startswith('.'):
+      # Still being written
+      continue
+
+    if fileName and not notificationName.endswith('-' + fileName):
+      continue
+
+    notificationPath = notificationsDir(spaceName) + '/' + notificationName
+
+    try:
+      (machineName, notifiedFile, notifiedTime) = open(notificationPath, 'r').read().split()
+      notifications.append((notificationPath, machineName, notifiedFile, int(notifiedTime)))
+    except:
+      vcycle.vacutils.logLine('Removing invalid notification ' + notificationPath)
+      removeNotification(notificationPath)
+
+  return notifications
+
+def removeNotification(notificationPath):
+
+  try:
+    os.remove(notificationPath)
+  except:
+    pass
+
+def drainNotifications(spaceName, fileName = None):
+  """ Read and remove the notifications for this space, returning a list
+      of (machineName, fileName, time) tuples """
+
+  notifications = []
+
+  for (notificationPath, machineName, notifiedFile, notifiedTime) in readNotifications(spaceName, fileName):
+    notifications.append((machineName, notifiedFile, notifiedTime))
+    removeNotification(notificationPath)
+
+  return notifications
+
+def fastRecyclePath(spaceName):
+  # Only exists for spaces with fast_recycle. Holds the counts the fast path
+  # starts from and when it next checks each shutdown_message notification
+  return '/var/lib/vcycle/spaces/' + spaceName + '/fast_recycle'
+
+def pendingShutdownSpaces():
+  """ Return the names of spaces with fast_recycle which have shutdown_message
+      notifications due to be checked. This is cheap enough for vcycled to
+      call every few seconds """
+
+  spaceNames = []
+  timeNow    = time.time()
+
+  try:
+    allSpaceNames = os.listdir('/var/lib/vcycle/shared/spaces')
+  except OSError:
+    return spaceNames
+
+  for spaceName in allSpaceNames:
+    try:
+      notificationNames = os.listdir(notificationsDir(spaceName))
+    except OSError:
+      continue
+
+    shutdownNames = [ notificationName for notificationName in notificationNames
+                      if not notificationName.startswith('.') and notificationName.endswith('-shutdown_message') ]
+
+    if not shutdownNames:
+      continue
+
+    try:
+      retries = json.load(open(fastRecyclePath(spaceName), 'r'))['retries']
+    except:
+      # No fast_recycle, so the next cycle deals with these machines
+      continue
+
+    for notificationName in shutdownNames:
+      if notificationName not in retries or retries[notificationName][0] <= timeNow:
+        spaceNames.append(spaceName)
+        break
+
+  return spaceNames
+
+def updateNotifiedTimes(spaceName):
+  """ Add newly drained notifications to the times saved from previous cycles
+      and return the dictionary of machineName -> { fileName : time } """
+
+  notifiedPath = '/var/lib/vcycle/spaces/' + spaceName + '/notified_times'
+
+  try:
+    notifiedTimes = json.load(open(notifiedPath, 'r'))
+  except:
+    notifiedTimes = {}
+
+  for (machineName, fileName, notifiedTime) in drainNotifications(spaceName):
+    notifiedTimes.setdefault(machineName, {})[fileName] = notifiedTime
+
+  # Forget machines whose directories have been moved out of current
+  currentDir = '/var/lib/vcycle/shared/spaces/' + spaceName + '/current'
+  for machineName in notifiedTimes.keys():
+    if not os.path.isdir(currentDir + '/' + machineName):
+      del notifiedTimes[machineName]
+
+  try:
+    os.makedirs('/var/lib/vcycle/spaces/' + spaceName, 0755)
+  except:
+    pass
+
+  vcycle.vacutils.createFile(notifiedPath, json.dumps(notifiedTimes), tmpDir = '/var/lib/vcycle/tmp')
+  return notifiedTimes
+
+class Inotify:
+  """ Minimal ctypes wrapper around the Linux inotify system calls """
+
+  def __init__(self):
+    try:
+      self.libc = ctypes.CDLL('libc.so.6', use_errno = True)
+      self.libc.inotify_init1
+    except Exception as e:
+      raise JoboutputsError('inotify is not available (' + str(e) + ')')
+
+    self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+    if self.fd < 0:
+      raise JoboutputsError('inotify_init1 fails (' + os.strerror(ctypes.get_errno()) + ')')
+
+  def addWatch(self, path, mask):
+    wd = self.libc.inotify_add_watch(self.fd, path, mask)
+
+    if wd < 0:
+      raise JoboutputsError('inotify_add_watch on ' + path + ' fails (' + os.strerror(ctypes.get_errno()) + ')')
+
+    return wd
+
+  def rmWatch(self, wd):
+    # The kernel then sends IN_IGNORED for wd. Fails if the watch is already gone
+    return self.libc.inotify_rm_watch(self.fd, wd) == 0
+
+  def readEvents(self, timeout):
+    # Return a list of (wd, mask, name) tuples, waiting up to timeout seconds for the first
+
+    if not select.select([self.fd], [], [], timeout)[0]:
+      return []
+
+    try:
+      buffer = os.read(self.fd, 65536)
+    except OSError as e:
+      if e.errno == errno.EAGAIN:
+        return []
+      raise
+
+    events = []
+    i = 0
+
+    while i + 16 <= len(buffer):
+      (wd, mask, cookie, nameLength) = struct.unpack('iIII', buffer[i:i + 16])
+      events.append((wd, mask, buffer[i + 16:i + 16 + nameLength].rstrip('\0')))
+      i += 16 + nameLength
+
+    return events
+
+class JoboutputsWatcher:
+  """ Watch SPACE/current/*/joboutputs and keep a map of machineName to the
+      ctimes of the files in joboutputs, written out to the times file """
+
+  def __init__(self, spaceName):
+    self.spaceName   = spaceName
+    self.currentDir  = '/var/lib/vcycle/shared/spaces/' + spaceName + '/current'
+    self.inotify     = Inotify()
+    self.machines    = {}
+    self.watches     = {}	# wd -> (machineName, isJoboutputs)
+    self.machineWds  = {}	# machineName -> set of its wds, to remove when it leaves current
+    self.changed     = True
+
+    self.currentWd = self.inotify.addWatch(self.currentDir, IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM | IN_ONLYDIR)
+    self.rescan()
+
+  def rescan(self):
+    # Add watches for all machines already present. Also used after queue overflows
+
+    for machineName in os.listdir(self.currentDir):
+      self.addMachine(machineName)
+
+  def addMachine(self, machineName):
+
+    try:
+      wd = self.inotify.addWatch(self.currentDir + '/' + machineName + '/joboutputs',
+                                 IN_CLOSE_WRITE | IN_MOVED_TO | IN_ATTRIB | IN_ONLYDIR)
+    except JoboutputsError:
+      # joboutputs may not exist yet, so watch for it being created in the machine's directory
+      try:
+        wd = self.inotify.addWatch(self.currentDir + '/' + machineName, IN_CREATE | IN_MOVED_TO | IN_ONLYDIR)
+      except JoboutputsError:
+        return
+
+      self.watches[wd] = (machineName, False)
+      self.machineWds.setdefault(machineName, set()).add(wd)
+      return
+
+    # The watch on the machine's directory is not needed once joboutputs is watched
+    for oldWd in self.machineWds.get(machineName, set()) - set([wd]):
+      self.removeWatch(oldWd)
+
+    self.watches[wd] = (machineName, True)
+    self.machineWds[machineName] = set([wd])
+
+    # Record any files written before the watch was added
+    self.machines[machineName] = {}
+
+    try:
+      for fileName in os.listdir(self.currentDir + '/' + machineName + '/joboutputs'):
+        self.updateFile(machineName, fileName)
+    except OSError:
+      pass
+
+    self.changed = True
+
+  def removeWatch(self, wd):
+    # Watches follow the inode, so must be removed when a machine's
+    # directory is renamed out of current rather than deleted
+
+    machineName = self.watches.pop(wd, (None, None))[0]
+    self.machineWds.get(machineName, set()).discard(wd)
+    self.inotify.rmWatch(wd)
+
+  def removeMachine(self, machineName):
+
+    for wd in list(self.machineWds.pop(machineName, set())):
+      self.removeWatch(wd)
+
+    if self.machines.pop(machineName, None) is not None:
+      self.changed = True
+
+  def updateFile(self, machineName, fileName):
+    # We use ctime rather than the time of the event, to match os.stat() in Machine
+
+    if fileName.startswith('.'):
+      # Temporary files of vcycle-wsgi
+      return
+
+    try:
+      self.machines.setdefault(machineName, {})[fileName] = int(os.stat(self.currentDir + '/' + machineName + '/joboutputs/' + fileName).st_ctime)
+    except OSError:
+      return
+
+    self.changed = True
+
+  def processEvent(self, wd, mask, name):
+
+    if mask & IN_Q_OVERFLOW:
+      vcycle.vacutils.logLine('inotify queue overflow for ' + self.spaceName + ' - rescanning')
+      self.rescan()
+
+    elif wd == self.currentWd:
+      if mask & (IN_CREATE | IN_MOVED_TO):
+        self.addMachine(name)
+      elif mask & (IN_DELETE | IN_MOVED_FROM):
+        self.removeMachine(name)
+
+    elif mask & IN_IGNORED:
+      # Watch removed by the kernel since the directory has gone, or by removeWatch()
+      (machineName, isJoboutputs) = self.watches.pop(wd, (None, None))
+      self.machineWds.get(machineName, set()).discard(wd)
+
+    elif wd in self.watches:
+      (machineName, isJoboutputs) = self.watches[wd]
+
+      if isJoboutputs:
+        self.updateFile(machineName, name)
+      elif name == 'joboutputs':
+        self.addMachine(machineName)
+
+  def writeTimes(self):
+    vcycle.vacutils.createFile(timesPath(self.spaceName),
+                               json.dumps({ 'updated' : int(time.time()), 'pid' : os.getpid(), 'machines' : self.machines }),
+                               tmpDir = '/var/lib/vcycle/tmp')
+    self.changed = False
+
+  def run(self):
+    # Loop until vcycled itself goes away
+
+    lastWriteTime = 0
+
+    while True:
+      for (wd, mask, name) in self.inotify.readEvents(1.0):
+        self.processEvent(wd, mask, name)
+
+      if (self.changed and lastWriteTime < time.time() - flushSeconds) or \
+         lastWriteTime < time.time() - staleSeconds / 2:
+        self.writeTimes()
+        lastWriteTime = time.time()
+
+        try:
+          os.kill(int(open('/var/run/vcycled.pid', 'r').read().strip()), 0)
+        except:
+          vcycle.vacutils.logLine('vcycled no longer running - joboutputs watcher for ' + self.spaceName + ' exits')
+          return
+
+def startJoboutputsWatcher(spaceName):
+  """ Start a watcher process for this space, unless one is already running """
+
+  pidFile = '/var/lib/vcycle/spaces/' + spaceName + '/joboutputs_watcher.pid'
+
+  try:
+    os.makedirs('/var/lib/vcycle/spaces/' + spaceName, 0755)
+  except:
+    pass
+
+  try:
+    os.kill(int(open(pidFile, 'r').read().strip()), 0)
+  except:
+    pass
+  else:
+    # Already running
+    return
+
+  try:
+    watcher = JoboutputsWatcher(spaceName)
+  except Exception as e:
+    vcycle.vacutils.logLine('Cannot watch joboutputs in ' + spaceName + ' - falling back to stat() (' + str(e) + ')')
+    return
+
+  pid = os.fork()
+
+  if pid != 0:
+    # The watcher object in this process is just discarded
+    os.close(watcher.inotify.fd)
+    os.waitpid(pid, 0)
+    return
+
+  # Detach from the cycle process, which will exit soon
+  os.setsid()
+
+  if os.fork() != 0:
+    os._exit(0)
+
+  try:
+    vcycle.vacutils.createFile(pidFile, str(os.getpid()), tmpDir = '/var/lib/vcycle/tmp')
+    vcycle.vacutils.setProcessName('vcycle-watcher')
+    vcycle.vacutils.logLine('Started joboutputs watcher for ' + spaceName)
+    watcher.run()
+  except Exception as e:
+    vcycle.vacutils.logLine('Joboutputs watcher for ' + spaceName + ' fails (' + str(e) + ')')
+
+  os._exit(0)
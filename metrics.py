@@ -0,0 +1,492 @@
+#!/usr/bin/python
+#
+#  metrics.py - timing and counts of what each cycle does
+#
+#  Andrew McNab, University of Manchester.
+#  Copyright (c) 2013-9. All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or
+#  without modification, are permitted provided that the following
+#  conditions are met:
+#
+#    o Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#    o Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+#  CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+#  MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS
+#  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+#  EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED
+#  TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+#  DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+#  ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+#  OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+#  POSSIBILITY OF SUCH DAMAGE.
+#
+#  Contacts: Andrew.McNab@cern.ch  http://www.gridpp.ac.uk/vcycle/
+#
+
+import os
+import re
+import gc
+import json
+import stat
+import time
+import bisect
+import urlparse
+import collections
+
+import pycurl
+
+import vcycle.vacutils
+import vcycle.shared
+
+# Each cycle child writes its record here, and vcycled adds it to the
+# rolling summary of recent cycles which it keeps in memory
+cycleRecordFile  = '/var/lib/vcycle/cycle-record.json'
+cycleSummaryFile = '/var/lib/vcycle/cycle-summary.json'
+summaryCycles    = 100		# How many recent cycles are in the summary
+
+# If this file exists, or vcycled receives SIGUSR1, the next cycle is run
+# under cProfile. If the file contains "memory", allocations are reported too
+profileFlagFile  = '/var/lib/vcycle/profile-next-cycle'
+profileDir       = '/var/lib/vcycle/profiles'
+
+# Upper bounds of the histogram buckets, with a final +Inf bucket
+httpBuckets      = [ 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0 ]
+heartbeatBuckets = [ 60, 300, 600, 1200, 1800, 3600 ]
+
+cycleRecord      = None		# Record of the cycle running in this process
+currentPhase     = None		# Entry in cycleRecord['phases'] being timed
+phaseStartOps    = None		# vacutils.fileOpCounts when currentPhase started
+recentRecords    = collections.deque(maxlen = summaryCycles)
+prometheusTotals = {}		# Counters kept by vcycled across cycles, by (name, labels)
+
+# Path segments which are IDs are replaced so calls are grouped by endpoint
+idSegmentRegex = re.compile('^([0-9a-fA-F-]{16,}|[0-9]+|vcycle-[^/]*)$')
+
+def startCycle():
+  # Start the record of the cycle run by this process
+
+  global cycleRecord, currentPhase
+
+  cycleRecord  = { 'pid'        : os.getpid(),
+                   'start_time' : time.time(),
+                   'phases'     : [],
+                   'http'       : {},
+                   'events'     : {},
+                   'spaces'     : {} }
+  currentPhase = None
+
+def startPhase(spaceName, phaseName):
+  # Finish any current phase and start timing phaseName. spaceName is
+  # None for phases of the whole cycle
+
+  global currentPhase, phaseStartOps
+
+  if cycleRecord is None:
+    return
+
+  endPhase()
+
+  currentPhase  = { 'space' : spaceName, 'phase' : phaseName, 'start_time' : time.time() }
+  phaseStartOps = dict(vcycle.vacutils.fileOpCounts)
+
+def endPhase():
+  # Add the current phase, if any, to the record of the cycle
+
+  global currentPhase
+
+  if cycleRecord is None or currentPhase is None:
+    return
+
+  currentPhase['seconds'] = time.time() - currentPhase.pop('start_time')
+
+  for (opName, count) in vcycle.vacutils.fileOpCounts.items():
+    currentPhase[opName + 's'] = count - phaseStartOps.get(opName, 0)
+
+  cycleRecord['phases'].append(currentPhase)
+  currentPhase = None
+
+def endpointName(method, url):
+  # Group URLs such as .../servers/UUID by replacing ID path segments
+
+  parsed = urlparse.urlparse(url)
+
+  return method + ' ' + parsed.netloc + '/'.join([ '{id}' if idSegmentRegex.match(segment) else segment
+                                                   for segment in parsed.path.split('/') ])
+
+def recordHTTP(method, url, status, seconds, numberBytes):
+  # Add one HTTP call to the record of the cycle, for the current phase's space
+
+  if cycleRecord is None:
+    return
+
+  spaceName = currentPhase['space'] if currentPhase else None
+  key       = str(spaceName) + ' ' + endpointName(method, url)
+
+  try:
+    endpoint = cycleRecord['http'][key]
+  except KeyError:
+    endpoint = { 'space'       : spaceName,
+                 'endpoint'    : endpointName(method, url),
+                 'calls'       : 0,
+                 'seconds'     : 0.0,
+                 'max_seconds' : 0.0,
+                 'bytes'       : 0,
+                 'statuses'    : {},
+                 'buckets'     : [ 0 ] * (len(httpBuckets) + 1) }
+    cycleRecord['http'][key] = endpoint
+
+  endpoint['calls']      += 1
+  endpoint['seconds']    += seconds
+  endpoint['max_seconds'] = max(endpoint['max_seconds'], seconds)
+  endpoint['bytes']      += numberBytes
+  endpoint['statuses'][str(status)] = endpoint['statuses'].get(str(status), 0) + 1
+  endpoint['buckets'][bisect.bisect_left(httpBuckets, seconds)] += 1
+
+def countEvent(spaceName, machinetypeName, eventName):
+  # Count an event such as creations_failed for a machinetype
+
+  if cycleRecord is None:
+    return
+
+  key = '%s %s %s' % (spaceName, machinetypeName, eventName)
+
+  if key not in cycleRecord['events']:
+    cycleRecord['events'][key] = { 'space' : spaceName, 'machinetype' : machinetypeName, 'event' : eventName, 'count' : 0 }
+
+  cycleRecord['events'][key]['count'] += 1
+
+def recordSpace(space):
+  """ Add the accounting snapshot of a space from updateAccounting() to the
+      record, with the distribution of how long ago running machines of each
+      machinetype last updated their heartbeat files """
+
+  if cycleRecord is None or space.accounting is None:
+    return
+
+  timeNow      = int(time.time())
+  machinetypes = {}
+
+  for (machinetypeName, machinetype) in space.machinetypes.iteritems():
+    machinetypes[machinetypeName] = dict(machinetype.accounting._asdict(),
+                                         target_share      = machinetype.target_share,
+                                         heartbeat_lags    = [ 0 ] * (len(heartbeatBuckets) + 1),
+                                         heartbeat_lag_max = 0)
+
+  for machine in space.machines.itervalues():
+    if machine.state == vcycle.shared.MachineState.running and \
+       machine.heartbeatTime and machine.machinetypeName in machinetypes:
+      lag = max(0, timeNow - machine.heartbeatTime)
+      machinetypes[machine.machinetypeName]['heartbeat_lags'][bisect.bisect_left(heartbeatBuckets, lag)] += 1
+      machinetypes[machine.machinetypeName]['heartbeat_lag_max'] = max(lag, machinetypes[machine.machinetypeName]['heartbeat_lag_max'])
+
+  cycleRecord['spaces'][space.spaceName] = { 'totals'       : dict(space.accounting._asdict()),
+                                             'machinetypes' : machinetypes }
+
+def recordCurl(curl, method, url, startTime):
+  # recordHTTP() for a pycurl.Curl object after perform(), or after it
+  # fails. If url is None, the URL set in the Curl object is used
+
+  try:
+    if url is None:
+      url = curl.getinfo(pycurl.EFFECTIVE_URL)
+
+    status      = curl.getinfo(pycurl.RESPONSE_CODE)
+    numberBytes = int(curl.getinfo(pycurl.SIZE_DOWNLOAD) + curl.getinfo(pycurl.SIZE_UPLOAD))
+  except:
+    status      = 0
+    numberBytes = 0
+
+  if url is None:
+    return
+
+  recordHTTP(method, url, status, time.time() - startTime, numberBytes)
+
+def endCycle():
+  # Finish the record of the cycle and write it out for vcycled
+
+  global cycleRecord
+
+  if cycleRecord is None:
+    return
+
+  endPhase()
+
+  cycleRecord['end_time'] = time.time()
+  cycleRecord['seconds']  = cycleRecord['end_time'] - cycleRecord['start_time']
+  cycleRecord['http']     = sorted(cycleRecord['http'].values(), key = lambda endpoint: (endpoint['space'], endpoint['endpoint']))
+  cycleRecord['events']   = sorted(cycleRecord['events'].values(), key = lambda event: (event['space'], event['machinetype'], event['event']))
+
+  # So vcycled, which does not read the configuration, knows where to write
+  cycleRecord['prometheus_file'] = vcycle.shared.prometheusFile
+
+  vcycle.vacutils.createFile(cycleRecordFile, json.dumps(cycleRecord),
+                             stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH, '/var/lib/vcycle/tmp')
+  cycleRecord = None
+
+def updateSummary():
+  """ Called by vcycled after each cycle child exits, to add the record it
+      wrote to the summary of recent cycles, which is written out to
+      cycleSummaryFile and returned """
+
+  try:
+    record = json.load(open(cycleRecordFile, 'r'))
+  except Exception as e:
+    vcycle.vacutils.logLine('Cannot read ' + cycleRecordFile + ' (' + str(e) + ')')
+    return None
+
+  if recentRecords and recentRecords[-1]['start_time'] == record['start_time']:
+    # Not a new record, as the cycle child failed to write one
+    return None
+
+  recentRecords.append(record)
+
+  phases    = collections.OrderedDict()
+  endpoints = collections.OrderedDict()
+
+  for oneRecord in recentRecords:
+    for phase in oneRecord['phases']:
+      summary = phases.setdefault((phase['space'], phase['phase']),
+                                  { 'space' : phase['space'], 'phase' : phase['phase'], 'cycles' : 0,
+                                    'seconds' : 0.0, 'max_seconds' : 0.0 })
+      summary['cycles']     += 1
+      summary['seconds']    += phase['seconds']
+      summary['max_seconds'] = max(summary['max_seconds'], phase['seconds'])
+      summary['last_seconds'] = phase['seconds']
+
+    for endpoint in oneRecord['http']:
+      summary = endpoints.setdefault((endpoint['space'], endpoint['endpoint']),
+                                     { 'space' : endpoint['space'], 'endpoint' : endpoint['endpoint'], 'calls' : 0,
+                                       'seconds' : 0.0, 'max_seconds' : 0.0, 'bytes' : 0, 'errors' : 0 })
+      summary['calls']      += endpoint['calls']
+      summary['seconds']    += endpoint['seconds']
+      summary['max_seconds'] = max(summary['max_seconds'], endpoint['max_seconds'])
+      summary['bytes']      += endpoint['bytes']
+      summary['errors']     += sum([ count for (status, count) in endpoint['statuses'].items()
+                                     if not status.startswith('2') and not status.startswith('3') ])
+
+  for summary in phases.values():
+    summary['mean_seconds'] = summary.pop('seconds') / summary['cycles']
+
+  for summary in endpoints.values():
+    summary['mean_seconds'] = summary.pop('seconds') / summary['calls']
+
+  cycleSummary = { 'cycles'       : len(recentRecords),
+                   'mean_seconds' : sum([ oneRecord['seconds'] for oneRecord in recentRecords ]) / len(recentRecords),
+                   'last'         : record,
+                   'phases'       : phases.values(),
+                   'http'         : endpoints.values() }
+
+  vcycle.vacutils.createFile(cycleSummaryFile, json.dumps(cycleSummary),
+                             stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH, '/var/lib/vcycle/tmp')
+
+  if record.get('prometheus_file'):
+    try:
+      writePrometheus(record)
+    except Exception as e:
+      vcycle.vacutils.logLine('Writing ' + record['prometheus_file'] + ' fails (' + str(e) + ')')
+
+  slowestPhase = max(record['phases'], key = lambda phase: phase['seconds']) if record['phases'] else None
+
+  vcycle.vacutils.logLine('Cycle took %.1fs (mean %.1fs over %d cycles)%s' %
+                          (record['seconds'], cycleSummary['mean_seconds'], len(recentRecords),
+                           (', slowest phase %s %s %.1fs' % (slowestPhase['space'] or '', slowestPhase['phase'], slowestPhase['seconds']))
+                           if slowestPhase else ''))
+
+  return cycleSummary
+
+# Names, types and help text of the metrics in writePrometheus() files
+prometheusMetrics = [
+  ('vcycle_cycles_total',                   'counter',   'Cycles completed since vcycled started'),
+  ('vcycle_last_cycle_timestamp_seconds',   'gauge',     'Time the last cycle finished'),
+  ('vcycle_cycle_seconds',                  'gauge',     'Duration of the last cycle'),
+  ('vcycle_cycle_phase_seconds',            'gauge',     'Duration of each phase of the last cycle, with space="" for the whole cycle'),
+  ('vcycle_machines',                       'gauge',     'Vcycle machines found in the last cycle, by state'),
+  ('vcycle_processors',                     'gauge',     'Processors of Vcycle machines found in the last cycle, by state'),
+  ('vcycle_running_hs06',                   'gauge',     'HS06 of running machines, if hs06_per_processor is configured'),
+  ('vcycle_weighted_machines',              'gauge',     'HS06 or processors divided by target_share, used to choose what to create'),
+  ('vcycle_target_share',                   'gauge',     'Configured target_share'),
+  ('vcycle_not_passed_fizzle_machines',     'gauge',     'Starting or running machines which have not yet passed fizzle_seconds'),
+  ('vcycle_events_total',                   'counter',   'Creations and deletions attempted and failed since vcycled started'),
+  ('vcycle_http_requests_total',            'counter',   'HTTP requests since vcycled started, by status'),
+  ('vcycle_http_request_duration_seconds',  'histogram', 'HTTP request latency since vcycled started'),
+  ('vcycle_heartbeat_lag_machines',         'gauge',     'Running machines whose heartbeat file was updated at most le seconds ago'),
+  ('vcycle_heartbeat_lag_seconds_max',      'gauge',     'Longest time since a running machine updated its heartbeat file'),
+  ]
+
+def prometheusLabels(labels):
+  return '{' + ','.join([ '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for (name, value) in labels ]) + '}'
+
+def prometheusBuckets(bounds, counts):
+  # Yield (le label value, cumulative count) for histogram buckets
+
+  total = 0
+  for (bound, count) in zip([ str(bound) for bound in bounds ] + [ '+Inf' ], counts):
+    total += count
+    yield (bound, total)
+
+def writePrometheus(record):
+  """ Called by updateSummary() in vcycled to write the metrics in record,
+      and counters kept since vcycled started, to record['prometheus_file']
+      in Prometheus text format, for example for the node_exporter textfile
+      collector. The file is replaced atomically """
+
+  def addTotal(name, labels, value):
+    prometheusTotals[(name, tuple(labels))] = prometheusTotals.get((name, tuple(labels)), 0) + value
+
+  addTotal('vcycle_cycles_total', (), 1)
+
+  for event in record['events']:
+    addTotal('vcycle_events_total', (('space', event['space']), ('machinetype', event['machinetype']), ('event', event['event'])), event['count'])
+
+  for endpoint in record['http']:
+    labels = (('space', endpoint['space'] or ''), ('endpoint', endpoint['endpoint']))
+
+    for (status, count) in endpoint['statuses'].items():
+      addTotal('vcycle_http_requests_total', labels + (('status', status),), count)
+
+    for (bound, count) in prometheusBuckets(httpBuckets, endpoint['buckets']):
+      addTotal('vcycle_http_request_duration_seconds_bucket', labels + (('le', bound),), count)
+
+    addTotal('vcycle_http_request_duration_seconds_sum',   labels, endpoint['seconds'])
+    addTotal('vcycle_http_request_duration_seconds_count', labels, endpoint['calls'])
+
+  # Gauges only come from the last cycle
+  samples = [ (name, labels, value) for ((name, labels), value) in prometheusTotals.items() ]
+
+  samples.append(('vcycle_last_cycle_timestamp_seconds', (), record['end_time']))
+  samples.append(('vcycle_cycle_seconds', (), record['seconds']))
+
+  for phase in record['phases']:
+    samples.append(('vcycle_cycle_phase_seconds', (('space', phase['space'] or ''), ('phase', phase['phase'])), phase['seconds']))
+
+  for (spaceName, spaceRecord) in record['spaces'].items():
+    for (machinetypeName, totals) in spaceRecord['machinetypes'].items():
+      labels = (('space', spaceName), ('machinetype', machinetypeName))
+
+      samples.append(('vcycle_machines', labels + (('state', 'running'),), totals['runningMachines']))
+      samples.append(('vcycle_machines', labels + (('state', 'total'),), totals['totalMachines']))
+      samples.append(('vcycle_processors', labels + (('state', 'running'),), totals['runningProcessors']))
+      samples.append(('vcycle_processors', labels + (('state', 'starting'),), totals['startingProcessors']))
+      samples.append(('vcycle_processors', labels + (('state', 'total'),), totals['totalProcessors']))
+      samples.append(('vcycle_weighted_machines', labels, totals['weightedMachines']))
+      samples.append(('vcycle_target_share', labels, totals['target_share']))
+      samples.append(('vcycle_not_passed_fizzle_machines', labels, totals['notPassedFizzle']))
+      samples.append(('vcycle_heartbeat_lag_seconds_max', labels, totals['heartbeat_lag_max']))
+
+      if totals['runningHS06'] is not None:
+        samples.append(('vcycle_running_hs06', labels, totals['runningHS06']))
+
+      for (bound, count) in prometheusBuckets(heartbeatBuckets, totals['heartbeat_lags']):
+        samples.append(('vcycle_heartbeat_lag_machines', labels + (('le', bound),), count))
+
+  lines = []
+
+  for (metricName, metricType, metricHelp) in prometheusMetrics:
+    lines.append('# HELP %s %s' % (metricName, metricHelp))
+    lines.append('# TYPE %s %s' % (metricName, metricType))
+
+    # Buckets in numerical order of le, as Prometheus expects
+    for (name, labels, value) in sorted(samples, key = lambda sample: (sample[0], [ (labelName, float(labelValue)) if labelName == 'le' else (labelName, labelValue)
+                                                                                   for (labelName, labelValue) in sample[1] ])):
+      if name == metricName or (metricType == 'histogram' and name.rsplit('_', 1)[0] == metricName):
+        lines.append('%s%s %s' % (name, prometheusLabels(labels) if labels else '', repr(float(value))))
+
+  if not vcycle.vacutils.createFile(record['prometheus_file'], '\n'.join(lines) + '\n',
+                                    stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH):
+    raise Exception('createFile() fails')
+
+def profileRequested(signalled = False):
+  """ Called by vcycled before forking each cycle. Returns None if the cycle
+      is to run normally, or the set of words such as "memory" given in
+      profileFlagFile if it is to be profiled, removing the file so only
+      one cycle is profiled """
+
+  try:
+    options = set(open(profileFlagFile, 'r').read().lower().split())
+  except IOError:
+    return set() if signalled else None
+
+  try:
+    os.remove(profileFlagFile)
+  except Exception as e:
+    vcycle.vacutils.logLine('Cannot remove ' + profileFlagFile + ' (' + str(e) + ')')
+
+  return options
+
+def objectTypeCounts():
+  counts = collections.Counter()
+
+  for obj in gc.get_objects():
+    counts[type(obj).__name__] += 1
+
+  return counts
+
+def profileCycle(function, withMemory = False):
+  """ Run function, normally a whole cycle, under cProfile and write the
+      statistics to profileDir/YYYYMMDD-HHMMSS-PID.pstats, with the top
+      functions and, if withMemory, the top allocations in a .txt file.
+      tracemalloc is used if this Python has it, and otherwise the growth
+      in the number of objects of each type is reported """
+
+  import cProfile
+  import pstats
+  import StringIO
+
+  try:
+    os.makedirs(profileDir, stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR)
+  except OSError:
+    pass
+
+  pathPrefix = profileDir + '/' + time.strftime('%Y%m%d-%H%M%S') + '-' + str(os.getpid())
+  tracemalloc = None
+
+  if withMemory:
+    try:
+      import tracemalloc
+    except ImportError:
+      startCounts = objectTypeCounts()
+    else:
+      tracemalloc.start(10)
+
+  vcycle.vacutils.logLine('Profiling this cycle into ' + pathPrefix + '.pstats')
+  profiler = cProfile.Profile()
+
+  try:
+    profiler.runcall(function)
+  finally:
+    profiler.dump_stats(pathPrefix + '.pstats')
+
+    report = StringIO.StringIO()
+    pstats.Stats(profiler, stream = report).sort_stats('cumulative').print_stats(50)
+
+    if withMemory and tracemalloc:
+      report.write('Top allocations by line:\n')
+
+      for statistic in tracemalloc.take_snapshot().statistics('lineno')[:30]:
+        report.write(str(statistic) + '\n')
+
+      tracemalloc.stop()
+
+    elif withMemory:
+      report.write('%-40s %12s %12s\n' % ('Type', 'Growth', 'Objects'))
+
+      endCounts = objectTypeCounts()
+
+      for (typeName, growth) in sorted([ (typeName, endCounts[typeName] - startCounts.get(typeName, 0)) for typeName in endCounts ],
+                                       key = lambda item: -item[1])[:30]:
+        report.write('%-40s %12d %12d\n' % (typeName, growth, endCounts[typeName]))
+
+    vcycle.vacutils.createFile(pathPrefix + '.txt', report.getvalue(), stat.S_IRUSR|stat.S_IWUSR, profileDir)
+    vcycle.vacutils.logLine('Wrote profile of this cycle to ' + pathPrefix + '.pstats and .txt')
@@ -35,6 +35,7 @@
 #
 
 import json
+import time
 import pycurl
 import os
 import StringIO
@@ -42,6 +43,7 @@ from abc import ABCMeta, abstractmethod
 from six import add_metaclass
 
 import vcycle.vacutils
+import vcycle.metrics
 
 # TODO: Figure a way to have this in one place
 class OpenstackError(Exception):
@@ -58,6 +60,15 @@ class GlanceBase(object):
     self.imageURL = imageURL
     self.curl = pycurl.Curl()
 
+  def _perform(self, method):
+    """ Perform the request set up in self.curl, recording it in the
+    metrics of the cycle whether it succeeds or not """
+    startTime = time.time()
+    try:
+      self.curl.perform()
+    finally:
+      vcycle.metrics.recordCurl(self.curl, method, None, startTime)
+
   @abstractmethod
   def uploadImage(self):
     raise NotImplementedError(__name__)
@@ -124,7 +135,7 @@ class GlanceV2(GlanceBase):
     outputBuffer = StringIO.StringIO()
     self.curl.setopt(pycurl.WRITEFUNCTION, outputBuffer.write)
 
-    self.curl.perform()
+    self._perform('POST')
 
     if self.curl.getinfo(pycurl.RESPONSE_CODE) / 100 != 2:
       raise Exception('Image upload returns HTTP error code '
@@ -165,7 +176,7 @@ class GlanceV2(GlanceBase):
     self.curl.setopt(pycurl.WRITEFUNCTION, outputBuffer.write)
 
     try:
-      self.curl.perform()
+      self._perform('PUT')
     except Exception as e:
       raise OpenstackError('Failed uploading image (' + str(e) + ')')
 
@@ -194,7 +205,7 @@ class GlanceV2(GlanceBase):
     self.curl.setopt(pycurl.HEADERFUNCTION, headersBuffer.write)
 
     try:
-      self.curl.perform()
+      self._perform('GET')
     except Exception as e:
       raise OpenstackError('Failed to get image details (' + str(e) + ')')
 
@@ -261,7 +272,7 @@ class GlanceV1(GlanceBase):
       self.curl.setopt(pycurl.CAPATH, '/etc/grid-security/certificates')
 
     try:
-      self.curl.perform()
+      self._perform('POST')
     except Exception as e:
       raise OpenstackError('Failed uploading image (' + str(e) + ')')
 
@@ -300,7 +311,7 @@ class GlanceV1(GlanceBase):
     self.curl.setopt(pycurl.HEADERFUNCTION, headersBuffer.write)
 
     try:
-      self.curl.perform()
+      self._perform('GET')
     except Exception as e:
       raise OpenstackError('Failed to get image details (' + str(e) + ')')
 
@@ -53,6 +53,7 @@ import tempfile
 import calendar
 
 import vcycle.vacutils
+import vcycle.imagecache
 import vcycle.openstack.image_api
 
 class OpenstackError(Exception):
@@ -368,89 +369,119 @@ class OpenstackSpace(vcycle.BaseSpace):
     # Convert machines from None to an empty dictionary since we successfully connected
     self.machines = {}
 
-    for oneServer in result['response']['servers']:
+    # Each server's dictionary is dropped as soon as its Machine is made,
+    # rather than keeping the whole response until the end of the scan
+    servers = result['response']['servers']
+    del result
 
-      try:
-        machineName = str(oneServer['metadata']['name'])
-      except:
-        machineName = oneServer['name']
+    flavorProcessors = dict([ (flavor['id'], flavor['processors']) for flavor in self.flavors.values() ])
 
-      try:
-        flavorID = oneServer['flavor']['id']
-      except:
-        flavorID   = None
-        processors = 1
-      else:
-        try:
-          processors = self.flavors[self.getFlavorName(flavorID)]['processors']
-        except:
-          processors = 1
+    while servers:
+      self._addServerMachine(servers.pop(), flavorProcessors)
 
-      # Just in case other VMs are in this space
-      if machineName[:7] != 'vcycle-':
-        # Still count VMs that we didn't create and won't manage, to avoid going above space limit
-        self.totalProcessors += processors
-        continue
+  def scanNamedMachines(self, machineNames):
+    """ Look up just the named machines for the fast path, with one request
+        for each rather than listing every server in the space """
 
-      uuidStr = str(oneServer['id'])
+    self.machines = {}
+
+    flavorProcessors = dict([ (flavor['id'], flavor['processors']) for flavor in self.flavors.values() ])
 
-      # Try to get the IP address. Always use the zeroth member of the earliest network
+    for machineName in machineNames:
+      # The name filter is a regular expression, and Vcycle names are plain
       try:
-        ip = str(oneServer['addresses'][ min(oneServer['addresses']) ][0]['addr'])
-      except:
-        ip = '0.0.0.0'
+        result = self.httpRequest(self.computeURL + '/servers/detail?name=' + machineName,
+                                  headers = [ 'X-Auth-Token: ' + self.token ])
+      except Exception as e:
+        raise OpenstackError('Cannot connect to ' + self.computeURL + ' (' + str(e) + ')')
 
-      createdTime  = calendar.timegm(time.strptime(str(oneServer['created']), "%Y-%m-%dT%H:%M:%SZ"))
-      updatedTime  = calendar.timegm(time.strptime(str(oneServer['updated']), "%Y-%m-%dT%H:%M:%SZ"))
+      for oneServer in result['response']['servers']:
+        if oneServer.get('name') == machineName:
+          self._addServerMachine(oneServer, flavorProcessors)
 
-      try:
-        startedTime = calendar.timegm(time.strptime(str(oneServer['OS-SRV-USG:launched_at']).split('.')[0], "%Y-%m-%dT%H:%M:%S"))
-      except:
-        startedTime = None
+    return True
 
-      taskState  = str(oneServer['OS-EXT-STS:task_state'])
-      powerState = int(oneServer['OS-EXT-STS:power_state'])
-      status     = str(oneServer['status'])
+  def _addServerMachine(self, oneServer, flavorProcessors):
+    # Make the Machine for one server dictionary from the compute service
 
-      try:
-        machinetypeName = str(oneServer['metadata']['machinetype'])
-      except:
+    try:
+      machineName = str(oneServer['metadata']['name'])
+    except:
+      machineName = oneServer['name']
+
+    try:
+      flavorID = oneServer['flavor']['id']
+    except:
+      flavorID   = None
+      processors = 1
+    else:
+      processors = flavorProcessors.get(flavorID, 1)
+
+    # Just in case other VMs are in this space
+    if machineName[:7] != 'vcycle-':
+      # Still count VMs that we didn't create and won't manage, to avoid going above space limit
+      self.totalProcessors += processors
+      return
+
+    uuidStr = str(oneServer['id'])
+
+    # Try to get the IP address. Always use the zeroth member of the earliest network
+    try:
+      ip = str(oneServer['addresses'][ min(oneServer['addresses']) ][0]['addr'])
+    except:
+      ip = '0.0.0.0'
+
+    createdTime  = calendar.timegm(time.strptime(str(oneServer['created']), "%Y-%m-%dT%H:%M:%SZ"))
+    updatedTime  = calendar.timegm(time.strptime(str(oneServer['updated']), "%Y-%m-%dT%H:%M:%SZ"))
+
+    try:
+      startedTime = calendar.timegm(time.strptime(str(oneServer['OS-SRV-USG:launched_at']).split('.')[0], "%Y-%m-%dT%H:%M:%S"))
+    except:
+      startedTime = None
+
+    taskState  = str(oneServer['OS-EXT-STS:task_state'])
+    powerState = int(oneServer['OS-EXT-STS:power_state'])
+    status     = str(oneServer['status'])
+
+    try:
+      machinetypeName = str(oneServer['metadata']['machinetype'])
+    except:
+      machinetypeName = None
+    else:
+      if machinetypeName not in self.machinetypes:
         machinetypeName = None
-      else:
-        if machinetypeName not in self.machinetypes:
-          machinetypeName = None
 
-      try:
-        zone = str(oneServer['OS-EXT-AZ:availability_zone'])
-      except:
-        zone = None
-
-      if taskState == 'Deleting':
-        state = vcycle.MachineState.deleting
-      elif status == 'ACTIVE' and powerState == 1:
-        state = vcycle.MachineState.running
-      elif status == 'BUILD' or status == 'ACTIVE':
-        state = vcycle.MachineState.starting
-      elif status == 'SHUTOFF':
-        state = vcycle.MachineState.shutdown
-      elif status == 'ERROR':
-        state = vcycle.MachineState.failed
-      elif status == 'DELETED':
-        state = vcycle.MachineState.deleting
-      else:
-        state = vcycle.MachineState.unknown
-
-      self.machines[machineName] = vcycle.shared.Machine(name             = machineName,
-                                                         spaceName        = self.spaceName,
-                                                         state            = state,
-                                                         ip               = ip,
-                                                         createdTime      = createdTime,
-                                                         startedTime      = startedTime,
-                                                         updatedTime      = updatedTime,
-                                                         uuidStr          = uuidStr,
-                                                         machinetypeName  = machinetypeName,
-                                                         zone             = zone,
-                                                         processors       = processors)
+    try:
+      zone = str(oneServer['OS-EXT-AZ:availability_zone'])
+    except:
+      zone = None
+
+    if taskState == 'Deleting':
+      state = vcycle.MachineState.deleting
+    elif status == 'ACTIVE' and powerState == 1:
+      state = vcycle.MachineState.running
+    elif status == 'BUILD' or status == 'ACTIVE':
+      state = vcycle.MachineState.starting
+    elif status == 'SHUTOFF':
+      state = vcycle.MachineState.shutdown
+    elif status == 'ERROR':
+      state = vcycle.MachineState.failed
+    elif status == 'DELETED':
+      state = vcycle.MachineState.deleting
+    else:
+      state = vcycle.MachineState.unknown
+
+    self.machines[machineName] = vcycle.shared.Machine(name             = machineName,
+                                                       spaceName        = self.spaceName,
+                                                       state            = state,
+                                                       ip               = ip,
+                                                       createdTime      = createdTime,
+                                                       startedTime      = startedTime,
+                                                       updatedTime      = updatedTime,
+                                                       uuidStr          = uuidStr,
+                                                       machinetypeName  = machinetypeName,
+                                                       zone             = zone,
+                                                       processors       = processors)
 
   def getFlavorName(self, flavorID):
     """Get the "flavor" ID"""
@@ -499,16 +530,15 @@ class OpenstackSpace(vcycle.BaseSpace):
          self.machinetypes[machinetypeName].root_image[:8] == 'https://':
 
         try:
-          imageFile = vcycle.vacutils.getRemoteRootImage(self.machinetypes[machinetypeName].root_image,
-                                         '/var/lib/vcycle/imagecache',
-                                         '/var/lib/vcycle/tmp',
-                                         'Vcycle ' + vcycle.shared.vcycleVersion)
-
-          imageLastModified = int(os.stat(imageFile).st_mtime)
+          (imageFile, imageLastModified) = vcycle.imagecache.getImage(self.machinetypes[machinetypeName].root_image,
+                                         'Vcycle ' + vcycle.shared.vcycleVersion,
+                                         vcycle.shared.imageCacheBytes,
+                                         vcycle.shared.prefetchStaleSeconds if self.prefetch_images else 0)
         except Exception as e:
           raise OpenstackError('Failed fetching ' + self.machinetypes[machinetypeName].root_image + ' (' + str(e) + ')')
 
         self.machinetypes[machinetypeName]._imageFile = imageFile
+        self.machinetypes[machinetypeName]._imageLastModified = imageLastModified
 
       elif self.machinetypes[machinetypeName].root_image[0] == '/':
 
@@ -518,6 +548,7 @@ class OpenstackSpace(vcycle.BaseSpace):
           raise OpenstackError('Image file "' + self.machinetypes[machinetypeName].root_image + '" for machinetype ' + machinetypeName + ' does not exist!')
 
         self.machinetypes[machinetypeName]._imageFile = self.machinetypes[machinetypeName].root_image
+        self.machinetypes[machinetypeName]._imageLastModified = imageLastModified
 
       else: # root_image is not an absolute path, but imageName is
 
@@ -528,9 +559,11 @@ class OpenstackSpace(vcycle.BaseSpace):
                             '" does not exist in /var/lib/vcycle/spaces/' + self.spaceName + '/machinetypes/' + machinetypeName + '/files/ !')
 
         self.machinetypes[machinetypeName]._imageFile = imageName
+        self.machinetypes[machinetypeName]._imageLastModified = imageLastModified
 
     else:
-      imageLastModified = int(os.stat(self.machinetypes[machinetypeName]._imageFile).st_mtime)
+      # Cached images are named by content, so use the time recorded when found
+      imageLastModified = self.machinetypes[machinetypeName]._imageLastModified
 
     # Go through the existing images looking for a name and time stamp match
     # We should delete old copies of the current image name if we find them here
@@ -559,14 +592,14 @@ class OpenstackSpace(vcycle.BaseSpace):
     vcycle.vacutils.logLine('Image "' + self.machinetypes[machinetypeName].root_image + '" not found in image service, so uploading')
 
     if self.machinetypes[machinetypeName].cernvm_signing_dn:
-      cernvmDict = vac.vacutils.getCernvmImageData(self.machinetypes[machinetypeName]._imageFile)
+      cernvmDict = vcycle.vacutils.getCernvmImageData(self.machinetypes[machinetypeName]._imageFile, '/var/lib/vcycle/imagecache/cernvm')
 
       if cernvmDict['verified'] == False:
         raise OpenstackError('Failed to verify signature/cert for ' + self.machinetypes[machinetypeName].root_image)
       elif re.search(self.machinetypes[machinetypeName].cernvm_signing_dn,  cernvmDict['dn']) is None:
         raise OpenstackError('Signing DN ' + cernvmDict['dn'] + ' does not match cernvm_signing_dn = ' + self.machinetypes[machinetypeName].cernvm_signing_dn)
       else:
-        vac.vacutils.logLine('Verified image signed by ' + cernvmDict['dn'])
+        vcycle.vacutils.logLine('Verified image signed by ' + cernvmDict['dn'])
 
     # Try to upload the image
     try:
@@ -575,6 +608,14 @@ class OpenstackSpace(vcycle.BaseSpace):
     except Exception as e:
       raise OpenstackError('Failed to upload image file ' + imageName + ' (' + str(e) + ')')
 
+  def prefetchImage(self, machinetypeName, imageFile, imageLastModified):
+    """ Upload a prefetched root_image before the machinetype switches to it """
+
+    self.machinetypes[machinetypeName]._imageFile         = imageFile
+    self.machinetypes[machinetypeName]._imageLastModified = imageLastModified
+
+    self.getImageID(machinetypeName)
+
   def uploadImage(self, imageFile, imageName, imageLastModified,
                   verbose = False):
     return self.imageAPI.uploadImage(imageFile, imageName, imageLastModified,
@@ -45,21 +45,30 @@ import glob
 import time
 import json
 import socket
+import fcntl
 import shutil
 import string
 import pycurl
 import urllib
+import Queue
 import random
 import base64
+import tarfile
 import datetime
+import difflib
 import StringIO
 import tempfile
 import calendar
+import threading
+import subprocess
 import collections
 import ConfigParser
 import xml.etree.cElementTree
 
 import vcycle.vacutils
+import vcycle.joboutputs
+import vcycle.imagecache
+import vcycle.metrics
 
 class VcycleError(Exception):
   pass
@@ -70,6 +79,105 @@ spaces              = None
 maxWallclockSeconds = 0
 curlTimeOutSeconds  = 90
 takeSeconds         = 3600	# Take machines abandoned by their manager for 1.00-1.99 hours
+cleanupThreads      = []	# Background cleanupDeletedDirectories() threads of this cycle
+fastRecycleWaitSeconds = 300	# How long the fast path waits for machines with a shutdown_message to stop
+fastRecycleRetrySeconds = 15	# First wait before the fast path checks a machine still stopping again, then doubled
+proxyKeyPoolDir     = '/var/lib/vcycle/proxykeys'
+proxyKeyPoolSize    = 50	# Pregenerated keys for user_data_proxy proxies
+proxyKeyPoolThread  = None	# Background topUpProxyKeyPool() thread of this cycle
+configSnapshotFile  = '/var/lib/vcycle/config-snapshot.json'
+apelJournalFile     = '/var/lib/vcycle/apel-journal'	# APEL records waiting to be written out
+apelMessageHeader   = 'APEL-individual-job-message: v0.3\n'	# Once at the start of each multi-record APEL file
+expandedVacuumPipes = set()	# vacuum_pipe sections already expanded in the configuration snapshot
+imageCacheBytes     = 20 * 1024 * 1024 * 1024	# Disk budget for root_image files in /var/lib/vcycle/imagecache
+prefetchStaleSeconds = 1800	# Cycles check root_image URLs themselves if not prefetched for this long
+prefetchFlagFile    = '/var/lib/vcycle/prefetch-images'	# Exists if the last cycle had spaces with prefetch_images
+vacmonEmitter       = None	# VacMonEmitter of this cycle, from getVacMonEmitter()
+vacmonDatagramBytes = 1472	# Largest VacMon UDP payload which fits in a 1500 byte MTU
+prometheusFile      = None	# Where vcycled writes metrics in Prometheus text format, if anywhere
+
+# Totals for a space or machinetype made by accountMachines()
+AccountingTotals = collections.namedtuple('AccountingTotals',
+                                          [ 'totalMachines', 'totalProcessors', 'startingProcessors',
+                                            'runningMachines', 'runningProcessors', 'runningHS06',
+                                            'weightedMachines', 'notPassedFizzle' ])
+
+# The counts of a space, besides those of its machinetypes, saved for the fast path
+fastRecycleSpaceFields = ( 'totalMachines', 'totalProcessors', 'runningMachines', 'runningProcessors', 'runningHS06' )
+
+def accountMachines(machines, machinetypes, timeNow = None):
+  """ Add up a dictionary of Machine objects in one pass, returning the
+      AccountingTotals of the space and a dictionary of the AccountingTotals
+      of each machinetype. Machines with no known machinetype only count
+      towards the space. runningHS06 is None unless hs06_per_processor is
+      configured for the machinetype, or for any machinetype for the space """
+
+  if timeNow is None:
+    timeNow = int(time.time())
+
+  # Lists in the order of the AccountingTotals fields
+  spaceRow = [ 0, 0, 0, 0, 0, 0.0, 0.0, 0 ]
+  rows     = dict([ (machinetypeName, [ 0, 0, 0, 0, 0, 0.0, 0.0, 0 ]) for machinetypeName in machinetypes ])
+
+  for machine in machines.itervalues():
+    isStarting = (machine.state == MachineState.starting)
+    isRunning  = (machine.state == MachineState.running)
+    processors = machine.processors
+
+    if machine.machinetypeName in rows:
+      machinetype = machinetypes[machine.machinetypeName]
+      machineRows = (spaceRow, rows[machine.machinetypeName])
+
+      if machinetype.target_share > 0.0:
+        weight = (machine.hs06 if machine.hs06 is not None else float(processors)) / machinetype.target_share
+      else:
+        weight = 0.0
+
+      notPassedFizzle = isStarting or \
+                        (isRunning and machine.startedTime and timeNow - machine.startedTime < machinetype.fizzle_seconds)
+    else:
+      machineRows     = (spaceRow,)
+      weight          = 0.0
+      notPassedFizzle = False
+
+    for row in machineRows:
+      row[0] += 1
+      row[1] += processors
+
+      if isStarting:
+        row[2] += processors
+
+      if isRunning:
+        row[3] += 1
+        row[4] += processors
+
+        if machine.hs06 is not None:
+          row[5] += machine.hs06
+
+      row[6] += weight
+
+      if notPassedFizzle:
+        row[7] += 1
+
+  machinetypeTotals = {}
+
+  for (machinetypeName, row) in rows.iteritems():
+    if machinetypes[machinetypeName].hs06_per_processor is None:
+      row[5] = None
+
+    machinetypeTotals[machinetypeName] = AccountingTotals(*row)
+
+  if not [ True for machinetype in machinetypes.itervalues() if machinetype.hs06_per_processor is not None ]:
+    spaceRow[5] = None
+
+  return (AccountingTotals(*spaceRow), machinetypeTotals)
+
+def internString(value):
+  # Return the interned copy of str values, leaving others such as None alone
+  if isinstance(value, str):
+    return intern(value)
+
+  return value
 
 class MachineState:
   #
@@ -84,19 +192,31 @@ class MachineState:
   #
   unknown, shutdown, starting, running, deleting, failed = ('Unknown', 'Shut down', 'Starting', 'Running', 'Deleting', 'Failed')
 
-class Machine:
+class Machine(object):
+
+  # Machines are rebuilt for every VM each cycle, so avoid a __dict__ per machine
+  __slots__ = ('name', 'spaceName', 'state', 'ip', 'createdTime', 'startedTime', 'updatedTime',
+               'stoppedTime', 'deletedTime', 'heartbeatTime', 'uuidStr', 'machinetypeName', 'zone',
+               'processors', 'hs06', 'manager', 'managedHere', 'managerHeartbeatTime',
+               'shutdownMessage', 'shutdownMessageTime', 'effects')
 
   def __init__(self, name, spaceName, state, ip, createdTime, startedTime, updatedTime, uuidStr, machinetypeName, zone = None, processors = None):
+    # Only builds the state of the machine. Files to write, abort times,
+    # APEL records and VacMon messages are recorded in self.effects and
+    # carried out later by commitEffects()
 
-    # Store values from api-specific calling function
+    self.effects = []
+
+    # Store values from api-specific calling function. Strings shared by
+    # many machines are interned so each machine just holds a reference
     self.name            = name
-    self.spaceName       = spaceName
-    self.state           = state
+    self.spaceName       = internString(spaceName)
+    self.state           = internString(state)
     self.ip              = ip
     self.updatedTime     = updatedTime
     self.uuidStr         = uuidStr
-    self.machinetypeName = machinetypeName
-    self.zone            = zone
+    self.machinetypeName = internString(machinetypeName)
+    self.zone            = internString(zone)
 
     if createdTime:
       self.createdTime  = createdTime
@@ -131,7 +251,7 @@ class Machine:
     if not self.machinetypeName:
       # Get machinetype name saved when we requested the machine
       try:
-        self.machinetypeName = self.getFileContents('machinetype_name').strip()
+        self.machinetypeName = internString(self.getFileContents('machinetype_name').strip())
       except:
         pass
       else:
@@ -161,67 +281,17 @@ class Machine:
 
     try:
       self.hs06 = float(self.getFileContents('jobfeatures/hs06_job'))
-      hs06Weight = self.hs06
     except:
       self.hs06 = None
-      hs06Weight = float(self.processors)
-
-    spaces[self.spaceName].totalMachines += 1
-    spaces[self.spaceName].totalProcessors += self.processors
-
-    try:
-      spaces[self.spaceName].machinetypes[self.machinetypeName].totalMachines += 1
-      spaces[self.spaceName].machinetypes[self.machinetypeName].totalProcessors += self.processors
-
-      if spaces[self.spaceName].machinetypes[self.machinetypeName].target_share > 0.0:
-         spaces[self.spaceName].machinetypes[self.machinetypeName].weightedMachines += (hs06Weight / spaces[self.spaceName].machinetypes[self.machinetypeName].target_share)
-    except:
-      pass
-
-    if self.state == MachineState.starting:
-      try:
-        spaces[self.spaceName].machinetypes[self.machinetypeName].startingProcessors += self.processors
-      except:
-        pass
-
-    if self.state == MachineState.running:
-      try:
-        if not self.startedTime:
-          self.startedTime = int(time.time())
-          self.updatedTime = self.startedTime
-
-        spaces[self.spaceName].runningMachines += 1
-        spaces[self.spaceName].runningProcessors += self.processors
-
-        try:
-          spaces[self.spaceName].machinetypes[self.machinetypeName].runningMachines += 1
-          spaces[self.spaceName].machinetypes[self.machinetypeName].runningProcessors += self.processors
-        except:
-          pass
-
-        if self.hs06 is not None:
-          # We check runningHS06 first in case hs06_per_processor removed from machinetype in config
-          if spaces[self.spacename].runningHS06 is not None:
-            spaces[self.spacename].runningHS06 += self.hs06
-
-          try:
-            spaces[self.spaceName].machinetypes[self.machinetypeName].runningHS06 += self.hs06
-          except:
-            pass
 
-      except:
-        pass
+    if self.state == MachineState.running and not self.startedTime:
+      self.startedTime = int(time.time())
+      self.updatedTime = self.startedTime
 
-    try:
-      if self.state == MachineState.starting or \
-         (self.state == MachineState.running and \
-          ((int(time.time()) - startedTime) < spaces[self.spaceName].machinetypes[self.machinetypeName].fizzle_seconds)):
-        spaces[self.spaceName].machinetypes[self.machinetypeName].notPassedFizzle += 1
-    except:
-      pass
+    # Totals for the space and machinetypes are made by accountMachines()
 
     try:
-      self.manager = self.getFileContents('manager')
+      self.manager = internString(self.getFileContents('manager'))
     except:
       self.manager = None
       self.managedHere = False
@@ -233,7 +303,7 @@ class Machine:
 
     if self.managedHere:
       self.managerHeartbeatTime = int(time.time())
-      self.setFileContents('manager_heartbeat', str(self.managerHeartbeatTime))
+      self.effects.append(('file', 'manager_heartbeat', str(self.managerHeartbeatTime)))
     else:
       try:
         self.managerHeartbeatTime = int(self.getFileContents('manager_heartbeat'))
@@ -242,8 +312,8 @@ class Machine:
 
     # Record when the machine started (rather than just being created)
     if self.managedHere and self.startedTime and not os.path.isfile(self.machineDir() + '/started'):
-      self.setFileContents('started', str(self.startedTime))
-      self.setFileContents('updated', str(self.updatedTime))
+      self.effects.append(('file', 'started', str(self.startedTime)))
+      self.effects.append(('file', 'updated', str(self.updatedTime)))
 
     try:
       self.deletedTime = int(self.getFileContents('deleted'))
@@ -263,10 +333,10 @@ class Machine:
         # This is certainly a better estimate than using time.time() if available (ie OpenStack)
         if not self.updatedTime:
           self.updatedTime = int(time.time())
-          self.setFileContents('updated', str(self.updatedTime))
+          self.effects.append(('file', 'updated', str(self.updatedTime)))
 
         self.stoppedTime = self.updatedTime
-        self.setFileContents('stopped', str(self.stoppedTime))
+        self.effects.append(('file', 'stopped', str(self.stoppedTime)))
 
         # Record the shutdown message if available
         self.getShutdownMessage()
@@ -288,7 +358,7 @@ class Machine:
              (self.stoppedTime > spaces[self.spaceName].machinetypes[self.machinetypeName].lastAbortTime):
             vcycle.vacutils.logLine('Set ' + self.spaceName + ' ' + self.machinetypeName + ' lastAbortTime ' + str(self.stoppedTime) +
                                     ' due to ' + name + ' shutdown message')
-            spaces[self.spaceName].machinetypes[self.machinetypeName].setLastAbortTime(self.stoppedTime)
+            self.effects.append(('lastAbortTime', self.stoppedTime))
 
           elif self.startedTime and \
                (self.stoppedTime > spaces[self.spaceName].machinetypes[self.machinetypeName].lastAbortTime) and \
@@ -297,15 +367,15 @@ class Machine:
             # Store last abort time for stopped machines, based on fizzle_seconds
             vcycle.vacutils.logLine('Set ' + self.spaceName + ' ' + self.machinetypeName + ' lastAbortTime ' + str(self.stoppedTime) +
                                     ' due to ' + name + ' fizzle')
-            spaces[self.spaceName].machinetypes[self.machinetypeName].setLastAbortTime(self.stoppedTime)
+            self.effects.append(('lastAbortTime', self.stoppedTime))
 
           if self.startedTime and shutdownCode and (shutdownCode / 100) == 3:
             vcycle.vacutils.logLine('For ' + self.spaceName + ':' + self.machinetypeName + ' minimum fizzle_seconds=' +
                                       str(self.stoppedTime - self.startedTime) + ' ?')
 
           # Machine finished messages for APEL and VacMon
-          self.writeApel()
-          self.sendMachineMessage()
+          self.effects.append(('apel',))
+          self.effects.append(('vacmon',))
       else:
         self.stoppedTime = None
 
@@ -353,16 +423,55 @@ class Machine:
     # Set the contents of a file for the given machine
     spaces[self.spaceName].setFileContents(self.name, fileName, contents, mode = mode)
 
+  def commitEffects(self, apelRecords = None):
+    """ Carry out the effects recorded while building the state of this
+        machine. If apelRecords is a list, APEL records are appended to it
+        for the caller to journal together, rather than journalled here """
+
+    effects = self.effects
+    self.effects = []
+
+    for effect in effects:
+      if effect[0] == 'file':
+        self.setFileContents(effect[1], effect[2])
+
+      elif effect[0] == 'lastAbortTime':
+        spaces[self.spaceName].machinetypes[self.machinetypeName].setLastAbortTime(effect[1])
+
+      elif effect[0] == 'apel':
+        if apelRecords is None:
+          self.writeApel()
+        else:
+          apelRecord = self.makeApelRecord()
+          if apelRecord:
+            apelRecords.append(apelRecord)
+
+      elif effect[0] == 'vacmon':
+        self.sendMachineMessage()
+
   def writeApel(self):
 
+    apelRecord = self.makeApelRecord()
+
+    if not apelRecord:
+      return
+
+    # Written out with the other records of this cycle by flushApelRecords()
+    try:
+      addApelRecords([ apelRecord ])
+    except Exception as e:
+      vcycle.vacutils.logLine('Failed adding APEL record for ' + self.name + ' to ' + apelJournalFile + ' (' + str(e) + ')')
+
+  def makeApelRecord(self):
+    # Return (APEL record without its header, whether it also goes to
+    # apel-outgoing), or None
+
     # If the VM just ran for fizzle_seconds, then we don't log it
     try:
       if (self.stoppedTime - self.startedTime) < spaces[self.spaceName].machinetypes[self.machinetypeName].fizzle_seconds:
-        return
+        return None
     except:
-      return
-
-    nowTime = time.localtime()
+      return None
 
     userDN = ''
     for component in self.spaceName.split('.'):
@@ -392,8 +501,9 @@ class Machine:
     else:
       tmpGocdbSitename = '.'.join(self.spaceName.split('.')[1:]) if '.' in self.spaceName else self.spaceName
 
-    mesg = ('APEL-individual-job-message: v0.3\n' +
-            'Site: ' + tmpGocdbSitename + '\n' +
+    # The APEL-individual-job-message header is added once per file by
+    # flushApelRecords(), so only the record itself is journalled
+    mesg = ('Site: ' + tmpGocdbSitename + '\n' +
             'SubmitHost: ' + self.spaceName + '/vcycle-' + os.uname()[1] + '\n' +
             'LocalJobId: ' + self.uuidStr + '\n' +
             'LocalUserId: ' + self.name + '\n' +
@@ -414,31 +524,7 @@ class Machine:
             'ServiceLevel: ' + str(self.hs06 if self.hs06 else 1.0) + '\n' +
             '%%\n')
 
-    fileName = time.strftime('%H%M%S', nowTime) + str(time.time() % 1)[2:][:8]
-
-    try:
-      os.makedirs(time.strftime('/var/lib/vcycle/apel-archive/%Y%m%d', nowTime), stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR|stat.S_IRGRP|stat.S_IXGRP|stat.S_IROTH|stat.S_IXOTH)
-    except:
-      pass
-
-    try:
-      vcycle.vacutils.createFile(time.strftime('/var/lib/vcycle/apel-archive/%Y%m%d/', nowTime) + fileName, mesg, stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH, '/var/lib/vcycle/tmp')
-    except:
-      vcycle.vacutils.logLine('Failed creating ' + time.strftime('/var/lib/vcycle/apel-archive/%Y%m%d/', nowTime) + fileName)
-      return
-
-    if spaces[self.spaceName].gocdb_sitename:
-      # We only write to apel-outgoing if gocdb_sitename is set
-      try:
-        os.makedirs(time.strftime('/var/lib/vcycle/apel-outgoing/%Y%m%d', nowTime), stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR|stat.S_IRGRP|stat.S_IXGRP|stat.S_IROTH|stat.S_IXOTH)
-      except:
-        pass
-
-      try:
-        vcycle.vacutils.createFile(time.strftime('/var/lib/vcycle/apel-outgoing/%Y%m%d/', nowTime) + fileName, mesg, stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH, '/var/lib/vcycle/tmp')
-      except:
-        vcycle.vacutils.logLine('Failed creating ' + time.strftime('/var/lib/vcycle/apel-outgoing/%Y%m%d/', nowTime) + fileName)
-        return
+    return (mesg, bool(spaces[self.spaceName].gocdb_sitename))
 
   def sendMachineMessage(self, cookie = '0'):
     if not spaces[self.spaceName].vacmons:
@@ -487,7 +573,7 @@ class Machine:
       messageDict['hs06'] = self.hs06
 
     try:
-      messageDict['fqan'] = spaces[self.spaceName].machinetypes[machinetypeName].accounting_fqan
+      messageDict['fqan'] = spaces[self.spaceName].machinetypes[self.machinetypeName].accounting_fqan
     except:
       pass
 
@@ -501,18 +587,8 @@ class Machine:
     except:
       pass
 
-    messageJSON = json.dumps(messageDict)
-
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-    for vacmonHostPort in spaces[self.spaceName].vacmons:
-      (vacmonHost, vacmonPort) = vacmonHostPort.split(':')
-
-      vcycle.vacutils.logLine('Sending VacMon machine finished message to %s:%s' % (vacmonHost, vacmonPort))
-
-      sock.sendto(messageJSON, (vacmonHost,int(vacmonPort)))
-
-    sock.close()
+    # Packed with other machine_status messages and sent in the background
+    getVacMonEmitter().addMachineMessage(spaces[self.spaceName].vacmons, messageDict)
 
   def getShutdownMessage(self):
 
@@ -530,10 +606,29 @@ class Machine:
        self.heartbeatTime = None
        return
 
-     try:
-       self.heartbeatTime = int(os.stat(self.machineDir() + '/joboutputs/' + spaces[self.spaceName].machinetypes[self.machinetypeName].heartbeat_file).st_ctime)
-     except:
-       self.heartbeatTime = None
+     heartbeatFile = spaces[self.spaceName].machinetypes[self.machinetypeName].heartbeat_file
+
+     # The time vcycle-wsgi told us the heartbeat file was written
+     if spaces[self.spaceName].notifiedTimes is not None and \
+        self.name in spaces[self.spaceName].notifiedTimes:
+       notifiedTime = spaces[self.spaceName].notifiedTimes[self.name].get(heartbeatFile)
+     else:
+       notifiedTime = None
+
+     # Use the times from the joboutputs watcher if it is watching this machine
+     if spaces[self.spaceName].joboutputsTimes is not None and \
+        self.name in spaces[self.spaceName].joboutputsTimes:
+       self.heartbeatTime = spaces[self.spaceName].joboutputsTimes[self.name].get(heartbeatFile)
+     else:
+       try:
+         self.heartbeatTime = int(os.stat(self.machineDir() + '/joboutputs/' + heartbeatFile).st_ctime)
+       except:
+         self.heartbeatTime = None
+
+     # Heartbeats written by vcycle-cgi or anything else which bypasses
+     # vcycle-wsgi are not notified, so the notified time may be stale
+     if notifiedTime is not None and (self.heartbeatTime is None or notifiedTime > self.heartbeatTime):
+       self.heartbeatTime = notifiedTime
 
 class Machinetype:
 
@@ -792,6 +887,7 @@ class Machinetype:
     self.runningProcessors  = 0
     self.weightedMachines   = 0.0
     self.notPassedFizzle    = 0
+    self.accounting         = None	# AccountingTotals from BaseSpace.updateAccounting()
 
   def setLastAbortTime(self, abortTime):
 
@@ -834,6 +930,7 @@ class BaseSpace(object):
     self.runningMachines    = 0
     self.runningProcessors  = 0
     self.runningHS06        = None
+    self.accounting         = None	# AccountingTotals from updateAccounting()
     self.zones              = None
     self.maxStartingSeconds = 3600
     self.shutdownTime  = None
@@ -880,6 +977,10 @@ class BaseSpace(object):
       if spaceTemp != spaceName or sectionType != 'vacuum_pipe':
         continue
 
+      if vacuumPipeSectionName in expandedVacuumPipes:
+        # Already expanded in the configuration snapshot
+        continue
+
       try:
         self._expandVacuumPipe(parser, vacuumPipeSectionName, machinetypeNamePrefix, updatePipes)
       except Exception as e:
@@ -922,6 +1023,12 @@ class BaseSpace(object):
     # Dictionary of all the Vcycle-created volumes in this space
     self.volumes = None
 
+    # Times of joboutputs files from the joboutputs watcher, if available this cycle
+    self.joboutputsTimes = None
+
+    # Times of joboutputs files from vcycle-wsgi notifications, if enabled
+    self.notifiedTimes = None
+
   def _expandVacuumPipe(self, parser, vacuumPipeSectionName, machinetypeNamePrefix, updatePipes):
     """ Read configuration settings from a vacuum pipe """
 
@@ -1090,7 +1197,7 @@ class BaseSpace(object):
   def getFileContents(self, machineName, fileName):
     # Get the contents of a file for the given machine
     try:
-      return open(self.machineDir(machineName) + '/' + fileName, 'r').read().strip()
+      return vcycle.vacutils.countedOpen(self.machineDir(machineName) + '/' + fileName, 'r').read().strip()
     except:
       return None
 
@@ -1102,6 +1209,10 @@ class BaseSpace(object):
     # Null method in case this API doesn't need a connect step
     pass
 
+  def prefetchImage(self, machinetypeName, imageFile, imageLastModified):
+    # Null method in case this API can't upload prefetched images in advance
+    pass
+
   def _xmlToDictRecursor(self, xmlTree):
 
     tag      = xmlTree.tag.split('}')[1]
@@ -1229,10 +1340,16 @@ class BaseSpace(object):
     if os.path.isdir('/etc/grid-security/certificates'):
       self.curl.setopt(pycurl.CAPATH, '/etc/grid-security/certificates')
 
+    startTime = time.time()
+
     try:
       self.curl.perform()
     except Exception as e:
       raise VcycleError('Failed to read ' + url + ' (' + str(e) + ')')
+    finally:
+      vcycle.metrics.recordCurl(self.curl,
+                                'DELETE' if method and method.upper() == 'DELETE' else ('POST' if jsonRequest or formRequest else 'GET'),
+                                str(url), startTime)
 
     headersBuffer.seek(0)
     outputHeaders = { }
@@ -1307,7 +1424,13 @@ class BaseSpace(object):
         pass
 
     # Call the subclass method specific to this space
-    self.deleteOneMachine(machineName)
+    vcycle.metrics.countEvent(self.spaceName, self.machines[machineName].machinetypeName, 'deletions_attempted')
+
+    try:
+      self.deleteOneMachine(machineName)
+    except:
+      vcycle.metrics.countEvent(self.spaceName, self.machines[machineName].machinetypeName, 'deletions_failed')
+      raise
 
   def deleteMachines(self):
     # Delete machines in this space. We do not update totals here: next cycle is good enough.
@@ -1401,142 +1524,499 @@ class BaseSpace(object):
         # We never delete/log directories for machines that are still listed
         continue
 
+      if self.archive_deleted:
+        # Pack the directory structure into today's archive instead
+        try:
+          self._archiveMachineDirectory(machineName)
+        except Exception as e:
+          vcycle.vacutils.logLine('Failed to archive ' + machineName + ' files (' + str(e) + ') - using deleted directory instead')
+        else:
+          # Once archived, the directory must not also go to deleted. If it
+          # cannot be removed now, the next cycle finds it in the index and
+          # just tries to remove it again
+          try:
+            shutil.rmtree(self.machineDir(machineName))
+          except Exception as e:
+            vcycle.vacutils.logLine('Failed to remove archived ' + machineName + ' files (' + str(e) + ') - will retry')
+
+          continue
+
       # Move the directory structure to the stopped machines directory
       vcycle.vacutils.logLine('Save ' + machineName + ' files to deleted directory')
-      os.rename(self.machineDir(machineName), '/var/lib/vcycle/shared/spaces/' + self.spaceName + '/deleted/' + machineName)
+      vcycle.vacutils.countedRename(self.machineDir(machineName), '/var/lib/vcycle/shared/spaces/' + self.spaceName + '/deleted/' + machineName)
 
-  def cleanupDeletedDirectories(self):
-    """ Go through /var/lib/vcycle/shared/SPACE/deleted deleting expired directory trees """
+      # Record when it was moved, so cleanupDeletedDirectories() can find it without a stat()
+      self._appendDeletedIndex(machineName, int(time.time()))
+
+  def _archiveMachineDirectory(self, machineName):
+    """ Append the directory tree of a finished machine to the per-day archive
+        SPACE/archives/YYYYMMDD.tar.gz, unless it is already in the archive for
+        today or yesterday, as a directory archived just before midnight may
+        only be removed by the next cycle. Each machine
+        is a separate gzip member, whose offset and length are recorded in
+        YYYYMMDD.index so it can be extracted on its own. The caller removes
+        the directory """
+
+    archivesDir = '/var/lib/vcycle/shared/spaces/' + self.spaceName + '/archives'
+    dayName     = time.strftime('%Y%m%d')
+    lastDayName = time.strftime('%Y%m%d', time.localtime(time.time() - 86400))
 
     try:
-      dirslist = os.listdir('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/deleted/')
+      os.makedirs(archivesDir, stat.S_IWUSR + stat.S_IXUSR + stat.S_IRUSR + stat.S_IXGRP + stat.S_IRGRP)
     except:
-      return
-      
-    expireTime = int(time.time() - self.cleanup_hours * 3600)
+      pass
 
-    # Go through the per-machine directories
-    for machineName in dirslist:
-    
-      if int(os.stat('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/deleted/' + machineName).st_mtime) < expireTime:
-        vcycle.vacutils.logLine('Cleanup directory of ' + machineName + ' in ' + self.spaceName)
-        
+    f = vcycle.vacutils.countedOpen(archivesDir + '/' + dayName + '.tar.gz', 'ab')
+
+    try:
+      # Other Vcycle instances may be appending to the same archive
+      fcntl.lockf(f, fcntl.LOCK_EX)
+
+      # Discard anything after the last indexed member, left by a crash during an append
+      archiveEnd = 0
+
+      for indexDayName in [lastDayName, dayName]:
         try:
-          shutil.rmtree('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/deleted/' + machineName)
-          vcycle.vacutils.logLine('Deleted /var/lib/vcycle/shared/spaces/' + self.spaceName + '/deleted/' + machineName)
-        except:
-          vcycle.vacutils.logLine('Failed deleting /var/lib/vcycle/shared/spaces/' + self.spaceName + '/deleted/' + machineName)
+          for line in vcycle.vacutils.countedOpen(archivesDir + '/' + indexDayName + '.index', 'r'):
+            try:
+              (indexedName, offset, length) = line.split()
+              memberEnd = int(offset) + int(length)
+            except:
+              continue
+
+            if indexDayName == dayName:
+              archiveEnd = max(archiveEnd, memberEnd)
+
+            if indexedName == machineName:
+              # Archived by an earlier cycle which then failed to remove the directory
+              return
+        except IOError:
+          pass
 
-  def takeMachines(self):
-    # Take abandoned machines from other managers (Vcycle instances), based on their manager_heartbeat times
-    # We do this at the end of the cycle to prevent race conditions mattering
-    # (things settle down during the end of cycle sleep)
+      f.seek(0, os.SEEK_END)
 
-    for machineName,machine in self.machines.iteritems():
+      if f.tell() > archiveEnd:
+        f.truncate(archiveEnd)
+        f.seek(archiveEnd)
 
-      if machine.managedHere:
-        # We do not process machines that are already managed by this Vcycle instance
+      tar = tarfile.open(fileobj = f, mode = 'w:gz')
+      self._addArchiveTree(tar, self.machineDir(machineName), machineName)
+      tar.close()
+      f.flush()
+      # The whole gzip member counts as one write
+      vcycle.vacutils.fileOpCounts['write'] += 1
+
+      i = vcycle.vacutils.countedOpen(archivesDir + '/' + dayName + '.index', 'a')
+      vcycle.vacutils.countedWrite(i, '%s %d %d\n' % (machineName, archiveEnd, f.tell() - archiveEnd))
+      i.close()
+
+    finally:
+      f.close()
+
+    vcycle.vacutils.logLine('Saved ' + machineName + ' files in ' + archivesDir + '/' + dayName + '.tar.gz')
+
+  def _addArchiveTree(self, tar, dirPath, arcName):
+    # Like tar.add(dirPath, arcName) but opening the files with countedOpen()
+    tar.add(dirPath, arcname = arcName, recursive = False)
+
+    for fileName in sorted(os.listdir(dirPath)):
+      filePath = dirPath + '/' + fileName
+
+      if os.path.isdir(filePath) and not os.path.islink(filePath):
+        self._addArchiveTree(tar, filePath, arcName + '/' + fileName)
         continue
 
-      # We add a random tolerance of up to 100% to takeSeconds in case there is more than
-      # one valid Vcycle instance. Each will take an equal share of abandoned machines during
-      # that extra tolerance period.
-      if machine.managerHeartbeatTime < time.time() - takeSeconds * (1.0 + random.random()):
-        vcycle.vacutils.logLine('Will take ' + machineName + ' in ' + self.spaceName + ' from manager ' + str(machine.manager))
+      tarInfo = tar.gettarinfo(filePath, arcName + '/' + fileName)
+
+      if tarInfo is None:
+        # Sockets etc, which tar.add() skips too
+        continue
+
+      if tarInfo.isreg():
+        memberFile = vcycle.vacutils.countedOpen(filePath, 'rb')
+
         try:
-          # First try to change the manager name
-          machine.setFileContents('manager', os.uname()[1])          
-        except Exception as e:
-          # If that fails, bail out. Hopefully another manager will successfully take it? Or we will next cycle?
-          vcycle.vacutils.logLine('Failed changing manager for ' + machineName + ' in ' + self.spaceName)
-        else:
-          # If it succeeds, then update the heartbeat immediately to stop another manager taking it 
-          machine.setFileContents('manager_heartbeat', str(int(time.time())))
-          vcycle.vacutils.logLine('Have taken ' + machineName + ' in ' + self.spaceName + ' from manager ' + str(machine.manager))
-          
-  def createHeartbeatMachines(self):
-    # Create a list of machines in each machinetype, to be populated
-    # with machine names of machines with a current heartbeat
-    # Permissions o+x to allow httpd to read specific lists but not
-    # allow directory browsing
+          tar.addfile(tarInfo, memberFile)
+        finally:
+          memberFile.close()
+      else:
+        tar.addfile(tarInfo)
+
+  def _cleanupArchives(self, expireTime):
+    # Remove whole per-day archives last written before expireTime
+
     try:
-      os.makedirs('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/heartbeatlists',
-                stat.S_IWUSR + stat.S_IXUSR + stat.S_IRUSR + stat.S_IXGRP + stat.S_IRGRP + stat.S_IXOTH)
+      archivesList = os.listdir('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/archives')
     except:
-      pass
+      return
 
-    for machinetypeName in self.machinetypes:
-       self.machinetypes[machinetypeName].heartbeatMachines = []
+    for fileName in archivesList:
+      if not fileName.endswith('.index'):
+        continue
 
-    for machineName,machine in self.machines.iteritems():
-      if machine.managedHere and \
-         machine.state == MachineState.running and \
-         machine.machinetypeName in self.machinetypes and \
-         self.machinetypes[machine.machinetypeName].heartbeat_file and \
-         self.machinetypes[machine.machinetypeName].heartbeat_seconds and \
-         machine.startedTime and \
-         (
-          (machine.heartbeatTime is not None) and
-          (machine.heartbeatTime > (int(time.time()) - self.machinetypes[machine.machinetypeName].heartbeat_seconds))
-         ):
-        # An active machine producing its heartbeat
-        self.machinetypes[machine.machinetypeName].heartbeatMachines.append(machineName)
+      try:
+        if int(os.stat('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/archives/' + fileName).st_mtime) >= expireTime:
+          continue
+      except:
+        continue
 
-    # Save these lists as files accessible through the web server    
-    for machinetypeName in self.machinetypes:
-      fileContents = []
-      for machineName in self.machinetypes[machinetypeName].heartbeatMachines:
-        fileContents.append('%d %s %s\n' 
-                        % (self.machines[machineName].heartbeatTime, machineName, self.machines[machineName].ip))
+      vcycle.vacutils.logLine('Cleanup archive ' + fileName[:-6] + ' in ' + self.spaceName)
 
-      # Sort the list by heartbeat time, newest first, then write as a file
-      fileContents.sort(reverse=True)
-      vcycle.vacutils.createFile('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/heartbeatlists/' + machinetypeName, ''.join(fileContents), 0664, '/var/lib/vcycle/shared/tmp')
-      
-  def makeFactoryMessage(self, cookie = '0'):
-    factoryHeartbeatTime = int(time.time())
+      for suffix in ['.tar.gz', '.index']:
+        try:
+          os.remove('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/archives/' + fileName[:-6] + suffix)
+        except:
+          pass
+
+  def _lockDeletedIndex(self):
+    # Lock deleted_index against other threads and other Vcycle instances sharing the filesystem
+    lockFile = vcycle.vacutils.countedOpen('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/deleted_index.lock', 'a')
+    fcntl.lockf(lockFile, fcntl.LOCK_EX)
+    return lockFile
+
+  def _appendDeletedIndex(self, machineName, movedTime):
+    # Append one "MOVEDTIME MACHINENAME" line to the index of the deleted directory
 
     try:
-      mjfHeartbeatTime = int(os.stat('/var/log/httpd/https-vcycle.log').st_ctime)
-      metadataHeartbeatTime = mjfHeartbeatTime
-    except:
-      mjfHeartbeatTime = 0
-      metadataHeartbeatTime = 0
+      lockFile = self._lockDeletedIndex()
+    except Exception as e:
+      vcycle.vacutils.logLine('Failed to lock deleted_index of ' + self.spaceName + ' (' + str(e) + ')')
+      return
+
+    if not os.path.exists('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/deleted_index'):
+      # cleanupDeletedDirectories() will build a complete index from the directory itself
+      lockFile.close()
+      return
 
     try:
-      bootTime = int(time.time() - float(open('/proc/uptime','r').readline().split()[0]))
-    except:
-      bootTime = 0
+      f = vcycle.vacutils.countedOpen('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/deleted_index', 'a')
+      vcycle.vacutils.countedWrite(f, '%d %s\n' % (movedTime, machineName))
+      f.close()
+    except Exception as e:
+      vcycle.vacutils.logLine('Failed to add ' + machineName + ' to deleted_index of ' + self.spaceName + ' (' + str(e) + ')')
 
-    daemonDiskStatFS  = os.statvfs('/var/lib/vcycle')
-    rootDiskStatFS = os.statvfs('/tmp')
+    lockFile.close()
 
-    memory = vcycle.vacutils.memInfo()
+  def _readDeletedIndex(self):
+    # Return a list of (movedTime, machineName) for the deleted directory, oldest first,
+    # creating the index from the modification times of the directories if necessary.
+    # Must be called with the lock held.
+
+    entries = []
 
     try:
-      osIssue = open('/etc/issue.vac','r').readline().strip()
+      f = vcycle.vacutils.countedOpen('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/deleted_index', 'r')
     except:
+      vcycle.vacutils.logLine('Building deleted_index for ' + self.spaceName)
+
       try:
-        osIssue = open('/etc/issue','r').readline().strip()
+        dirslist = os.listdir('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/deleted')
       except:
-        osIssue = os.uname()[2]
+        dirslist = []
 
-    if spaces[self.spaceName].gocdb_sitename:
-      tmpGocdbSitename = spaces[self.spaceName].gocdb_sitename
-    else:
-      tmpGocdbSitename = '.'.join(self.spaceName.split('.')[1:]) if '.' in self.spaceName else self.spaceName
+      for machineName in dirslist:
+        try:
+          entries.append((int(os.stat('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/deleted/' + machineName).st_mtime), machineName))
+        except:
+          pass
 
-    messageDict = {
-                'message_type'             : 'factory_status',
-                'daemon_version'           : 'Vcycle ' + vcycleVersion + ' vcycled',
-                'vacquery_version'         : 'VacQuery ' + vacQueryVersion,
-                'cookie'                   : cookie,
-                'space'                    : self.spaceName,
-                'site'                     : tmpGocdbSitename,
-                'factory'                  : os.uname()[1],
-                'time_sent'                : int(time.time()),
+      entries.sort()
+      self._writeDeletedIndex(entries)
+      return entries
 
-                'running_processors'       : self.runningProcessors,
+    for line in f:
+      try:
+        (movedTime, machineName) = line.split()
+        entries.append((int(movedTime), machineName))
+      except:
+        # Skip partially written or corrupted lines
+        pass
+
+    f.close()
+
+    entries.sort()
+    return entries
+
+  def _writeDeletedIndex(self, entries):
+    # Replace the index with the given list of (movedTime, machineName). Must be called with the lock held.
+    vcycle.vacutils.createFile('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/deleted_index',
+                               ''.join(['%d %s\n' % entry for entry in entries]),
+                               stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP, '/var/lib/vcycle/shared/tmp')
+
+  def startCleanupDeletedDirectories(self):
+    """ Run cleanupDeletedDirectories() in a background thread. These threads are
+        collected by waitCleanupDeletedDirectories() at the end of the cycle """
+
+    thread = threading.Thread(target = self._cleanupDeletedDirectoriesThread, name = 'cleanup ' + self.spaceName)
+    thread.daemon = True
+    thread.start()
+    cleanupThreads.append(thread)
+
+  def _cleanupDeletedDirectoriesThread(self):
+    try:
+      self.cleanupDeletedDirectories()
+    except Exception as e:
+      vcycle.vacutils.logLine('Cleanup of deleted directories in ' + self.spaceName + ' fails: ' + str(e))
+
+  def cleanupDeletedDirectories(self):
+    """ Go through /var/lib/vcycle/shared/SPACE/deleted deleting expired directory trees,
+        oldest first according to deleted_index, for at most cleanup_seconds """
+
+    stopTime   = time.time() + self.cleanup_seconds
+    expireTime = int(time.time() - self.cleanup_hours * 3600)
+
+    try:
+      os.makedirs('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/deleted',
+                  stat.S_IWUSR + stat.S_IXUSR + stat.S_IRUSR + stat.S_IXGRP + stat.S_IRGRP + stat.S_IXOTH + stat.S_IROTH)
+    except:
+      pass
+
+    self._cleanupArchives(expireTime)
+
+    lockFile = self._lockDeletedIndex()
+
+    try:
+      entries = self._readDeletedIndex()
+    finally:
+      lockFile.close()
+
+    # The index is in expiry order, so we can stop at the first unexpired entry
+    expiredNames = []
+    for (movedTime, machineName) in entries:
+      if movedTime >= expireTime:
+        break
+
+      expiredNames.append(machineName)
+
+    if not expiredNames:
+      return
+
+    doneNames = set()
+
+    if self.cleanup_fast_remove:
+      # Rename the expired directories into a batch directory for this cycle, which
+      # is then removed by a single rm -rf running independently of this cycle
+      batchDir = '/var/lib/vcycle/shared/spaces/' + self.spaceName + '/expired/' + time.strftime('%Y%m%d.%H%M%S')
+
+      try:
+        os.makedirs(batchDir, stat.S_IWUSR + stat.S_IXUSR + stat.S_IRUSR)
+      except:
+        pass
+
+      for machineName in expiredNames:
+        if time.time() > stopTime:
+          vcycle.vacutils.logLine('cleanup_seconds reached for ' + self.spaceName + ', remaining directories left until next cycle')
+          break
+
+        try:
+          vcycle.vacutils.countedRename('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/deleted/' + machineName, batchDir + '/' + machineName)
+        except OSError as e:
+          if os.path.lexists('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/deleted/' + machineName):
+            vcycle.vacutils.logLine('Failed moving ' + machineName + ' in ' + self.spaceName + ' to ' + batchDir + ' (' + str(e) + ')')
+            continue
+
+        doneNames.add(machineName)
+
+      self._startExpiredRemoval(len(doneNames))
+
+    else:
+      for machineName in expiredNames:
+        if time.time() > stopTime:
+          vcycle.vacutils.logLine('cleanup_seconds reached for ' + self.spaceName + ', remaining directories left until next cycle')
+          break
+
+        vcycle.vacutils.logLine('Cleanup directory of ' + machineName + ' in ' + self.spaceName)
+
+        if not os.path.lexists('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/deleted/' + machineName):
+          # Already gone, so just remove it from the index
+          doneNames.add(machineName)
+          continue
+
+        try:
+          shutil.rmtree('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/deleted/' + machineName)
+          vcycle.vacutils.logLine('Deleted /var/lib/vcycle/shared/spaces/' + self.spaceName + '/deleted/' + machineName)
+          doneNames.add(machineName)
+        except:
+          vcycle.vacutils.logLine('Failed deleting /var/lib/vcycle/shared/spaces/' + self.spaceName + '/deleted/' + machineName)
+
+    # Reread the index in case machines were added meanwhile, and drop the ones we removed
+    lockFile = self._lockDeletedIndex()
+
+    try:
+      self._writeDeletedIndex([entry for entry in self._readDeletedIndex() if entry[1] not in doneNames])
+    finally:
+      lockFile.close()
+
+  def _startExpiredRemoval(self, numDirectories):
+    # Start an rm -rf of the batch directories in SPACE/expired, including any left
+    # over from previous cycles, except those still being removed by an earlier rm.
+    # Each running rm is recorded as a line "PID BATCH BATCH ..." in SPACE/expired.pid
+
+    expiredDir  = '/var/lib/vcycle/shared/spaces/' + self.spaceName + '/expired'
+    pidLines    = []
+    removingSet = set()
+
+    try:
+      for line in vcycle.vacutils.countedOpen(expiredDir + '.pid', 'r'):
+        try:
+          pid = int(line.split()[0])
+        except:
+          continue
+
+        try:
+          # Reap it if it is a finished child of this process
+          if os.waitpid(pid, os.WNOHANG)[0] == pid:
+            continue
+        except OSError:
+          # Started by an earlier cycle, so just check whether it still exists
+          try:
+            os.kill(pid, 0)
+          except OSError:
+            continue
+
+        pidLines.append(line.strip())
+        removingSet.update(line.split()[1:])
+    except IOError:
+      pass
+
+    batchNames = [ batchName for batchName in sorted(os.listdir(expiredDir)) if batchName not in removingSet ]
+
+    if removingSet:
+      vcycle.vacutils.logLine('Removal of ' + ' '.join(sorted(removingSet)) + ' in ' + expiredDir + ' still running')
+
+    if batchNames:
+      try:
+        process = subprocess.Popen(['/bin/rm', '-rf'] + [ expiredDir + '/' + batchName for batchName in batchNames ],
+                                   close_fds = True)
+      except Exception as e:
+        vcycle.vacutils.logLine('Failed to start removal of ' + ' '.join(batchNames) + ' in ' + expiredDir + ' (' + str(e) + ')')
+      else:
+        vcycle.vacutils.logLine('Started removal of ' + str(numDirectories) + ' expired directories in '
+                                + ' '.join(batchNames) + ' in ' + expiredDir)
+        pidLines.append(str(process.pid) + ' ' + ' '.join(batchNames))
+
+    # createFile() logs any failure itself
+    vcycle.vacutils.createFile(expiredDir + '.pid', ''.join([ line + '\n' for line in pidLines ]),
+                               stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP, '/var/lib/vcycle/tmp')
+
+  def takeMachines(self):
+    # Take abandoned machines from other managers (Vcycle instances), based on their manager_heartbeat times
+    # We do this at the end of the cycle to prevent race conditions mattering
+    # (things settle down during the end of cycle sleep)
+
+    for machineName,machine in self.machines.iteritems():
+
+      if machine.managedHere:
+        # We do not process machines that are already managed by this Vcycle instance
+        continue
+
+      # We add a random tolerance of up to 100% to takeSeconds in case there is more than
+      # one valid Vcycle instance. Each will take an equal share of abandoned machines during
+      # that extra tolerance period.
+      if machine.managerHeartbeatTime < time.time() - takeSeconds * (1.0 + random.random()):
+        vcycle.vacutils.logLine('Will take ' + machineName + ' in ' + self.spaceName + ' from manager ' + str(machine.manager))
+        try:
+          # First try to change the manager name
+          machine.setFileContents('manager', os.uname()[1])          
+        except Exception as e:
+          # If that fails, bail out. Hopefully another manager will successfully take it? Or we will next cycle?
+          vcycle.vacutils.logLine('Failed changing manager for ' + machineName + ' in ' + self.spaceName)
+        else:
+          # If it succeeds, then update the heartbeat immediately to stop another manager taking it 
+          machine.setFileContents('manager_heartbeat', str(int(time.time())))
+          vcycle.vacutils.logLine('Have taken ' + machineName + ' in ' + self.spaceName + ' from manager ' + str(machine.manager))
+          
+  def createHeartbeatMachines(self):
+    # Create a list of machines in each machinetype, to be populated
+    # with machine names of machines with a current heartbeat
+    # Permissions o+x to allow httpd to read specific lists but not
+    # allow directory browsing
+    try:
+      os.makedirs('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/heartbeatlists',
+                stat.S_IWUSR + stat.S_IXUSR + stat.S_IRUSR + stat.S_IXGRP + stat.S_IRGRP + stat.S_IXOTH)
+    except:
+      pass
+
+    for machinetypeName in self.machinetypes:
+       self.machinetypes[machinetypeName].heartbeatMachines = []
+
+    for machineName,machine in self.machines.iteritems():
+      if machine.managedHere and \
+         machine.state == MachineState.running and \
+         machine.machinetypeName in self.machinetypes and \
+         self.machinetypes[machine.machinetypeName].heartbeat_file and \
+         self.machinetypes[machine.machinetypeName].heartbeat_seconds and \
+         machine.startedTime and \
+         (
+          (machine.heartbeatTime is not None) and
+          (machine.heartbeatTime > (int(time.time()) - self.machinetypes[machine.machinetypeName].heartbeat_seconds))
+         ):
+        # An active machine producing its heartbeat
+        self.machinetypes[machine.machinetypeName].heartbeatMachines.append(machineName)
+
+    # Save these lists as files accessible through the web server    
+    for machinetypeName in self.machinetypes:
+      fileContents = []
+      for machineName in self.machinetypes[machinetypeName].heartbeatMachines:
+        fileContents.append('%d %s %s\n' 
+                        % (self.machines[machineName].heartbeatTime, machineName, self.machines[machineName].ip))
+
+      # Sort the list by heartbeat time, newest first, then write as a file
+      fileContents.sort(reverse=True)
+
+      try:
+        if open('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/heartbeatlists/' + machinetypeName, 'r').read() == ''.join(fileContents):
+          # Unchanged since the last cycle
+          continue
+      except:
+        pass
+
+      vcycle.vacutils.createFile('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/heartbeatlists/' + machinetypeName, ''.join(fileContents), 0664, '/var/lib/vcycle/shared/tmp')
+      
+  def makeFactoryMessage(self, cookie = '0'):
+    factoryHeartbeatTime = int(time.time())
+
+    try:
+      mjfHeartbeatTime = int(os.stat('/var/log/httpd/https-vcycle.log').st_ctime)
+      metadataHeartbeatTime = mjfHeartbeatTime
+    except:
+      mjfHeartbeatTime = 0
+      metadataHeartbeatTime = 0
+
+    try:
+      bootTime = int(time.time() - float(open('/proc/uptime','r').readline().split()[0]))
+    except:
+      bootTime = 0
+
+    daemonDiskStatFS  = os.statvfs('/var/lib/vcycle')
+    rootDiskStatFS = os.statvfs('/tmp')
+
+    memory = vcycle.vacutils.memInfo()
+
+    try:
+      osIssue = open('/etc/issue.vac','r').readline().strip()
+    except:
+      try:
+        osIssue = open('/etc/issue','r').readline().strip()
+      except:
+        osIssue = os.uname()[2]
+
+    if spaces[self.spaceName].gocdb_sitename:
+      tmpGocdbSitename = spaces[self.spaceName].gocdb_sitename
+    else:
+      tmpGocdbSitename = '.'.join(self.spaceName.split('.')[1:]) if '.' in self.spaceName else self.spaceName
+
+    messageDict = {
+                'message_type'             : 'factory_status',
+                'daemon_version'           : 'Vcycle ' + vcycleVersion + ' vcycled',
+                'vacquery_version'         : 'VacQuery ' + vacQueryVersion,
+                'cookie'                   : cookie,
+                'space'                    : self.spaceName,
+                'site'                     : tmpGocdbSitename,
+                'factory'                  : os.uname()[1],
+                'time_sent'                : int(time.time()),
+
+                'running_processors'       : self.runningProcessors,
                 'running_machines'         : self.runningMachines,
 
                 'max_processors'           : self.processors_limit,
@@ -1642,21 +2122,13 @@ class BaseSpace(object):
     factoryMessage      = self.makeFactoryMessage()
     machinetypeMessages = self.makeMachinetypeMessages()
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-    for vacmonHostPort in self.vacmons:
-      (vacmonHost, vacmonPort) = vacmonHostPort.split(':')
-
-      vcycle.vacutils.logLine('Sending VacMon status messages to %s:%s' % (vacmonHost, vacmonPort))
-
-      sock.sendto(factoryMessage, (vacmonHost,int(vacmonPort)))
-
-      for machinetypeMessage in machinetypeMessages:
-        sock.sendto(machinetypeMessage, (vacmonHost,int(vacmonPort)))
+    emitter = getVacMonEmitter()
+    emitter.addMessage(self.vacmons, factoryMessage)
 
-    sock.close()
+    for machinetypeMessage in machinetypeMessages:
+      emitter.addMessage(self.vacmons, machinetypeMessage)
 
-  def makeMachines(self):
+  def makeMachines(self, maxProcessors = None):
 
     if self.shutdownTime is not None and self.shutdownTime < time.time():
       vcycle.vacutils.logLine('Space {} has shutdown time in the past ({}), '\
@@ -1687,6 +2159,10 @@ class BaseSpace(object):
     creationsPerCycle  = int(0.9999999 + self.processors_limit * 0.1)
     creationsThisCycle = 0
 
+    # The fast path only replaces the processors of the machines it deleted
+    if maxProcessors is not None:
+      creationsPerCycle = min(creationsPerCycle, maxProcessors)
+
     # Keep making passes through the machinetypes until limits exhausted
     while True:
       if self.processors_limit is not None and self.totalProcessors >= self.processors_limit:
@@ -1757,6 +2233,174 @@ class BaseSpace(object):
         vcycle.vacutils.logLine('No more free capacity and/or suitable machinetype found within ' + self.spaceName)
         return
 
+  def updateAccounting(self):
+    """ Keep the accountMachines() totals of self.machines as the read-only
+        snapshots self.accounting and machinetype.accounting, and start the
+        counts which makeMachines() updates as it creates machines from them.
+        scanMachines() has already added the processors of VMs which Vcycle
+        does not manage to totalProcessors """
+
+    (self.accounting, machinetypeTotals) = accountMachines(self.machines, self.machinetypes)
+
+    self.totalMachines     = self.accounting.totalMachines
+    self.totalProcessors  += self.accounting.totalProcessors
+    self.runningMachines   = self.accounting.runningMachines
+    self.runningProcessors = self.accounting.runningProcessors
+    self.runningHS06       = self.accounting.runningHS06
+
+    for (machinetypeName, totals) in machinetypeTotals.iteritems():
+      self.machinetypes[machinetypeName].accounting = totals
+
+      for field in AccountingTotals._fields:
+        setattr(self.machinetypes[machinetypeName], field, getattr(totals, field))
+
+  def _accountNewMachine(self, machine):
+    # Add a machine just created by makeMachines() to the counts it is using.
+    # Its starting processors and notPassedFizzle are already counted there
+    # for each creation attempt
+
+    (spaceTotals, machinetypeTotals) = accountMachines({ machine.name : machine }, self.machinetypes)
+
+    self.totalMachines   += spaceTotals.totalMachines
+    self.totalProcessors += spaceTotals.totalProcessors
+
+    for (machinetypeName, totals) in machinetypeTotals.iteritems():
+      self.machinetypes[machinetypeName].totalMachines    += totals.totalMachines
+      self.machinetypes[machinetypeName].totalProcessors  += totals.totalProcessors
+      self.machinetypes[machinetypeName].weightedMachines += totals.weightedMachines
+
+  def commitMachineEffects(self):
+    """ Carry out the effects recorded by the Machine objects made by
+        scanMachines(), which itself only builds their state. APEL records
+        are journalled together at the end """
+
+    apelRecords = []
+
+    for machineName, machine in self.machines.iteritems():
+      try:
+        machine.commitEffects(apelRecords)
+      except Exception as e:
+        vcycle.vacutils.logLine('Committing changes for ' + machineName + ' fails: ' + str(e))
+
+    try:
+      addApelRecords(apelRecords)
+    except Exception as e:
+      vcycle.vacutils.logLine('Failed adding ' + str(len(apelRecords)) + ' APEL records to ' + apelJournalFile + ' (' + str(e) + ')')
+
+  def scanNamedMachines(self, machineNames):
+    """ Put just the named machines in self.machines, for the fast path, and
+        return True. APIs which can look up machines one at a time override
+        this. Otherwise it returns False and the whole space is scanned """
+
+    return False
+
+  def recycleMachines(self, machineNames, fastRecycleState = None):
+    """ Fast path between cycles for machines which have written shutdown_message:
+        delete any which have now stopped and create replacements within the usual
+        limits. Returns the names which no longer need to be looked at """
+
+    self.connect()
+
+    if fastRecycleState and self.scanNamedMachines(machineNames):
+      # Start from the counts saved by the last cycle or fast path rather
+      # than scanning the whole space
+      self.restoreFastRecycleCounts(fastRecycleState)
+    else:
+      self.scanMachines()
+      self.updateAccounting()
+
+    self.commitMachineEffects()
+
+    doneNames       = []
+    freedProcessors = 0
+
+    for machineName in machineNames:
+
+      if machineName not in self.machines or \
+         not self.machines[machineName].managedHere or \
+         self.machines[machineName].deletedTime:
+        doneNames.append(machineName)
+        continue
+
+      machine = self.machines[machineName]
+
+      if machine.state == MachineState.running or machine.state == MachineState.starting:
+        # Still shutting down, so wait for it to stop, since the stopped
+        # state is when scanMachines() records APEL and abort times
+        continue
+
+      try:
+        self._deleteOneMachine(machineName)
+      except Exception as e:
+        vcycle.vacutils.logLine('Fast path deletion of ' + machineName + ' fails: ' + str(e))
+        doneNames.append(machineName)
+        continue
+
+      doneNames.append(machineName)
+
+      # Release its processors now, rather than waiting for the next scanMachines()
+      self.totalMachines   -= 1
+      self.totalProcessors -= machine.processors
+      freedProcessors      += machine.processors
+
+      if machine.machinetypeName in self.machinetypes:
+        self.machinetypes[machine.machinetypeName].totalMachines   -= 1
+        self.machinetypes[machine.machinetypeName].totalProcessors -= machine.processors
+
+    if freedProcessors:
+      self.makeMachines(maxProcessors = freedProcessors)
+
+    return doneNames
+
+  def saveFastRecycleState(self, retries = {}):
+    """ Save the counts makeMachines() uses, for the fast path to start from,
+        and retries, the [ next check time, wait ] of each shutdown_message
+        notification of a machine still stopping. vcycled only runs the fast
+        path for spaces with this file """
+
+    stateDict = { 'space'        : dict([ (field, getattr(self, field)) for field in fastRecycleSpaceFields ]),
+                  'machinetypes' : dict([ (machinetypeName, dict([ (field, getattr(machinetype, field)) for field in AccountingTotals._fields ]))
+                                          for (machinetypeName, machinetype) in self.machinetypes.iteritems() ]),
+                  'retries'      : retries }
+
+    try:
+      os.makedirs('/var/lib/vcycle/spaces/' + self.spaceName, 0755)
+    except:
+      pass
+
+    vcycle.vacutils.createFile(vcycle.joboutputs.fastRecyclePath(self.spaceName), json.dumps(stateDict),
+                               tmpDir = '/var/lib/vcycle/tmp')
+
+  def loadFastRecycleState(self):
+    # Return the dictionary saved by saveFastRecycleState(), or None if it is missing or incomplete
+
+    try:
+      stateDict = json.load(open(vcycle.joboutputs.fastRecyclePath(self.spaceName), 'r'))
+
+      for field in fastRecycleSpaceFields:
+        stateDict['space'][field]
+
+      for totals in stateDict['machinetypes'].itervalues():
+        for field in AccountingTotals._fields:
+          totals[field]
+
+      stateDict['retries'].items()
+    except:
+      return None
+
+    return stateDict
+
+  def restoreFastRecycleCounts(self, stateDict):
+    # Set the counts of the space and its machinetypes from loadFastRecycleState()
+
+    for field in fastRecycleSpaceFields:
+      setattr(self, field, stateDict['space'][field])
+
+    for (machinetypeName, totals) in stateDict['machinetypes'].iteritems():
+      if machinetypeName in self.machinetypes:
+        for field in AccountingTotals._fields:
+          setattr(self.machinetypes[machinetypeName], field, totals[field])
+
   def _createMachine(self, machinetypeName):
     """Generic machine creation"""
 
@@ -1842,7 +2486,10 @@ class BaseSpace(object):
                                                         jobfeaturesURL       = 'https://' + self.https_host + ':' + str(self.https_port) + '/machines/' + self.spaceName + '/' + machineName + '/jobfeatures',
                                                         joboutputsURL        = 'https://' + self.https_host + ':' + str(self.https_port) + '/machines/' + self.spaceName + '/' + machineName + '/joboutputs',
                                                         heartbeatMachinesURL = 'https://' + self.https_host + ':' + str(self.https_port) + '/heartbeatlists/' + self.spaceName,
-                                                        gocdbSitename        =  spaces[self.spaceName].gocdb_sitename
+                                                        gocdbSitename        =  spaces[self.spaceName].gocdb_sitename,
+                                                        userDataCache        = '/var/lib/vcycle/userdatacache',
+                                                        userDataCacheSeconds = self.user_data_cache_seconds,
+                                                        proxyKeyPool         = proxyKeyPoolDir
                                                        )
     except Exception as e:
       raise VcycleError('Failed getting user_data file (' + str(e) + ')')
@@ -1865,10 +2512,17 @@ class BaseSpace(object):
       self.setFileContents(machineName,'jobfeatures/shutdowntime_job', str(self.shutdownTime), mode = 0644)
 
     # Call the API-specific method to actually create the machine
+    vcycle.metrics.countEvent(self.spaceName, machinetypeName, 'creations_attempted')
+
     try:
       self.createMachine(machineName, machinetypeName, zone)
     except Exception as e:
       vcycle.vacutils.logLine('Creation of machine %s fails with: %s' % (machineName, str(e)))
+      vcycle.metrics.countEvent(self.spaceName, machinetypeName, 'creations_failed')
+
+    if machineName in self.machines:
+      self.machines[machineName].commitEffects()
+      self._accountNewMachine(self.machines[machineName])
 
     # Rest of MJF. Some values may be set by self.createMachine() from the API!
 
@@ -1919,74 +2573,153 @@ class BaseSpace(object):
 
   def oneCycle(self):
 
+    vcycle.metrics.startPhase(self.spaceName, 'connect')
     try:
       self.connect()
     except Exception as e:
       vcycle.vacutils.logLine('Skipping ' + self.spaceName + ' this cycle: ' + str(e))
       return
 
+    vcycle.metrics.startPhase(self.spaceName, 'joboutputs')
+    if self.joboutputs_watcher:
+      try:
+        vcycle.joboutputs.startJoboutputsWatcher(self.spaceName)
+        self.joboutputsTimes = vcycle.joboutputs.loadJoboutputsTimes(self.spaceName)
+      except Exception as e:
+        vcycle.vacutils.logLine('Using joboutputs watcher for ' + self.spaceName + ' fails: ' + str(e))
+
+    if self.joboutputs_notifications:
+      try:
+        vcycle.joboutputs.createNotificationsDir(self.spaceName)
+        self.notifiedTimes = vcycle.joboutputs.updateNotifiedTimes(self.spaceName)
+      except Exception as e:
+        vcycle.vacutils.logLine('Reading joboutputs notifications for ' + self.spaceName + ' fails: ' + str(e))
+
+    vcycle.metrics.startPhase(self.spaceName, 'scanMachines')
     try:
       self.scanMachines()
     except Exception as e:
       vcycle.vacutils.logLine('Giving up on ' + self.spaceName + ' this cycle: ' + str(e))
       return
 
+    vcycle.metrics.startPhase(self.spaceName, 'commitMachineEffects')
+    self.updateAccounting()
+
+    try:
+      vcycle.metrics.recordSpace(self)
+    except Exception as e:
+      vcycle.vacutils.logLine('Recording metrics for ' + self.spaceName + ' fails: ' + str(e))
+
+    self.commitMachineEffects()
+
+    vcycle.metrics.startPhase(self.spaceName, 'sendVacMon')
     try:
       self.sendVacMon()
     except Exception as e:
       vcycle.vacutils.logLine('Sending VacMon messages fails: ' + str(e))
 
+    vcycle.metrics.startPhase(self.spaceName, 'deleteMachines')
     try:
       self.deleteMachines()
     except Exception as e:
       vcycle.vacutils.logLine('Deleting old machines in ' + self.spaceName + ' fails: ' + str(e))
       # We carry on because this isn't fatal
       
+    vcycle.metrics.startPhase(self.spaceName, 'moveMachineDirectories')
     try:
       self.moveMachineDirectories()
     except Exception as e:
       vcycle.vacutils.logLine('Moving delete machine directoriess in ' + self.spaceName + ' fails: ' + str(e))
       # We carry on because this isn't fatal
+
+    vcycle.metrics.startPhase(self.spaceName, 'startCleanupDeletedDirectories')
+    # This runs in the background, in parallel with the rest of the cycle
+    try:
+      self.startCleanupDeletedDirectories()
+    except Exception as e:
+      vcycle.vacutils.logLine('Cleanup of deleted directories in ' + self.spaceName + ' fails: ' + str(e))
+      # We carry on because this isn't fatal
       
+    vcycle.metrics.startPhase(self.spaceName, 'createHeartbeatMachines')
     try:
        self.createHeartbeatMachines()
     except Exception as e:
       vcycle.vacutils.logLine('Creating heartbeat machine lists for ' + self.spaceName + ' fails: ' + str(e))
       
+    vcycle.metrics.startPhase(self.spaceName, 'makeMachines')
     try:
       self.makeMachines()
     except Exception as e:
       vcycle.vacutils.logLine('Making machines in ' + self.spaceName + ' fails: ' + str(e))
 
+    # The counts after this cycle's creations are where the fast path starts
     try:
-      self.cleanupDeletedDirectories()
+      if self.fast_recycle:
+        self.saveFastRecycleState()
+      elif os.path.exists(vcycle.joboutputs.fastRecyclePath(self.spaceName)):
+        os.remove(vcycle.joboutputs.fastRecyclePath(self.spaceName))
     except Exception as e:
-      vcycle.vacutils.logLine('Cleanup of deleted directories in ' + self.spaceName + ' fails: ' + str(e))
-      # We carry on because this isn't fatal
-      
+      vcycle.vacutils.logLine('Saving fast_recycle counts of ' + self.spaceName + ' fails: ' + str(e))
+
+    vcycle.metrics.startPhase(self.spaceName, 'startProxyKeyPool')
+    # Replace the pregenerated keys used for user_data_proxy proxies, in the
+    # background while the rest of this cycle continues
+    try:
+      if [ True for machinetype in self.machinetypes.values() if machinetype.options['user_data_proxy'] ]:
+        startProxyKeyPool()
+    except Exception as e:
+      vcycle.vacutils.logLine('Starting proxy key pool fails: ' + str(e))
+
+    vcycle.metrics.startPhase(self.spaceName, 'takeMachines')
     # This must be done last in the cycle to avoid race conditions between manager instances
     try:
       self.takeMachines()
     except Exception as e:
       vcycle.vacutils.logLine('Take abandoned machines ' + self.spaceName + ' fails: ' + str(e))
+
+    vcycle.metrics.endPhase()
       
-def readConf(printConf = False, updatePipes = True):
+# Modules containing the BaseSpace subclass for each API name. These are only
+# imported when a space uses them, to avoid importing the dependencies of all
+# the other plugins. Other API names are looked for in vcycle/API_api.py or
+# vcycle/API/API_api.py as before.
+spacePlugins = {
+  'azure'     : 'vcycle.azure_api',
+  'creamce'   : 'vcycle.creamce_api',
+  'dbce'      : 'vcycle.dbce_api',
+  'ec2'       : 'vcycle.ec2_api',
+  'google'    : 'vcycle.google_api',
+  'occi'      : 'vcycle.occi_api',
+  'openstack' : 'vcycle.openstack.openstack_api'
+  }
+
+def loadSpacePlugin(api):
+  # Import the plugin module for api if necessary. Returns False if there is
+  # no plugin for it, and raises an exception if the plugin fails to import.
+
+  if api in spacePlugins:
+    moduleName = spacePlugins[api]
+  else:
+    vcycleDir = os.path.dirname(os.path.abspath(__file__))
+
+    if os.path.exists(vcycleDir + '/' + api + '_api.py'):
+      moduleName = 'vcycle.' + api + '_api'
+    elif os.path.exists(vcycleDir + '/' + api + '/' + api + '_api.py'):
+      moduleName = 'vcycle.' + api + '.' + api + '_api'
+    else:
+      return False
 
-  global vcycleVersion, spaces
+  if moduleName not in sys.modules:
+    __import__(moduleName)
 
-  try:
-    f = open('/var/lib/vcycle/VERSION', 'r')
-    vcycleVersion = f.readline().split('=',1)[1].strip()
-    f.close()
-  except:
-    vcycleVersion = '0.0.0'
+  return True
 
-  spaces = {}
+def configFiles():
+  # Return the configuration files in the order they are read
 
-  parser = ConfigParser.RawConfigParser()
+  paths = []
 
   # Look for configuration files in /etc/vcycle.d
-  
   for etcPath in ['/var/lib/vcycle/shared/vcycle.d/', '/etc/vcycle.d/']:
     try:
       confFiles = os.listdir(etcPath)
@@ -1995,17 +2728,154 @@ def readConf(printConf = False, updatePipes = True):
     else:
       for oneFile in sorted(confFiles):
         if oneFile[-5:] == '.conf':
-          try:
-            parser.read(etcPath + oneFile)
-          except Exception as e:
-            vcycle.vacutils.logLine('Failed to parse ' + etcPath + oneFile + ' (' + str(e) + ')')
+          paths.append(etcPath + oneFile)
 
   # Standalone configuration file, read last in case of manual overrides
-  parser.read('/etc/vcycle.conf')
+  paths.append('/etc/vcycle.conf')
+
+  return paths
+
+def filesKey(paths):
+  # Identify the current versions of the files, whether or not they exist
+
+  key = []
+
+  for path in paths:
+    try:
+      statInfo = os.stat(path)
+    except:
+      key.append([path, None])
+    else:
+      key.append([path, statInfo.st_mtime, statInfo.st_size, statInfo.st_ino])
+
+  return key
+
+def configSections(parser):
+  # Return the sections of parser as a list of [name, [[option, value], ...]]
+
+  return [ [ sectionName, [ [ n, v ] for (n, v) in parser.items(sectionName) ] ]
+           for sectionName in parser.sections() ]
+
+def configText(sections, sortOptions = False):
+  # Same format as RawConfigParser.write(), optionally with options sorted
+  # so the order options come from vacuum pipes doesn't show up in diffs
+
+  lines = []
+
+  for (sectionName, items) in sections:
+    lines.append('[' + sectionName + ']')
+
+    for (n, v) in (sorted(items) if sortOptions else items):
+      lines.append(n + ' = ' + v.replace('\n', '\n\t'))
+
+    lines.append('')
+
+  return lines
+
+def readConf(printConf = False, updatePipes = True):
+
+  global vcycleVersion, spaces, imageCacheBytes, expandedVacuumPipes, prometheusFile
+
+  try:
+    f = open('/var/lib/vcycle/VERSION', 'r')
+    vcycleVersion = f.readline().split('=',1)[1].strip()
+    f.close()
+  except:
+    vcycleVersion = '0.0.0'
+
+  spaces = {}
+  expandedVacuumPipes = set()
+
+  # The snapshot is the configuration after vacuum pipes have been expanded
+  # into it, saved with the versions of the files it was made from
+  try:
+    snapshot = json.load(open(configSnapshotFile, 'r'))
+
+    for key in ['conf_key', 'pipes_key', 'vacuum_pipe_urls', 'sections', 'time']:
+      snapshot[key]
+  except:
+    snapshot = None
+
+  confPaths = configFiles()
+  confKey   = [ vcycleVersion ] + filesKey(confPaths)
+
+  if snapshot and snapshot['conf_key'] == confKey:
+    vacuumPipeURLs = [ url.encode('utf-8') for url in snapshot['vacuum_pipe_urls'] ]
+    parser         = None
+  else:
+    parser = ConfigParser.RawConfigParser()
+
+    for path in confPaths:
+      try:
+        parser.read(path)
+      except Exception as e:
+        vcycle.vacutils.logLine('Failed to parse ' + path + ' (' + str(e) + ')')
+
+    vacuumPipeURLs = []
+
+    for sectionName in parser.sections():
+      if sectionName.lower().startswith('vacuum_pipe ') and parser.has_option(sectionName, 'vacuum_pipe_url'):
+        vacuumPipeURLs.append(parser.get(sectionName, 'vacuum_pipe_url'))
+
+  # Fetch any vacuum pipes which are due for updating all at once, rather
+  # than one by one as each space is created
+  if updatePipes:
+    try:
+      vcycle.vacutils.fetchPipes('/var/lib/vcycle/pipescache', vacuumPipeURLs, 'vcycle ' + vcycleVersion)
+    except Exception as e:
+      vcycle.vacutils.logLine('Failed fetching vacuum pipes (' + str(e) + ') - using cached copies')
+
+  pipesKey = filesKey([ '/var/lib/vcycle/pipescache/' + urllib.quote(url, '') for url in sorted(set(vacuumPipeURLs)) ])
+
+  if parser is None and snapshot['pipes_key'] == pipesKey:
+    # Nothing has changed, so use the snapshot without expanding pipes again
+    parser = ConfigParser.RawConfigParser()
+
+    for (sectionName, items) in snapshot['sections']:
+      # JSON gives unicode, but everything else expects str as from ConfigParser
+      sectionName = sectionName.encode('utf-8')
+      parser.add_section(sectionName)
+
+      for (n, v) in items:
+        parser.set(sectionName, n.encode('utf-8'), v.encode('utf-8'))
+
+      if sectionName.lower().startswith('vacuum_pipe '):
+        expandedVacuumPipes.add(sectionName)
+
+    newSnapshot = None
+
+  else:
+    if parser is None:
+      # Only the pipes have changed
+      parser = ConfigParser.RawConfigParser()
+
+      for path in confPaths:
+        try:
+          parser.read(path)
+        except Exception as e:
+          vcycle.vacutils.logLine('Failed to parse ' + path + ' (' + str(e) + ')')
+
+    newSnapshot = { 'conf_key'         : confKey,
+                    'pipes_key'        : pipesKey,
+                    'vacuum_pipe_urls' : vacuumPipeURLs }
+
+  # Options which apply to all spaces
+  try:
+    imageCacheBytes = int(float(parser.get('settings', 'image_cache_gb').strip()) * 1024 * 1024 * 1024)
+  except:
+    imageCacheBytes = 20 * 1024 * 1024 * 1024
+
+  try:
+    prometheusFile = parser.get('settings', 'prometheus_file').strip() or None
+  except:
+    prometheusFile = None
 
   # Find the space sections
   for spaceSectionName in parser.sections():
 
+    if spaceSectionName.lower() == 'settings':
+      continue
+
     try:
       (sectionType, spaceName) = spaceSectionName.lower().split(None,1)
     except Exception as e:
@@ -2032,10 +2902,16 @@ def readConf(printConf = False, updatePipes = True):
         if string.translate(apiVersion, None, '0123456789abcdefghijklmnopqrstuvwxyz._-') != '':
           raise VcycleError('Name of api_version in [space ' + spaceName + '] can only contain a-z 0-9 - . or _')
 
+      try:
+        loadSpacePlugin(api)
+      except Exception as e:
+        raise VcycleError('Failed to load plugin for api ' + api + ' in [space ' + spaceName + '] (' + str(e) + ')')
+
       for subClass in BaseSpace.__subclasses__():
         if subClass.__name__ == api.capitalize() + 'Space':
           try:
-            spaces[spaceName] = subClass(api, apiVersion, spaceName, parser, spaceSectionName, updatePipes)
+            # Pipes have already been updated by fetchPipes() above
+            spaces[spaceName] = subClass(api, apiVersion, spaceName, parser, spaceSectionName, False)
           except Exception as e:
             raise VcycleError('Failed to initialise space ' + spaceName + ' (' + str(e) + ')')
           else:
@@ -2079,15 +2955,482 @@ def readConf(printConf = False, updatePipes = True):
       except:
         spaces[spaceName].cleanup_hours = 72
 
+      try:
+        spaces[spaceName].cleanup_seconds = int(parser.get(spaceSectionName,'cleanup_seconds').strip())
+      except:
+        spaces[spaceName].cleanup_seconds = 30
+
+      try:
+        spaces[spaceName].user_data_cache_seconds = int(parser.get(spaceSectionName,'user_data_cache_seconds').strip())
+      except:
+        spaces[spaceName].user_data_cache_seconds = 60
+
+      if parser.has_option(spaceSectionName, 'joboutputs_watcher') and \
+         parser.get(spaceSectionName, 'joboutputs_watcher').strip().lower() == 'true':
+        spaces[spaceName].joboutputs_watcher = True
+      else:
+        spaces[spaceName].joboutputs_watcher = False
+
+      if parser.has_option(spaceSectionName, 'joboutputs_notifications') and \
+         parser.get(spaceSectionName, 'joboutputs_notifications').strip().lower() == 'true':
+        spaces[spaceName].joboutputs_notifications = True
+      else:
+        spaces[spaceName].joboutputs_notifications = False
+
+      if spaces[spaceName].joboutputs_notifications and \
+         parser.has_option(spaceSectionName, 'fast_recycle') and \
+         parser.get(spaceSectionName, 'fast_recycle').strip().lower() == 'true':
+        spaces[spaceName].fast_recycle = True
+      else:
+        spaces[spaceName].fast_recycle = False
+
+      if parser.has_option(spaceSectionName, 'prefetch_images') and \
+         parser.get(spaceSectionName, 'prefetch_images').strip().lower() == 'true':
+        spaces[spaceName].prefetch_images = True
+      else:
+        spaces[spaceName].prefetch_images = False
+
+      if spaces[spaceName].prefetch_images and \
+         parser.has_option(spaceSectionName, 'prefetch_upload') and \
+         parser.get(spaceSectionName, 'prefetch_upload').strip().lower() == 'true':
+        spaces[spaceName].prefetch_upload = True
+      else:
+        spaces[spaceName].prefetch_upload = False
+
+      if parser.has_option(spaceSectionName, 'archive_deleted') and \
+         parser.get(spaceSectionName, 'archive_deleted').strip().lower() == 'true':
+        spaces[spaceName].archive_deleted = True
+      else:
+        spaces[spaceName].archive_deleted = False
+
+      if parser.has_option(spaceSectionName, 'cleanup_fast_remove') and \
+         parser.get(spaceSectionName, 'cleanup_fast_remove').strip().lower() == 'true':
+        spaces[spaceName].cleanup_fast_remove = True
+      else:
+        spaces[spaceName].cleanup_fast_remove = False
+
     elif sectionType != 'machinetype' and sectionType != 'vacuum_pipe':
       raise VcycleError('Section type ' + sectionType + 'not recognised')
 
   # else: Skip over vacuum_pipe and machinetype sections, which are parsed during the space class initialization
 
+  if newSnapshot:
+    newSnapshot['sections'] = configSections(parser)
+    newSnapshot['time']     = int(time.time())
+
+    vcycle.vacutils.createFile(configSnapshotFile, json.dumps(newSnapshot),
+                               stat.S_IRUSR | stat.S_IWUSR, tmpDir = '/var/lib/vcycle/tmp')
+
   if printConf:
-    print 'Configuration including any machinetypes from Vacuum Pipes:'
-    print
-    parser.write(sys.stdout)
-    print
+    if snapshot is None:
+      print 'Configuration including any machinetypes from Vacuum Pipes:'
+      print
+      print '\n'.join(configText(newSnapshot['sections']))
+    else:
+      if newSnapshot is None:
+        diffLines = []
+      else:
+        diffLines = list(difflib.unified_diff(configText(snapshot['sections'], sortOptions = True),
+                                              configText(newSnapshot['sections'], sortOptions = True),
+                                              'previous', 'current', lineterm = ''))
+      if diffLines:
+        print 'Changes to configuration including any machinetypes from Vacuum Pipes:'
+        print
+        print '\n'.join(diffLines)
+        print
+      else:
+        print 'Configuration including any machinetypes from Vacuum Pipes unchanged since ' + \
+              time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(snapshot['time']))
+
+def recycleShutdownMachines(spaceNames):
+  """ Run by vcycled between cycles when vcycle-wsgi has notified it that VMs
+      have written shutdown_message, so their slots can be reused immediately """
+
+  readConf(printConf = False, updatePipes = False)
+
+  for spaceName in spaceNames:
+    notifications = vcycle.joboutputs.readNotifications(spaceName, 'shutdown_message')
+
+    if spaceName not in spaces or not spaces[spaceName].fast_recycle:
+      # The next cycle will deal with these machines as usual
+      for (notificationPath, machineName, fileName, notifiedTime) in notifications:
+        vcycle.joboutputs.removeNotification(notificationPath)
+
+      try:
+        os.remove(vcycle.joboutputs.fastRecyclePath(spaceName))
+      except:
+        pass
+
+      continue
+
+    vcycle.vacutils.logLine('--- Fast path for space ' + spaceName + ' ---------------------')
+
+    fastRecycleState = spaces[spaceName].loadFastRecycleState()
+    retries          = fastRecycleState['retries'] if fastRecycleState else {}
+    timeNow          = time.time()
+
+    # Machines found still stopping last time are only checked again after their wait
+    dueNames = set([ machineName for (notificationPath, machineName, fileName, notifiedTime) in notifications
+                     if os.path.basename(notificationPath) not in retries or
+                        retries[os.path.basename(notificationPath)][0] <= timeNow ])
+
+    doneNames   = set()
+    countsKnown = False
+
+    if dueNames:
+      try:
+        doneNames   = spaces[spaceName].recycleMachines(dueNames, fastRecycleState)
+        countsKnown = True
+      except Exception as e:
+        vcycle.vacutils.logLine('Fast path for ' + spaceName + ' fails: ' + str(e))
+        doneNames = dueNames
+
+    newRetries = {}
+
+    for (notificationPath, machineName, fileName, notifiedTime) in notifications:
+      notificationName = os.path.basename(notificationPath)
+
+      # Machines which never stop are left for the normal cycles to deal with
+      if machineName in doneNames or notifiedTime < int(time.time()) - fastRecycleWaitSeconds:
+        vcycle.joboutputs.removeNotification(notificationPath)
+      elif machineName in dueNames:
+        waitSeconds = retries[notificationName][1] * 2 if notificationName in retries else fastRecycleRetrySeconds
+        newRetries[notificationName] = [ timeNow + waitSeconds, waitSeconds ]
+      elif notificationName in retries:
+        newRetries[notificationName] = retries[notificationName]
+
+    # Otherwise the counts are what the last cycle or fast path saved
+    if not countsKnown and fastRecycleState:
+      spaces[spaceName].restoreFastRecycleCounts(fastRecycleState)
+      countsKnown = True
+
+    if countsKnown:
+      try:
+        spaces[spaceName].saveFastRecycleState(newRetries)
+      except Exception as e:
+        vcycle.vacutils.logLine('Saving fast_recycle counts of ' + spaceName + ' fails: ' + str(e))
+
+  finishVacMon()
+  flushApelRecords()
+
+def addApelRecords(apelRecords):
+  # Append a list of (APEL record, outgoing) to the journal, so they are kept
+  # even if this process dies before flushApelRecords() writes out the
+  # records of the cycle
+
+  if not apelRecords:
+    return
+
+  fd = vcycle.vacutils.countedOsOpen(apelJournalFile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, stat.S_IRUSR | stat.S_IWUSR)
+
+  try:
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    vcycle.vacutils.countedWrite(fd, ''.join([ json.dumps({ 'record' : mesg, 'outgoing' : outgoing }) + '\n'
+                                               for (mesg, outgoing) in apelRecords ]))
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+def flushApelRecords():
+  """ Write the journalled APEL records as one multi-record file in apel-archive
+      and, for spaces with gocdb_sitename, one in apel-outgoing, then empty
+      the journal. Before writing, the file name is recorded in the journal so
+      that if this is interrupted, the next flush writes the same files again
+      rather than duplicating the records in new ones """
+
+  try:
+    journal = vcycle.vacutils.countedOpen(apelJournalFile, 'r+')
+  except IOError:
+    return
+
+  try:
+    fcntl.flock(journal.fileno(), fcntl.LOCK_EX)
+
+    # List of (file name, records) to write, oldest first
+    batches = []
+    records = []
+
+    for line in journal:
+      try:
+        entry = json.loads(line)
+      except:
+        # Partial line from a process which died while appending
+        continue
+
+      if 'flush' in entry:
+        batches.append((str(entry['flush']), records))
+        records = []
+      else:
+        records.append(entry)
+
+    if records:
+      nowTime  = time.localtime()
+      fileName = time.strftime('%Y%m%d/%H%M%S', nowTime) + str(time.time() % 1)[2:][:8]
+
+      journal.seek(0, os.SEEK_END)
+      vcycle.vacutils.countedWrite(journal, json.dumps({ 'flush' : fileName }) + '\n')
+      journal.flush()
+      os.fsync(journal.fileno())
+
+      batches.append((fileName, records))
+
+    for (fileName, records) in batches:
+      if not records:
+        continue
+
+      # Journals written before records were journalled without the header
+      # may still contain it, which must not be repeated inside the file
+      for record in records:
+        if record['record'].startswith(apelMessageHeader):
+          record['record'] = record['record'][len(apelMessageHeader):]
+
+      for (apelDir, mesgs) in [ ('/var/lib/vcycle/apel-archive', [ r['record'] for r in records ]),
+                                ('/var/lib/vcycle/apel-outgoing', [ r['record'] for r in records if r['outgoing'] ]) ]:
+        if not mesgs:
+          continue
+
+        try:
+          os.makedirs(apelDir + '/' + fileName[:8], stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR|stat.S_IRGRP|stat.S_IXGRP|stat.S_IROTH|stat.S_IXOTH)
+        except:
+          pass
+
+        # One header, then the records each ending with a %% line
+        apelText = apelMessageHeader + ''.join(mesgs)
+
+        if not vcycle.vacutils.createFile(apelDir + '/' + fileName, apelText.encode('utf-8'),
+                                          stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH, '/var/lib/vcycle/tmp'):
+          # Leave the journal for the next attempt
+          vcycle.vacutils.logLine('Failed creating ' + apelDir + '/' + fileName)
+          return
+
+        if apelDir == '/var/lib/vcycle/apel-archive':
+          # If this fails, makeSyncRecord indexes the file when it needs it
+          try:
+            vcycle.vacutils.addApelIndex('/var/lib/vcycle', fileName, apelText)
+          except Exception as e:
+            vcycle.vacutils.logLine('Failed indexing ' + apelDir + '/' + fileName + ' (' + str(e) + ')')
+
+      vcycle.vacutils.logLine('Wrote ' + str(len(records)) + ' APEL records to ' + fileName)
+
+    journal.truncate(0)
+
+  finally:
+    journal.close()
+
+def updatePrefetchFlag():
+  """ Called by each cycle after readConf() so vcycled, which does not read
+      the configuration itself, only starts the prefetcher when it is needed """
+
+  if [ True for space in spaces.itervalues() if space.prefetch_images ]:
+    if not os.path.exists(prefetchFlagFile):
+      vcycle.vacutils.createFile(prefetchFlagFile, '', tmpDir = '/var/lib/vcycle/tmp')
+  else:
+    try:
+      os.remove(prefetchFlagFile)
+    except OSError:
+      pass
+
+def prefetchImages():
+  """ Run by vcycled in the background to fetch new versions of the remote
+      root_image files of spaces with prefetch_images, optionally upload them
+      to the spaces' image services, and then switch machinetypes to them """
+
+  readConf(printConf = False, updatePipes = False)
+
+  # Each URL is fetched once however many spaces and machinetypes use it
+  urlUsers = collections.OrderedDict()
+
+  for spaceName, space in spaces.iteritems():
+    if not space.prefetch_images:
+      continue
+
+    for machinetypeName, machinetype in space.machinetypes.iteritems():
+      if machinetype.root_image and \
+         (machinetype.root_image.startswith('http://') or machinetype.root_image.startswith('https://')):
+        urlUsers.setdefault(machinetype.root_image, []).append((space, machinetypeName))
+
+  connectedSpaces = set()
+
+  for url, users in urlUsers.iteritems():
+    try:
+      pendingDict = vcycle.imagecache.prefetchImage(url, 'Vcycle ' + vcycleVersion, imageCacheBytes)
+    except Exception as e:
+      vcycle.vacutils.logLine('Prefetching ' + url + ' fails: ' + str(e))
+      continue
+
+    if pendingDict is None:
+      continue
+
+    ready = True
+
+    for (space, machinetypeName) in users:
+      if not space.prefetch_upload:
+        continue
+
+      try:
+        if space.spaceName not in connectedSpaces:
+          space.connect()
+          connectedSpaces.add(space.spaceName)
+
+        space.prefetchImage(machinetypeName,
+                            vcycle.imagecache.objectPath(pendingDict['sha256']),
+                            pendingDict['last_modified'])
+      except Exception as e:
+        vcycle.vacutils.logLine('Uploading prefetched ' + url + ' for ' + machinetypeName +
+                                ' in ' + space.spaceName + ' fails: ' + str(e))
+        ready = False
+
+    # Otherwise try the uploads again next time, using the pending copy
+    if ready:
+      vcycle.imagecache.switchImage(url, pendingDict)
+
+class VacMonEmitter:
+  """ Sends the VacMon messages of one cycle from a background thread, with
+      one UDP socket and each vacmon_hostport resolved once. machine_status
+      messages are packed several to a datagram, one JSON object per line,
+      with num_machines giving the number of machines in that datagram """
+
+  def __init__(self):
+    self.pending     = {}	# vacmon_hostport -> machine_status dicts not yet packed
+    self.addresses   = {}	# vacmon_hostport -> (address, port), or None if not resolved
+    self.sentCounts  = {}	# vacmon_hostport -> number of datagrams sent
+    self.sock        = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.queue       = Queue.Queue()
+    self.thread      = threading.Thread(target = self._sendThread, name = 'vacmon')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def addMessage(self, vacmons, message):
+    # Queue a JSON message to be sent on its own to each of vacmons
+    for vacmonHostPort in vacmons:
+      self.queue.put((vacmonHostPort, message))
+
+  def addMachineMessage(self, vacmons, messageDict):
+    # Add a machine_status message, queueing a datagram whenever the next
+    # message would not fit in the one being filled for a destination
+
+    # Allow for num_machines reaching three digits when packed
+    messageBytes = len(json.dumps(dict(messageDict, num_machines = 999))) + 1
+
+    for vacmonHostPort in vacmons:
+      (pendingBytes, messageDicts) = self.pending.get(vacmonHostPort, (0, []))
+
+      if messageDicts and pendingBytes + messageBytes > vacmonDatagramBytes:
+        self._queueMachineMessages(vacmonHostPort, messageDicts)
+        (pendingBytes, messageDicts) = (0, [])
+
+      self.pending[vacmonHostPort] = (pendingBytes + messageBytes, messageDicts + [ messageDict ])
+
+  def _queueMachineMessages(self, vacmonHostPort, messageDicts):
+    self.queue.put((vacmonHostPort,
+                    '\n'.join([ json.dumps(dict(messageDict, num_machines = len(messageDicts)))
+                                for messageDict in messageDicts ])))
+
+  def _address(self, vacmonHostPort):
+    if vacmonHostPort not in self.addresses:
+      try:
+        (vacmonHost, vacmonPort) = vacmonHostPort.split(':')
+        self.addresses[vacmonHostPort] = socket.getaddrinfo(vacmonHost, int(vacmonPort),
+                                                            socket.AF_INET, socket.SOCK_DGRAM)[0][4]
+      except Exception as e:
+        vcycle.vacutils.logLine('Cannot resolve VacMon ' + vacmonHostPort + ' (' + str(e) + ')')
+        self.addresses[vacmonHostPort] = None
+
+    return self.addresses[vacmonHostPort]
+
+  def _sendThread(self):
+    while True:
+      item = self.queue.get()
+
+      if item is None:
+        return
+
+      (vacmonHostPort, datagram) = item
+      address = self._address(vacmonHostPort)
+
+      if address is None:
+        continue
+
+      try:
+        self.sock.sendto(datagram, address)
+      except Exception as e:
+        vcycle.vacutils.logLine('Sending VacMon message to ' + vacmonHostPort + ' fails: ' + str(e))
+      else:
+        self.sentCounts[vacmonHostPort] = self.sentCounts.get(vacmonHostPort, 0) + 1
+
+  def finish(self, timeoutSeconds = 10):
+    # Send any partly filled datagrams and wait for the thread to send everything
+
+    for (vacmonHostPort, (pendingBytes, messageDicts)) in self.pending.items():
+      if messageDicts:
+        self._queueMachineMessages(vacmonHostPort, messageDicts)
+
+    self.pending = {}
+    self.queue.put(None)
+    self.thread.join(timeoutSeconds)
+
+    if self.thread.is_alive():
+      vcycle.vacutils.logLine('Abandoning VacMon messages still unsent after ' + str(timeoutSeconds) + 's')
+    else:
+      self.sock.close()
+
+    for (vacmonHostPort, count) in sorted(self.sentCounts.items()):
+      vcycle.vacutils.logLine('Sent ' + str(count) + ' VacMon datagrams to ' + vacmonHostPort)
+
+def getVacMonEmitter():
+  # Return the VacMonEmitter of this cycle, creating it if necessary
+
+  global vacmonEmitter
+
+  if vacmonEmitter is None:
+    vacmonEmitter = VacMonEmitter()
+
+  return vacmonEmitter
+
+def finishVacMon():
+  # Send the remaining VacMon messages of this cycle, if there were any
+
+  global vacmonEmitter
+
+  if vacmonEmitter is not None:
+    vacmonEmitter.finish()
+    vacmonEmitter = None
+
+def startProxyKeyPool():
+  # Start a thread to top up the pool of pregenerated proxy keys, unless
+  # one is already running in this process
+
+  global proxyKeyPoolThread
+
+  if proxyKeyPoolThread is not None and proxyKeyPoolThread.is_alive():
+    return
+
+  proxyKeyPoolThread = threading.Thread(target = _topUpProxyKeyPoolThread,
+                                        name = 'topUpProxyKeyPool')
+  # Keys are written with createFile(), so the cycle can exit without it
+  proxyKeyPoolThread.daemon = True
+  proxyKeyPoolThread.start()
+
+def _topUpProxyKeyPoolThread():
+
+  try:
+    vcycle.vacutils.topUpProxyKeyPool(proxyKeyPoolDir, proxyKeyPoolSize)
+  except Exception as e:
+    vcycle.vacutils.logLine('Topping up proxy key pool in ' + proxyKeyPoolDir + ' fails: ' + str(e))
+
+def waitCleanupDeletedDirectories():
+  # Wait for the background cleanupDeletedDirectories() threads of this cycle. Each
+  # stops itself after cleanup_seconds, but we allow for one slow rmtree() too.
+  # The topUpProxyKeyPool() thread, if any, is given until the same time.
+
+  stopTime = time.time() + max([ space.cleanup_seconds for space in spaces.values() ] + [ 0 ]) + 60
+
+  for thread in cleanupThreads + [ thread for thread in [proxyKeyPoolThread] if thread is not None ]:
+    thread.join(max(0.0, stopTime - time.time()))
+
+    if thread.is_alive():
+      vcycle.vacutils.logLine('Abandoning ' + thread.name + ' still running at end of cycle')
+
+  del cleanupThreads[:]
 
 ### END ###
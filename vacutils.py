@@ -50,13 +50,17 @@ import StringIO
 import tempfile
 import calendar
 import hashlib
+import sqlite3
 import xml.etree.cElementTree
 import pycurl
 import base64
-import M2Crypto
 
 logStream = sys.stdout
 
+# Counts of successful file operations by createFile() and the counted*()
+# functions, so daemons can see how many each part of their work does
+fileOpCounts = { 'open' : 0, 'write' : 0, 'rename' : 0 }
+
 class VacutilsError(Exception):
    pass
 
@@ -68,6 +72,32 @@ def logLine(text):
    logStream.write(time.strftime('%b %d %H:%M:%S [') + str(os.getpid()) + ']: ' + text + '\n')
    logStream.flush()
 
+def countedOpen(path, mode = 'r'):
+   # open() which is counted in fileOpCounts if it succeeds
+   f = open(path, mode)
+   fileOpCounts['open'] += 1
+   return f
+
+def countedOsOpen(path, flags, mode = 0777):
+   # os.open() which is counted in fileOpCounts if it succeeds
+   fd = os.open(path, flags, mode)
+   fileOpCounts['open'] += 1
+   return fd
+
+def countedWrite(fileOrFd, data):
+   # Write data to a file object or descriptor, counted in fileOpCounts if it succeeds
+   if isinstance(fileOrFd, int):
+     os.write(fileOrFd, data)
+   else:
+     fileOrFd.write(data)
+
+   fileOpCounts['write'] += 1
+
+def countedRename(oldPath, newPath):
+   # os.rename() which is counted in fileOpCounts if it succeeds
+   os.rename(oldPath, newPath)
+   fileOpCounts['rename'] += 1
+
 def createFile(targetname, contents, mode=stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP, tmpDir = None):
    # Create a temporary text file containing contents then move
    # it into place. Rename is an atomic operation in POSIX,
@@ -78,13 +108,14 @@ def createFile(targetname, contents, mode=stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP
 
    try:
      ftup = tempfile.mkstemp(prefix = 'createFile-', dir = tmpDir, text = True)
-     os.write(ftup[0], contents)
+     fileOpCounts['open'] += 1
+     countedWrite(ftup[0], contents)
 
      if mode:
        os.fchmod(ftup[0], mode)
 
      os.close(ftup[0])
-     os.rename(ftup[1], targetname)
+     countedRename(ftup[1], targetname)
      return True
    except Exception as e:
      logLine('createFile(' + targetname + ',...) fails with "' + str(e) + '"')
@@ -117,51 +148,64 @@ def secondsToString(timeStamp):
    else:
      return '%dd' % (seconds / 86400)
 
-def readPipe(pipesCache, pipeURL, versionString, updatePipes = False):
+def pipeNeedsUpdate(pipesCache, pipeURL):
+   # True if pipeURL is remote and the cached copy is missing or was last
+   # checked more than the pipe's cache_seconds ago
 
-   # Default value in case not given in file
-   cacheSeconds = 3600
+   if (pipeURL[0:7] != 'http://') and (pipeURL[0:8] != 'https://'):
+     return False
 
    pipeFile = pipesCache + '/' + urllib.quote(pipeURL, '')
 
    try:
      pipeDict = json.load(open(pipeFile, 'r'))
    except:
-     # No pipe file found, so create a placeholder file
-     logLine('Unable to read and parse vacuum pipe file ' + pipeFile)
-     pipeDict = { 'cache_seconds' : cacheSeconds, 'machinetypes' : [] }
+     return True
 
-     if not updatePipes:
-       # if not updating then nothing further we can do
-       return pipeDict
-     
-     try:
-       f = open(pipeFile, 'w')
-     except:
-       raise VacutilsError('Unable to write vacuum pipe file ' + pipeFile)
-     else:
-       json.dump(pipeDict, f)
-       f.close()
+   # As in readPipe(), pipes without a usable cache_seconds are kept for an hour
+   try:
+     cacheSeconds = int(pipeDict['cache_seconds'])
+   except:
+     cacheSeconds = 3600
 
-     # but still force an attempt to fetch remote file
-     cacheSeconds = 0
+   try:
+     checkedTime = json.load(open(pipeFile + '.headers', 'r'))['checked']
+   except:
+     # Cached before ETag:/Last-Modified: were recorded
+     checkedTime = int(os.stat(pipeFile).st_mtime)
 
-   else:
-     try:
-       cacheSeconds = int(pipeDict['cache_seconds'])
-     except:
-       pipeDict['cache_seconds'] = cacheSeconds
+   return checkedTime <= time.time() - cacheSeconds
+
+def fetchPipes(pipesCache, pipeURLs, versionString):
+   # Fetch all the pipes in pipeURLs which need updating at the same time,
+   # sending ETag:/Last-Modified: so unchanged pipes are not transferred again.
+   # If a pipe cannot be fetched, the cached copy is kept and used instead.
+
+   multi   = pycurl.CurlMulti()
+   fetches = []
+
+   for pipeURL in sorted(set(pipeURLs)):
+
+     if not pipeNeedsUpdate(pipesCache, pipeURL):
+       continue
+
+     pipeFile = pipesCache + '/' + urllib.quote(pipeURL, '')
+     fetch = { 'url' : pipeURL, 'file' : pipeFile, 'buffer' : StringIO.StringIO(), 'headers' : {} }
+
+     def headerCallback(line, headers = fetch['headers']):
+       try:
+         (name, value) = line.split(':', 1)
+       except ValueError:
+         return
+
+       headers[name.strip().lower()] = value.strip()
 
-   # Check if cache seconds has expired
-   if updatePipes and \
-      (cacheSeconds == 0 or 
-       int(os.stat(pipeFile).st_mtime) <= time.time() - cacheSeconds) and \
-      ((pipeURL[0:7] == 'http://') or (pipeURL[0:8] == 'https://')):
-     buffer = StringIO.StringIO()
      c = pycurl.Curl()
      c.setopt(c.URL, pipeURL)
-     c.setopt(c.WRITEFUNCTION, buffer.write)
+     c.setopt(c.WRITEFUNCTION, fetch['buffer'].write)
+     c.setopt(c.HEADERFUNCTION, headerCallback)
      c.setopt(c.USERAGENT, versionString)
+     c.setopt(c.CONNECTTIMEOUT, 10)
      c.setopt(c.TIMEOUT, 30)
      c.setopt(c.FOLLOWLOCATION, True)
      c.setopt(c.SSL_VERIFYPEER, 1)
@@ -172,40 +216,355 @@ def readPipe(pipesCache, pipeURL, versionString, updatePipes = False):
      else:
        logLine('/etc/grid-security/certificates directory does not exist - relying on curl bundle of commercial CAs')
 
+     if os.path.exists(pipeFile):
+       try:
+         headersDict = json.load(open(pipeFile + '.headers', 'r'))
+       except:
+         headersDict = {}
+
+       requestHeaders = []
+
+       if headersDict.get('etag'):
+         requestHeaders.append('If-None-Match: ' + str(headersDict['etag']))
+
+       if headersDict.get('last_modified'):
+         requestHeaders.append('If-Modified-Since: ' + str(headersDict['last_modified']))
+
+       c.setopt(c.HTTPHEADER, requestHeaders)
+       fetch['headersDict'] = headersDict
+
      logLine('Fetching ' + pipeURL)
 
-     try:
-       c.perform()
-     except Exception as e:
-       raise VacutilsError('Failed to read ' + pipeURL + ' (' + str(e) + ')')
+     fetch['curl'] = c
+     multi.add_handle(c)
+     fetches.append(fetch)
+
+   numActive = len(fetches)
+   while numActive:
+     while True:
+       (ret, numActive) = multi.perform()
+       if ret != pycurl.E_CALL_MULTI_PERFORM:
+         break
+
+     if numActive:
+       multi.select(1.0)
+
+   curlErrors = {}
+   while True:
+     (numQueued, okList, errList) = multi.info_read()
+
+     for (c, errNum, errMessage) in errList:
+       curlErrors[c] = errMessage
 
+     if numQueued == 0:
+       break
+
+   for fetch in fetches:
+     c = fetch['curl']
+     responseCode = c.getinfo(c.RESPONSE_CODE)
+     multi.remove_handle(c)
      c.close()
 
+     if c in curlErrors:
+       logLine('Failed to read ' + fetch['url'] + ' (' + curlErrors[c] + ') - using cached copy if any')
+       continue
+
+     if responseCode == 304 and 'headersDict' in fetch:
+       fetch['headersDict']['checked'] = int(time.time())
+       createFile(fetch['file'] + '.headers', json.dumps(fetch['headersDict']),
+                  stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH)
+       continue
+
+     if responseCode != 200:
+       logLine('Failed to read ' + fetch['url'] + ' (HTTP code ' + str(responseCode) + ') - using cached copy if any')
+       continue
+
      try:
-       pipeDict = json.loads(buffer.getvalue())
+       json.loads(fetch['buffer'].getvalue())
      except:
-       raise VacutilsError('Failed to load vacuum pipe file from ' + pipeURL)
-     else:
-       try:
-         f = open(pipeFile, 'w')
-       except:
-         logLine('Unable to write vacuum pipe file ' + pipeFile)
-         return pipeDict
-       else:
-         json.dump(pipeDict, f)
-         f.close()
-         logLine('Saved ' + pipeURL + ' as ' + pipeFile)
+       logLine('Failed to load vacuum pipe file from ' + fetch['url'] + ' - using cached copy if any')
+       continue
+
+     if createFile(fetch['file'], fetch['buffer'].getvalue(),
+                   stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH):
+       createFile(fetch['file'] + '.headers',
+                  json.dumps({ 'url'           : fetch['url'],
+                               'checked'       : int(time.time()),
+                               'etag'          : fetch['headers'].get('etag'),
+                               'last_modified' : fetch['headers'].get('last-modified') }),
+                  stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH)
+       logLine('Saved ' + fetch['url'] + ' as ' + fetch['file'])
+
+def readPipe(pipesCache, pipeURL, versionString, updatePipes = False):
+   # Return the vacuum pipe at pipeURL from the copy in pipesCache, first
+   # fetching it if updatePipes is True and it is due to be updated. To fetch
+   # many pipes at once, call fetchPipes() first and then readPipe() for each.
+
+   if updatePipes:
+     fetchPipes(pipesCache, [pipeURL], versionString)
+
+   pipeFile = pipesCache + '/' + urllib.quote(pipeURL, '')
+
+   try:
+     pipeDict = json.load(open(pipeFile, 'r'))
+   except:
+     logLine('Unable to read and parse vacuum pipe file ' + pipeFile)
+     # Default value in case not given in file
+     return { 'cache_seconds' : 3600, 'machinetypes' : [] }
 
-     createFile(pipeFile, json.dumps(pipeDict), stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH)
+   try:
+     pipeDict['cache_seconds'] = int(pipeDict['cache_seconds'])
+   except:
+     pipeDict['cache_seconds'] = 3600
 
    return pipeDict
 
+# Pattern for user_data template placeholders, also used to remove unused ones
+userDataPattern = re.compile('##user_data_[a-z,0-9,_]*##')
+
+# Option names which make a whole placeholder that userDataPattern finds
+userDataNamePattern = re.compile('user_data_[a-z,0-9,_]*$')
+
+# Characters which can be part of a placeholder
+userDataPatternChars = re.compile('[a-z,0-9,_#]')
+
+# path -> (mtime, size, inode, contents) of files read by readCachedFile()
+cachedFiles = {}
+
+# template -> compiled template from compileUserDataTemplate()
+compiledUserDataTemplates = {}
+
+def readCachedFile(path):
+   # Return the contents of the file, only rereading it if it has changed
+
+   statInfo = os.stat(path)
+
+   try:
+     (mtime, size, inode, contents) = cachedFiles[path]
+     if mtime == statInfo.st_mtime and size == statInfo.st_size and inode == statInfo.st_ino:
+       return contents
+   except KeyError:
+     pass
+
+   f = open(path, 'r')
+   contents = f.read()
+   f.close()
+
+   cachedFiles[path] = (statInfo.st_mtime, statInfo.st_size, statInfo.st_ino, contents)
+   return contents
+
+def compileUserDataTemplate(template):
+   # Split a user_data template into a list of alternating literal strings and
+   # placeholder names, so each VM's user_data can be made in a single pass.
+   # Returns (parts, placeholders, joinableNames) where placeholders maps each
+   # name to its positions in parts, and joinableNames are placeholders with
+   # text either side which could join up with a value to make a new
+   # placeholder. Returns None if the result would depend on the order of
+   # substitution anyway, which happens if placeholders share ## delimiters.
+
+   try:
+     return compiledUserDataTemplates[template]
+   except KeyError:
+     pass
+
+   parts    = []
+   position = 0
+
+   for match in userDataPattern.finditer(template):
+     if userDataPattern.match(template, match.end() - 2) or userDataPattern.match(template, match.end() - 1):
+       parts = None
+       break
+
+     parts.append(template[position:match.start()])
+     parts.append(match.group()[2:-2])
+     position = match.end()
+
+   if parts is None:
+     compiled = None
+   else:
+     parts.append(template[position:])
+
+     placeholders  = {}
+     joinableNames = set()
+
+     for i in xrange(1, len(parts), 2):
+       placeholders.setdefault(parts[i], []).append(i)
+
+       # Text at the start or end of the template is fine, otherwise the
+       # character next to the placeholder must not be part of a placeholder
+       if (parts[i - 1] == '' and i > 1) or userDataPatternChars.match(parts[i - 1][-1:]) or \
+          (parts[i + 1] == '' and i < len(parts) - 2) or userDataPatternChars.match(parts[i + 1][:1]):
+         joinableNames.add(parts[i])
+
+     compiled = (parts, placeholders, joinableNames)
+
+   # Templates are kept until they stop changing so much
+   if len(compiledUserDataTemplates) > 100:
+     compiledUserDataTemplates.clear()
+
+   compiledUserDataTemplates[template] = compiled
+   return compiled
+
+def renderUserDataTemplate(template, substitutions):
+   # Apply the (placeholderName, value) substitutions in order, where the
+   # first value for each name wins, and remove any unused placeholders.
+   # The result is always the same as doing a str.replace() for each
+   # substitution in turn and then removing unused placeholders with
+   # re.sub(), which is still done if the compiled template cannot be used.
+
+   compiled = compileUserDataTemplate(template)
+
+   values = {}
+   for (name, value) in substitutions:
+     if name not in values:
+       values[name] = value
+
+   if compiled is not None:
+     (parts, placeholders, joinableNames) = compiled
+
+     for name in values:
+       if name in placeholders:
+         if name in joinableNames or userDataPattern.search(values[name]):
+           # Could form new placeholders, which str.replace() might then substitute
+           compiled = None
+           break
+
+       elif not userDataNamePattern.match(name):
+         # Placeholders the pattern cannot find, or only part of (such as
+         # with a # in the name), but str.replace() would
+         compiled = None
+         break
+
+   if compiled is None:
+     for (name, value) in substitutions:
+       template = template.replace('##' + name + '##', value)
+
+     return userDataPattern.sub('', template)
+
+   rendered = list(parts)
+
+   for (name, positions) in placeholders.iteritems():
+     value = values.get(name, '')
+     for i in positions:
+       rendered[i] = value
+
+   return ''.join(rendered)
+
+def getRemoteUserData(url, userDataCache, versionString, cacheSeconds):
+   # Return the user_data template at url, using the copy in the userDataCache
+   # directory if it was checked in the last cacheSeconds. Otherwise it is
+   # revalidated with ETag: / Last-Modified: and if the server cannot be
+   # reached, the cached copy is used anyway.
+
+   urlEncoded = urllib.quote(url, '')
+   cachedFile = userDataCache + '/' + urlEncoded
+
+   try:
+     cachedDict = json.load(open(cachedFile + '.json', 'r'))
+     cachedContents = readCachedFile(cachedFile)
+   except:
+     cachedDict     = None
+     cachedContents = None
+   else:
+     if cachedDict.get('checked', 0) > time.time() - cacheSeconds:
+       return cachedContents
+
+   buffer  = StringIO.StringIO()
+   headers = {}
+
+   def headerCallback(line):
+     try:
+       (name, value) = line.split(':', 1)
+     except ValueError:
+       return
+
+     headers[name.strip().lower()] = value.strip()
+
+   c = pycurl.Curl()
+   c.setopt(c.URL, url)
+   c.setopt(c.WRITEFUNCTION, buffer.write)
+   c.setopt(c.HEADERFUNCTION, headerCallback)
+   c.setopt(c.USERAGENT, versionString)
+   c.setopt(c.TIMEOUT, 30)
+   c.setopt(c.FOLLOWLOCATION, True)
+   c.setopt(c.SSL_VERIFYPEER, 1)
+   c.setopt(c.SSL_VERIFYHOST, 2)
+
+   if os.path.isdir('/etc/grid-security/certificates'):
+     c.setopt(c.CAPATH, '/etc/grid-security/certificates')
+   else:
+     logLine('/etc/grid-security/certificates directory does not exist - relying on curl bundle of commercial CAs')
+
+   if cachedContents is not None:
+     requestHeaders = []
+
+     if cachedDict.get('etag'):
+       requestHeaders.append('If-None-Match: ' + str(cachedDict['etag']))
+
+     if cachedDict.get('last_modified'):
+       requestHeaders.append('If-Modified-Since: ' + str(cachedDict['last_modified']))
+
+     c.setopt(c.HTTPHEADER, requestHeaders)
+
+   try:
+     c.perform()
+     responseCode = c.getinfo(c.RESPONSE_CODE)
+   except Exception as e:
+     c.close()
+
+     if cachedContents is None:
+       raise VacutilsError('Failed to read ' + url + ' (' + str(e) + ')')
+
+     logLine('Failed to read ' + url + ' (' + str(e) + ') - using cached copy')
+     return cachedContents
+
+   c.close()
+
+   if responseCode == 304:
+     cachedDict['checked'] = int(time.time())
+     createFile(cachedFile + '.json', json.dumps(cachedDict), tmpDir = userDataCache)
+     return cachedContents
+
+   if responseCode != 200:
+     if cachedContents is None:
+       raise VacutilsError('Failed to read ' + url + ' (HTTP code ' + str(responseCode) + ')')
+
+     logLine('Failed to read ' + url + ' (HTTP code ' + str(responseCode) + ') - using cached copy')
+     return cachedContents
+
+   contents = buffer.getvalue()
+
+   try:
+     createFile(cachedFile, contents, tmpDir = userDataCache)
+     createFile(cachedFile + '.json',
+                json.dumps({ 'url'           : url,
+                             'checked'       : int(time.time()),
+                             'etag'          : headers.get('etag'),
+                             'last_modified' : headers.get('last-modified') }),
+                tmpDir = userDataCache)
+   except Exception as e:
+     logLine('Failed to save ' + url + ' in ' + userDataCache + ' (' + str(e) + ')')
+   else:
+     logLine('Saved ' + url + ' as ' + cachedFile)
+
+   return contents
+
 def createUserData(shutdownTime, machinetypePath, options, versionString, spaceName, machinetypeName, userDataPath, hostName, uuidStr,
                    machinefeaturesURL = None, jobfeaturesURL = None, joboutputsURL = None, rootImageURL = None, heartbeatMachinesURL = None,
-                   gocdbSitename = None):
+                   gocdbSitename = None, userDataCache = None, userDataCacheSeconds = 60, proxyKeyPool = None):
 
-   # Get raw user_data template file, either from network ...
-   if (userDataPath[0:7] == 'http://') or (userDataPath[0:8] == 'https://'):
+   # List of (placeholder name, value) in the order they are applied
+   substitutions = []
+
+   # Get raw user_data template file, either from network via the cache ...
+   if userDataCache and ((userDataPath[0:7] == 'http://') or (userDataPath[0:8] == 'https://')):
+     userDataContents = getRemoteUserData(userDataPath, userDataCache, versionString, userDataCacheSeconds)
+
+     # We only do this substitution if it was an HTTP(S) URL
+     substitutions.append(('user_data_url', userDataPath))
+
+   # ... or directly from the network ...
+   elif (userDataPath[0:7] == 'http://') or (userDataPath[0:8] == 'https://'):
      buffer = StringIO.StringIO()
      c = pycurl.Curl()
      c.setopt(c.URL, userDataPath)
@@ -228,8 +587,10 @@ def createUserData(shutdownTime, machinetypePath, options, versionString, spaceN
 
      c.close()
 
+     userDataContents = buffer.getvalue()
+
      # We only do this substitution if it was an HTTP(S) URL
-     userDataContents = buffer.getvalue().replace('##user_data_url##', userDataPath)
+     substitutions.append(('user_data_url', userDataPath))
 
    # ... or from filesystem
    else:
@@ -239,45 +600,45 @@ def createUserData(shutdownTime, machinetypePath, options, versionString, spaceN
        userDataFile = machinetypePath + '/files/' + userDataPath
 
      try:
-       u = open(userDataFile, 'r')
-       userDataContents = u.read()
-       u.close()
+       userDataContents = readCachedFile(userDataFile)
      except:
        raise VacutilsError('Failed to read ' + userDataFile)
 
+   managerHostname = os.uname()[1]
+
    # Default substitutions (plus ##user_data_url## possibly done already)
    if gocdbSitename:
-     userDataContents = userDataContents.replace('##user_data_site##', gocdbSitename)
+     substitutions.append(('user_data_site', gocdbSitename))
    
-   userDataContents = userDataContents.replace('##user_data_space##',            spaceName)
-   userDataContents = userDataContents.replace('##user_data_machinetype##',      machinetypeName)
-   userDataContents = userDataContents.replace('##user_data_machine_hostname##', hostName)
-   userDataContents = userDataContents.replace('##user_data_manager_version##',  versionString)
-   userDataContents = userDataContents.replace('##user_data_manager_hostname##', os.uname()[1])
+   substitutions.append(('user_data_space',            spaceName))
+   substitutions.append(('user_data_machinetype',      machinetypeName))
+   substitutions.append(('user_data_machine_hostname', hostName))
+   substitutions.append(('user_data_manager_version',  versionString))
+   substitutions.append(('user_data_manager_hostname', managerHostname))
 
    if machinefeaturesURL:
-     userDataContents = userDataContents.replace('##user_data_machinefeatures_url##', machinefeaturesURL)
+     substitutions.append(('user_data_machinefeatures_url', machinefeaturesURL))
 
    if jobfeaturesURL:
-     userDataContents = userDataContents.replace('##user_data_jobfeatures_url##', jobfeaturesURL)
+     substitutions.append(('user_data_jobfeatures_url', jobfeaturesURL))
 
    if joboutputsURL:
-     userDataContents = userDataContents.replace('##user_data_joboutputs_url##', joboutputsURL)
+     substitutions.append(('user_data_joboutputs_url', joboutputsURL))
 
    if rootImageURL:
-     userDataContents = userDataContents.replace('##user_data_root_image_url##', rootImageURL)
+     substitutions.append(('user_data_root_image_url', rootImageURL))
 
    if heartbeatMachinesURL:
-     userDataContents = userDataContents.replace('##user_data_heartbeat_machines_url##', heartbeatMachinesURL)
+     substitutions.append(('user_data_heartbeat_machines_url', heartbeatMachinesURL))
 
    # Deprecated vmtype/VM/VMLM terminology
-   userDataContents = userDataContents.replace('##user_data_vmtype##',           machinetypeName)
-   userDataContents = userDataContents.replace('##user_data_vm_hostname##',      hostName)
-   userDataContents = userDataContents.replace('##user_data_vmlm_version##',     versionString)
-   userDataContents = userDataContents.replace('##user_data_vmlm_hostname##',    os.uname()[1])
+   substitutions.append(('user_data_vmtype',           machinetypeName))
+   substitutions.append(('user_data_vm_hostname',      hostName))
+   substitutions.append(('user_data_vmlm_version',     versionString))
+   substitutions.append(('user_data_vmlm_hostname',    managerHostname))
 
    if uuidStr:
-     userDataContents = userDataContents.replace('##user_data_uuid##', uuidStr)
+     substitutions.append(('user_data_uuid', uuidStr))
 
    # Insert a proxy created from user_data_proxy_cert / user_data_proxy_key
    if 'user_data_proxy' in options and options['user_data_proxy'] == True:
@@ -286,41 +647,46 @@ def createUserData(shutdownTime, machinetypePath, options, versionString, spaceN
 
      try:
        if ('legacy_proxy' in options) and options['legacy_proxy']:
-         userDataContents = userDataContents.replace('##user_data_option_x509_proxy##',
-                              makeX509Proxy(certPath, keyPath, shutdownTime, isLegacyProxy=True))
+         substitutions.append(('user_data_option_x509_proxy',
+                               makeX509Proxy(certPath, keyPath, shutdownTime, isLegacyProxy=True, keyPoolDir=proxyKeyPool)))
        else:
-         userDataContents = userDataContents.replace('##user_data_option_x509_proxy##',
-                              makeX509Proxy(certPath, keyPath, shutdownTime, isLegacyProxy=False, cn=machinetypeName))
+         substitutions.append(('user_data_option_x509_proxy',
+                               makeX509Proxy(certPath, keyPath, shutdownTime, isLegacyProxy=False, cn=machinetypeName, keyPoolDir=proxyKeyPool)))
      except Exception as e:
        raise VacutilsError('Faled to make proxy (' + str(e) + ')')
 
    # Site configurable substitutions for this machinetype
    for oneOption, oneValue in options.iteritems():
       if oneOption.startswith('user_data_option_'):
-        userDataContents = userDataContents.replace('##' + oneOption + '##', oneValue)
+        substitutions.append((oneOption, oneValue))
       elif oneOption.startswith('user_data_file_'):
         try:
            if oneValue[0] == '/':
-             f = open(oneValue, 'r')
+             fileContents = readCachedFile(oneValue)
            else:
-             f = open(machinetypePath + '/files/' + oneValue, 'r')
+             fileContents = readCachedFile(machinetypePath + '/files/' + oneValue)
+        except:
+           raise VacutilsError('Failed to read ' + oneValue + ' for ' + oneOption)
 
-           fileContents = f.read()
-           f.close()
+        # deprecated: replace ##user_data_file_xxxx## with value
+        substitutions.append((oneOption, fileContents))
 
-           # deprecated: replace ##user_data_file_xxxx## with value
-           userDataContents = userDataContents.replace('##' + oneOption + '##', fileContents)
+        # new behaviour: replace ##user_data_option_xxxx## with value from user_data_file_xxxx
+        substitutions.append(('user_data_option_' + oneOption[15:], fileContents))
 
-           # new behaviour: replace ##user_data_option_xxxx## with value from user_data_file_xxxx
-           userDataContents = userDataContents.replace('##user_data_option_' + oneOption[15:] + '##', fileContents)
+   # Substitute values and remove any unused patterns from the template
+   return renderUserDataTemplate(userDataContents, substitutions)
 
-        except:
-           raise VacutilsError('Failed to read ' + oneValue + ' for ' + oneOption)
+# M2Crypto is only imported by loadM2Crypto() when proxies or signatures
+# are actually needed, as most processes which import vacutils never use it
+M2Crypto = None
+
+def loadM2Crypto():
 
-   # Remove any unused patterns from the template
-   userDataContents = re.sub('##user_data_[a-z,0-9,_]*##', '', userDataContents)
+   global M2Crypto
 
-   return userDataContents
+   if M2Crypto is None:
+     import M2Crypto
 
 def emptyCallback1(p1):
    return
@@ -328,10 +694,32 @@ def emptyCallback1(p1):
 def emptyCallback2(p1, p2):
    return
 
-def makeX509Proxy(certPath, keyPath, expirationTime, isLegacyProxy=False, cn=None):
-   # Return a PEM-encoded limited proxy as a string in either Globus Legacy
-   # or RFC 3820 format. Checks that the existing cert/proxy expires after
-   # the given expirationTime, but no other checks are done.
+# (certPath, keyPath) -> (certStat, keyStat, signing key, cert PEM blocks, not after time)
+cachedX509Credentials = {}
+
+def _fileSignature(path):
+   statInfo = os.stat(path)
+   return (statInfo.st_mtime, statInfo.st_size, statInfo.st_ino)
+
+def loadX509Credentials(certPath, keyPath):
+   # Return the parsed signing key, the PEM blocks of the certificate chain,
+   # and the expiration time of the first certificate. These are cached and
+   # only reloaded if either file changes.
+
+   loadM2Crypto()
+
+   try:
+     certSignature = _fileSignature(certPath)
+     keySignature  = _fileSignature(keyPath)
+   except Exception as e:
+     raise VacutilsError('Failed to find ' + certPath + ' or ' + keyPath + ' (' + str(e) + ')')
+
+   try:
+     (cachedCertSignature, cachedKeySignature, oldKeyEVP, oldCertsPEM, notAfterTime) = cachedX509Credentials[(certPath, keyPath)]
+     if cachedCertSignature == certSignature and cachedKeySignature == keySignature:
+       return (oldKeyEVP, oldCertsPEM, notAfterTime)
+   except KeyError:
+     pass
 
    # First get the existing priviate key
 
@@ -340,6 +728,9 @@ def makeX509Proxy(certPath, keyPath, expirationTime, isLegacyProxy=False, cn=Non
    except Exception as e:
      raise VacutilsError('Failed to get private key from ' + keyPath + ' (' + str(e) + ')')
 
+   oldKeyEVP = M2Crypto.EVP.PKey()
+   oldKeyEVP.assign_rsa(oldKey)
+
    # Get the chain of certificates (just one if a usercert or hostcert file)
 
    try:
@@ -359,27 +750,131 @@ def makeX509Proxy(certPath, keyPath, expirationTime, isLegacyProxy=False, cn=Non
    if len(oldCerts) == 0:
      raise VacutilsError('Failed get certificate from ' + certPath)
 
+   # Certificates are kept as PEM, since their subject objects are changed
+   # in place when making each proxy
+
+   oldCertsPEM  = [ oneOldCert.as_pem() for oneOldCert in oldCerts ]
+   notAfterTime = int(calendar.timegm(time.strptime(str(oldCerts[0].get_not_after()), "%b %d %H:%M:%S %Y %Z")))
+
+   cachedX509Credentials[(certPath, keyPath)] = (certSignature, keySignature, oldKeyEVP, oldCertsPEM, notAfterTime)
+   return (oldKeyEVP, oldCertsPEM, notAfterTime)
+
+def claimProxyKey(keyPoolDir):
+   # Take one pregenerated RSA key from the pool directory, or return None if
+   # the pool is empty. Keys are claimed by renaming them, so each key is only
+   # ever used once even if several processes share the pool.
+
+   loadM2Crypto()
+
+   try:
+     keyNames = os.listdir(keyPoolDir)
+   except:
+     return None
+
+   for keyName in keyNames:
+     if not keyName.startswith('key-'):
+       continue
+
+     claimedPath = keyPoolDir + '/claimed-' + str(os.getpid()) + '-' + keyName
+
+     try:
+       os.rename(keyPoolDir + '/' + keyName, claimedPath)
+     except:
+       # Someone else got there first
+       continue
+
+     try:
+       rsaKey = M2Crypto.RSA.load_key(claimedPath, emptyCallback1)
+     except Exception as e:
+       logLine('Failed to load pregenerated key ' + claimedPath + ' (' + str(e) + ')')
+       rsaKey = None
+
+     os.remove(claimedPath)
+
+     if rsaKey is not None:
+       return rsaKey
+
+   return None
+
+def topUpProxyKeyPool(keyPoolDir, poolSize):
+   # Generate RSA keys for proxies until there are poolSize of them in
+   # keyPoolDir. The directory is only readable by its owner.
+
+   loadM2Crypto()
+
+   try:
+     os.makedirs(keyPoolDir, stat.S_IRWXU)
+   except OSError:
+     pass
+
+   os.chmod(keyPoolDir, stat.S_IRWXU)
+
+   try:
+     keyCount = len([ keyName for keyName in os.listdir(keyPoolDir) if keyName.startswith('key-') ])
+   except:
+     return
+
+   # Remove keys left claimed by processes which died
+   for keyName in os.listdir(keyPoolDir):
+     if keyName.startswith('claimed-'):
+       try:
+         if os.stat(keyPoolDir + '/' + keyName).st_mtime < time.time() - 3600:
+           os.remove(keyPoolDir + '/' + keyName)
+       except:
+         pass
+
+   while keyCount < poolSize:
+     rsaKey = M2Crypto.RSA.gen_key(1024, 65537, emptyCallback2)
+
+     createFile(keyPoolDir + '/key-%.6f-%d' % (time.time(), os.getpid()),
+                rsaKey.as_pem(cipher = None),
+                stat.S_IRUSR | stat.S_IWUSR,
+                keyPoolDir)
+
+     keyCount += 1
+
+def makeX509Proxy(certPath, keyPath, expirationTime, isLegacyProxy=False, cn=None, keyPoolDir=None):
+   # Return a PEM-encoded limited proxy as a string in either Globus Legacy
+   # or RFC 3820 format. Checks that the existing cert/proxy expires after
+   # the given expirationTime, but no other checks are done. If keyPoolDir
+   # is given then a key pregenerated by topUpProxyKeyPool() is used if
+   # there is one.
+
+   loadM2Crypto()
+
+   (oldKeyEVP, oldCertsPEM, notAfterTime) = loadX509Credentials(certPath, keyPath)
+
    # Check the expirationTime
 
-   if int(calendar.timegm(time.strptime(str(oldCerts[0].get_not_after()), "%b %d %H:%M:%S %Y %Z"))) < expirationTime:
+   if notAfterTime < expirationTime:
      raise VacutilsError('Cert/proxy ' + certPath + ' expires before given expiration time ' + str(expirationTime))
 
+   oldCert = M2Crypto.X509.load_cert_string(oldCertsPEM[0])
+
    # Create the public/private keypair for the new proxy
 
+   rsaKey = None
+
+   if keyPoolDir:
+     rsaKey = claimProxyKey(keyPoolDir)
+
+   if rsaKey is None:
+     rsaKey = M2Crypto.RSA.gen_key(1024, 65537, emptyCallback2)
+
    newKey = M2Crypto.EVP.PKey()
-   newKey.assign_rsa(M2Crypto.RSA.gen_key(1024, 65537, emptyCallback2))
+   newKey.assign_rsa(rsaKey)
 
    # Start filling in the new certificate object
 
    newCert = M2Crypto.X509.X509()
    newCert.set_pubkey(newKey)
    newCert.set_serial_number(int(time.time() * 100))
-   newCert.set_issuer_name(oldCerts[0].get_subject())
+   newCert.set_issuer_name(oldCert.get_subject())
    newCert.set_version(2) # "2" is X.509 for "v3" ...
 
    # Construct the legacy or RFC style subject
 
-   newSubject = oldCerts[0].get_subject()
+   newSubject = oldCert.get_subject()
 
    if isLegacyProxy:
      # Globus legacy proxy
@@ -426,28 +921,72 @@ def makeX509Proxy(certPath, keyPath, expirationTime, isLegacyProxy=False, cn=Non
      newCert.add_ext(M2Crypto.X509.new_extension("proxyCertInfo", "critical, language:1.3.6.1.4.1.3536.1.1.1.9", 1, 0))
 
    # Sign the certificate with the old private key
-   oldKeyEVP = M2Crypto.EVP.PKey()
-   oldKeyEVP.assign_rsa(oldKey)
    newCert.sign(oldKeyEVP, 'sha256')
 
    # Return proxy as a string of PEM blocks
 
    proxyString = newCert.as_pem() + newKey.as_pem(cipher = None)
 
-   for oneOldCert in oldCerts:
-     proxyString += oneOldCert.as_pem()
+   for oneOldCertPEM in oldCertsPEM:
+     proxyString += oneOldCertPEM
 
    return proxyString
 
-def getCernvmImageData(fileName):
+# (fileName, size, mtime, inode) -> (time verified, data) of verified images
+cachedCernvmImageData = {}
 
-   data = { 'verified' : False, 'dn' : None }
+def getCernvmImageData(fileName, cacheDir = None, cacheSeconds = 86400):
+   # Verify the signature of a CernVM image and return a dictionary with the
+   # signing DN and version. Successful results are cached in memory and, if
+   # cacheDir is given, on disk, so an unchanged image is only verified once
+   # every cacheSeconds, which allows for the signing certificate expiring.
 
    try:
-     length = os.stat(fileName).st_size
+     statInfo = os.stat(fileName)
    except Exception as e:
      logLine('Failed to get CernVM image size (' + str(e) + ')')
-     return data
+     return { 'verified' : False, 'dn' : None }
+
+   cacheKey = [ os.path.realpath(fileName), statInfo.st_size, statInfo.st_mtime, statInfo.st_ino ]
+
+   if cacheDir:
+     cacheFile = cacheDir + '/' + urllib.quote(cacheKey[0], '') + '.json'
+
+     try:
+       cacheDict = json.load(open(cacheFile, 'r'))
+       if cacheDict['key'] == cacheKey and tuple(cacheKey) not in cachedCernvmImageData:
+         cachedCernvmImageData[tuple(cacheKey)] = (cacheDict['verified_time'], cacheDict['data'])
+     except:
+       pass
+
+   try:
+     (verifiedTime, data) = cachedCernvmImageData[tuple(cacheKey)]
+   except KeyError:
+     pass
+   else:
+     if verifiedTime > time.time() - cacheSeconds:
+       return dict(data)
+
+   data = verifyCernvmImage(fileName, statInfo.st_size)
+
+   if data['verified']:
+     verifiedTime = int(time.time())
+     cachedCernvmImageData[tuple(cacheKey)] = (verifiedTime, dict(data))
+
+     if cacheDir:
+       try:
+         if not os.path.isdir(cacheDir):
+           os.makedirs(cacheDir, stat.S_IRWXU)
+
+         createFile(cacheFile, json.dumps({ 'key' : cacheKey, 'verified_time' : verifiedTime, 'data' : data }), tmpDir = cacheDir)
+       except Exception as e:
+         logLine('Failed to save CernVM image verification in ' + cacheDir + ' (' + str(e) + ')')
+
+   return data
+
+def verifyCernvmImage(fileName, length):
+
+   data = { 'verified' : False, 'dn' : None }
 
    if length <= 65536:
      logLine('CernVM image only ' + str(length) + ' bytes long: must be more than 65536')
@@ -482,15 +1021,27 @@ def getCernvmImageData(fileName):
      return data
 
    try:
+     # Read in chunks so memory use does not depend on the size of the image
      f.seek(0, os.SEEK_SET)
-     digestableImage = f.read(length - 32 * 1024)
-     hash = hashlib.sha256(digestableImage)
+     hash = hashlib.sha256()
+     remaining = length - 32 * 1024
+
+     while remaining > 0:
+       chunk = f.read(min(remaining, 1048576))
+
+       if not chunk:
+         raise VacutilsError('Image shorter than expected')
+
+       hash.update(chunk)
+       remaining -= len(chunk)
+
      digest = hash.digest()
    except Exception as e:
      logLine('Failed to make digest of CernVM image (' + str(e) + ')')
      return data
 
    try:
+     loadM2Crypto()
      certificate = base64.b64decode(signatureDict['certificate'])
      x509 = M2Crypto.X509.load_cert_string(certificate)
      rsaPubkey = x509.get_pubkey().get_rsa()
@@ -678,14 +1229,168 @@ def setProcessName(processName):
      logLine('Failed setting process name in argv[] to ' + processName)
      return
 
-def makeSyncRecord(dirPrefix, targetYearMonth, tmpDir):
-
+def parseApelRecords(text):
+   # Split the text of an APEL file into one dictionary per %% terminated record.
+   # The APEL-...-message header line at the start of the file is not part of
+   # any record, and files written by older versions repeat it for each record
+
+   records = []
+   record  = {}
+
+   for line in text.splitlines():
+     if line.startswith('APEL-') and '-message:' in line:
+       continue
+     elif line.startswith('%%'):
+       records.append(record)
+       record = {}
+     elif ':' in line:
+       (key, value) = line.split(':', 1)
+       record[key.strip()] = value.strip()
+
+   return records
+
+def openApelIndex(dirPrefix):
+   # Open the index of the records in dirPrefix/apel-archive, creating it if
+   # necessary. Month and day come from the YYYYMMDD directory of each file,
+   # as makeSyncRecord has always counted them
+
+   conn = sqlite3.connect(dirPrefix + '/apel-index.sqlite3', timeout = 60)
+
+   conn.execute('CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY)')
+   conn.execute('CREATE TABLE IF NOT EXISTS records '
+                '(file TEXT, seq INTEGER, month TEXT, day TEXT, site TEXT, submit_host TEXT, '
+                'local_job_id TEXT, queue TEXT, wall_seconds INTEGER, processors INTEGER, '
+                'service_level REAL, end_time INTEGER, PRIMARY KEY (file, seq))')
+   conn.execute('CREATE INDEX IF NOT EXISTS records_month ON records (month, site, submit_host)')
+   conn.execute('CREATE INDEX IF NOT EXISTS records_day ON records (day, queue)')
+   conn.commit()
+
+   return conn
+
+def _apelInt(record, key):
    try:
-      targetMonth = int(targetYearMonth[4:6])
-      targetYear  = int(targetYearMonth[0:4])
+     return int(float(record[key]))
    except:
-      print 'Cannot parse as YYYYMM: ' + targetYearMonth
-      return 1
+     return None
+
+def indexApelFile(conn, fileName, text):
+   # Add the records of one apel-archive file, named as YYYYMMDD/HHMMSS..., to
+   # the index. Indexing the same file again replaces its records
+
+   rows = []
+
+   # sqlite3 only accepts ASCII in str values
+   if isinstance(text, str):
+     text = text.decode('utf-8', 'replace')
+
+   for (seq, record) in enumerate(parseApelRecords(text)):
+     try:
+       serviceLevel = float(record['ServiceLevel'])
+     except:
+       serviceLevel = None
+
+     rows.append((fileName, seq, fileName[:6], fileName[:8],
+                  record.get('Site') or None, record.get('SubmitHost') or None,
+                  record.get('LocalJobId'), record.get('Queue'),
+                  _apelInt(record, 'WallDuration'), _apelInt(record, 'Processors'),
+                  serviceLevel, _apelInt(record, 'EndTime')))
+
+   conn.execute('DELETE FROM records WHERE file = ?', (fileName,))
+   conn.executemany('INSERT INTO records VALUES (?,?,?,?,?,?,?,?,?,?,?,?)', rows)
+   conn.execute('INSERT OR REPLACE INTO files VALUES (?)', (fileName,))
+   conn.commit()
+
+def addApelIndex(dirPrefix, fileName, text):
+   # Called when an apel-archive file is written, so the index is current
+   # without rereading the archive later
+
+   conn = openApelIndex(dirPrefix)
+
+   try:
+     indexApelFile(conn, fileName, text)
+   finally:
+     conn.close()
+
+def updateApelIndex(conn, dirPrefix, yearMonth):
+   # Index any files for the month written without updating the index, such
+   # as those from before the index existed. Only the file names are listed,
+   # and only new files are opened
+
+   indexedFiles = set([ row[0] for row in conn.execute('SELECT name FROM files WHERE name LIKE ?', (yearMonth + '%',)) ])
+
+   for path in glob.glob(dirPrefix + '/apel-archive/' + yearMonth + '*/*'):
+     fileName = '/'.join(path.split('/')[-2:])
+
+     if fileName not in indexedFiles:
+       try:
+         indexApelFile(conn, fileName, open(path, 'r').read())
+       except Exception as e:
+         logLine('Failed indexing ' + path + ' (' + str(e) + ')')
+
+def apelUsage(dirPrefix, fromDay, toDay):
+   # Return a list of (day, queue, jobs, HS06 hours) for the days YYYYMMDD
+   # from fromDay to toDay inclusive. ServiceLevel is the HS06 of the whole job
+
+   conn = openApelIndex(dirPrefix)
+
+   try:
+     year  = int(fromDay[0:4])
+     month = int(fromDay[4:6])
+
+     while '%04d%02d' % (year, month) <= toDay[0:6]:
+       updateApelIndex(conn, dirPrefix, '%04d%02d' % (year, month))
+       (year, month) = (year + 1, 1) if month == 12 else (year, month + 1)
+
+     return conn.execute('SELECT day, queue, COUNT(*), SUM(wall_seconds * IFNULL(service_level, 1.0)) / 3600.0 '
+                         'FROM records WHERE day >= ? AND day <= ? '
+                         'GROUP BY day, queue ORDER BY day, queue', (fromDay, toDay)).fetchall()
+   finally:
+     conn.close()
+
+def countApelRecords(dirPrefix, targetYearMonth):
+   # Return (site, submitHost, numberJobs) for the month from the index. We
+   # assume that site and SubmitHost of the most recent record are correct
+
+   conn = openApelIndex(dirPrefix)
+
+   try:
+     updateApelIndex(conn, dirPrefix, targetYearMonth)
+
+     for (count,) in conn.execute('SELECT COUNT(*) FROM records WHERE month = ? AND site IS NULL', (targetYearMonth,)):
+       if count:
+         print 'No Site given in ' + str(count) + ' records for ' + targetYearMonth + ' !! - please fix this - skipping'
+
+     for (count,) in conn.execute('SELECT COUNT(*) FROM records WHERE month = ? AND site IS NOT NULL AND submit_host IS NULL', (targetYearMonth,)):
+       if count:
+         print 'No SubmitHost given in ' + str(count) + ' records for ' + targetYearMonth + ' !! - please fix this - skipping'
+
+     row = conn.execute('SELECT site, submit_host FROM records '
+                        'WHERE month = ? AND site IS NOT NULL AND submit_host IS NOT NULL '
+                        'ORDER BY file DESC, seq DESC LIMIT 1', (targetYearMonth,)).fetchone()
+
+     if row is None:
+       return (None, None, 0)
+
+     (site, submitHost) = (str(row[0]), str(row[1]))
+
+     for (thisSite, thisSubmitHost, count) in conn.execute('SELECT site, submit_host, COUNT(*) FROM records '
+                                                           'WHERE month = ? AND site IS NOT NULL AND submit_host IS NOT NULL '
+                                                           'AND (site != ? OR submit_host != ?) GROUP BY site, submit_host',
+                                                           (targetYearMonth, site, submitHost)):
+       if thisSite != site:
+         print 'Site changes from ' + site + ' to ' + thisSite + ' in ' + str(count) + ' records - please fix - skipping'
+       else:
+         print 'SubmitHost changes from ' + submitHost + ' to ' + thisSubmitHost + ' in ' + str(count) + ' records - please fix - skipping'
+
+     (numberJobs,) = conn.execute('SELECT COUNT(*) FROM records WHERE month = ? AND site = ? AND submit_host = ?',
+                                  (targetYearMonth, site, submitHost)).fetchone()
+
+     return (site, submitHost, numberJobs)
+   finally:
+     conn.close()
+
+def scanApelRecords(dirPrefix, targetYearMonth):
+   # Return (site, submitHost, numberJobs) for the month by reading every file
 
    numberJobs = 0
    site       = None
@@ -697,39 +1402,56 @@ def makeSyncRecord(dirPrefix, targetYearMonth, tmpDir):
    recordsList.sort(reverse=True)
 
    for fileName in recordsList:
-      thisSite = None
-      thisSubmitHost = None
-
-      for line in open(fileName, 'r'):
-        if line.startswith('Site:'):
-          thisSite = line[5:].strip()
-        elif line.startswith('SubmitHost:'):
-          thisSubmitHost = line[11:].strip()
-
-        if thisSite and thisSubmitHost:
-          break
-
-      if thisSite is None:
-        print 'No Site given in ' + fileName + ' !! - please fix this - skipping'
-        continue
-
-      if thisSubmitHost is None:
-        print 'No SubmitHost given in ' + fileName + ' !! - please fix this - skipping'
-        continue
-
-      if site is None:
-        site = thisSite
-      elif site != thisSite:
-        print 'Site changes from ' + site + ' to ' + thisSite + ' - please fix ' + fileName + ' - skipping'
-        continue
-
-      if submitHost is None:
-        submitHost = thisSubmitHost
-      elif submitHost != thisSubmitHost:
-        print 'SubmitHost changes from ' + submitHost + ' to ' + thisSubmitHost + ' - please fix ' + fileName + ' - skipping'
-        continue
-
-      numberJobs += 1
+      # Each file can contain several records separated by %% lines
+      fileRecords = [ (record.get('Site'), record.get('SubmitHost')) for record in parseApelRecords(open(fileName, 'r').read()) ]
+
+      # Most recent records are last within each file
+      fileRecords.reverse()
+
+      for (thisSite, thisSubmitHost) in fileRecords:
+
+        if thisSite is None:
+          print 'No Site given in a record in ' + fileName + ' !! - please fix this - skipping'
+          continue
+
+        if thisSubmitHost is None:
+          print 'No SubmitHost given in a record in ' + fileName + ' !! - please fix this - skipping'
+          continue
+
+        if site is None:
+          site = thisSite
+        elif site != thisSite:
+          print 'Site changes from ' + site + ' to ' + thisSite + ' - please fix ' + fileName + ' - skipping'
+          continue
+
+        if submitHost is None:
+          submitHost = thisSubmitHost
+        elif submitHost != thisSubmitHost:
+          print 'SubmitHost changes from ' + submitHost + ' to ' + thisSubmitHost + ' - please fix ' + fileName + ' - skipping'
+          continue
+
+        numberJobs += 1
+
+   return (site, submitHost, numberJobs)
+
+def makeSyncRecord(dirPrefix, targetYearMonth, tmpDir):
+
+   try:
+      targetMonth = int(targetYearMonth[4:6])
+      targetYear  = int(targetYearMonth[0:4])
+   except:
+      print 'Cannot parse as YYYYMM: ' + targetYearMonth
+      return 1
+
+   try:
+      (site, submitHost, numberJobs) = countApelRecords(dirPrefix, targetYearMonth)
+   except Exception as e:
+      print 'Cannot use ' + dirPrefix + '/apel-index.sqlite3 (' + str(e) + ') - reading apel-archive instead'
+      (site, submitHost, numberJobs) = scanApelRecords(dirPrefix, targetYearMonth)
+
+   if site is None or submitHost is None:
+      print 'No records with Site and SubmitHost found for ' + targetYearMonth
+      return 1
 
    syncRecord = 'APEL-sync-message: v0.1\n'               \
                 'Site: ' + site + '\n'                    \
@@ -63,6 +63,9 @@ fi
 %{python_sitelib}/vcycle/__init__.py*
 %{python_sitelib}/vcycle/shared.py*
 %{python_sitelib}/vcycle/vacutils.py*
+%{python_sitelib}/vcycle/joboutputs.py*
+%{python_sitelib}/vcycle/imagecache.py*
+%{python_sitelib}/vcycle/metrics.py*
 %{python_sitelib}/vcycle/openstack/openstack_api.py*
 %{python_sitelib}/vcycle/ec2_api.py*
 %{python_sitelib}/vcycle/openstack/*.py*